@@ -0,0 +1,137 @@
+#include <Braccio.h>
+#include <Servo.h>
+
+// Interpreter of motion scripts streamed by the lab through the serial port.
+// Every packet is: SYNC, type, sequence number, payload length, payload and
+// the 8 bit sum of type, sequence number, length and payload. Each accepted
+// packet is answered with ACK and its sequence number; a corrupted or out of
+// order packet with NAK and the sequence number expected. Packets are only
+// read while there is room in the queue, so the sender never overflows the
+// 64 byte receive buffer as long as it keeps at most 4 packets unanswered.
+// Packet types:
+//   'B' begin a new script, the queue is emptied
+//   'W' waypoint: stepDelay, base, shoulder, elbow, wrist_ver, wrist_rot, gripper
+//   'E' end of the script, DONE is sent when its last waypoint is reached
+
+#define SOFT_START_LEVEL -70
+
+#define BAUDRATE 115200
+#define SYNC 0xA5
+#define ACK 0x06
+#define NAK 0x15
+#define DONE 0x04
+
+#define QUEUE_SIZE 16
+#define WAYPOINT_SIZE 7
+#define MAX_PACKET (4 + WAYPOINT_SIZE + 1)
+
+Servo base;
+Servo shoulder;
+Servo elbow;
+Servo wrist_rot;
+Servo wrist_ver;
+Servo gripper;
+
+uint8_t queue[QUEUE_SIZE][WAYPOINT_SIZE];
+uint8_t head = 0;
+uint8_t count = 0;
+
+uint8_t packet[MAX_PACKET];
+uint8_t received = 0;
+uint8_t expected = 0;
+bool nakSent = false;
+bool ending = false;
+uint8_t endSeq = 0;
+
+void reply(uint8_t code, uint8_t seq) {
+  Serial.write(code);
+  Serial.write(seq);
+}
+
+// Ask for the expected packet, once until it is received
+void nak() {
+  if (!nakSent) {
+    reply(NAK, expected);
+    nakSent = true;
+  }
+}
+
+void handlePacket() {
+  uint8_t type = packet[1];
+  uint8_t seq = packet[2];
+  uint8_t length = packet[3];
+
+  uint8_t sum = type + seq + length;
+  for (uint8_t i = 0; i < length; i++) {
+    sum += packet[4 + i];
+  }
+  if (sum != packet[4 + length]) {
+    nak();
+    return;
+  }
+
+  if (type == 'B') {
+    count = 0;
+    ending = false;
+    expected = seq + 1;
+    nakSent = false;
+    reply(ACK, seq);
+    return;
+  }
+  if (seq != expected) {
+    if ((uint8_t)(expected - seq) <= 128) {
+      reply(ACK, seq); // Already received, its ACK was lost
+    } else {
+      nak(); // A packet was lost
+    }
+    return;
+  }
+
+  if (type == 'W' && length == WAYPOINT_SIZE) {
+    memcpy(queue[(head + count) % QUEUE_SIZE], &packet[4], WAYPOINT_SIZE);
+    count++;
+  } else if (type == 'E') {
+    ending = true;
+    endSeq = seq;
+  }
+  expected++;
+  nakSent = false;
+  reply(ACK, seq);
+}
+
+void readByte(uint8_t b) {
+  if (received == 0 && b != SYNC) {
+    return;
+  }
+  packet[received++] = b;
+  if (received == 4 && packet[3] > WAYPOINT_SIZE) {
+    // Not a packet or a corrupted length, look for the next SYNC. The packet
+    // is asked for again at once, without waiting for the sender's timeout.
+    received = 0;
+    nak();
+  } else if (received >= 4 && received == 5 + packet[3]) {
+    handlePacket();
+    received = 0;
+  }
+}
+
+void setup() {
+  Serial.begin(BAUDRATE);
+  Braccio.begin(SOFT_START_LEVEL);
+}
+
+void loop() {
+  while (count < QUEUE_SIZE && Serial.available()) {
+    readByte(Serial.read());
+  }
+
+  if (count > 0) {
+    uint8_t *w = queue[head];
+    Braccio.ServoMovement(w[0], w[1], w[2], w[3], w[4], w[5], w[6]);
+    head = (head + 1) % QUEUE_SIZE;
+    count--;
+  } else if (ending) {
+    reply(DONE, endSeq);
+    ending = false;
+  }
+}
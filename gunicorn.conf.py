@@ -0,0 +1,13 @@
+import os
+
+
+# Production server of the lab. Every worker process runs its own copy of the
+# app, they share the board locks, the job status and the compile cache
+# through the files of the run folder (see get_run_path() of utils.py) and
+# arduino/compilations.
+bind = '0.0.0.0:8000'
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_WORKERS', 2))
+threads = int(os.environ.get('WEB_THREADS', 8))
+# Uploads and the legacy monitor can take longer than the default 30 seconds
+timeout = 120
@@ -1,28 +1,102 @@
+import logging
 import os
+import shutil
+import threading
 from datetime import datetime, timedelta, timezone
 
 from flask import Flask
 from flask_login import LoginManager
 
+from .compile_cache import CompileCache
 from .config import Config
-from .utils import User, cleanLab, update_boards_config
+from .discovery import BoardDiscovery
+from .jobs import JobQueue
+from .metrics import metrics
+from .serial_monitor import SerialManager
+from .shared_state import FileLock
+from .startup import LabStartup
+from .suggestions import SuggestionClient
+from .toolchain import start_daemon
+from .trace import TraceRecorder
+from .utils import User, cleanLab, update_boards_config, precompile_examples, get_workspace_path, \
+                    get_run_path
+from .workspace import Workspace
 
 
 url_prefix = '/' + Config.server_name + '/' + Config.lab_name
-# The user end time will be 10 seconds before the actual end time
+# The user end time will be some seconds before the actual end time
 # to have some margin to clean the lab
 user_end_time = datetime.strptime(Config.end_time, "%Y-%m-%dT%H:%M:%S.%fZ")\
-    .replace(tzinfo=timezone.utc) - timedelta(seconds=10)
+    .replace(tzinfo=timezone.utc) - timedelta(seconds=Config.clean_margin)
 
-boards = update_boards_config(Config.boards_config)
+# The boards are found in the background (see LabStartup), or when they are
+# first used in the processes that do not run the startup
+discovery = BoardDiscovery(Config.sysfs_root, Config.usb_hub)
+boards = Config.boards_config
+# Keep the tty of the boards updated when they are plugged again or power cycled
+discovery.watch([config['usb_port'] for config in boards.values()],
+                lambda usb_port: update_boards_config(boards, discovery, check_connected=False))
 
 app = Flask(__name__, instance_path=os.path.join(os.getcwd(), 'arduino'),
             static_url_path=(url_prefix+'/static/'))
 app.config.from_mapping(Config.flask_config)
 
-# Start the thread to clean the lab
-clean_lab = cleanLab(boards, user_end_time, app.instance_path)
-clean_lab.start()
+if Config.log_metrics:
+    logging.basicConfig(format='%(message)s')
+    logging.getLogger('in4labs_robotics_app.metrics').setLevel(logging.INFO)
+
+# Cache of compilation artifacts shared by all the boards
+compile_cache = CompileCache(os.path.join(app.instance_path, 'compilations', 'cache_store'),
+                                Config.compile_cache_size)
+
+# Folder of the compilations of the session, removed when it ends
+workspace = Workspace(get_workspace_path(app.instance_path), Config.workspace_size)
+
+# Locks and state shared by the processes of the production server
+run_path = get_run_path(app.instance_path)
+
+# Recorder of the requests and jobs of the session, only if TRACE_PATH is set
+trace = TraceRecorder(Config.trace_path) if Config.trace_path else None
+
+# Compile and upload jobs, serialized per board
+jobs = JobQueue(Config.job_workers, run_path, trace=trace)
+
+# Serial port sessions kept open during the user session, one per board
+serial_sessions = SerialManager(run_path)
+
+# Client of the code suggestion API
+suggestions = SuggestionClient(Config.suggest_url, Config.suggest_timeout,
+                                Config.suggest_cache_ttl, Config.suggest_cache_size)
+
+# Status of the startup of every board, shared by all the processes
+startup = LabStartup(boards, discovery, run_path, app.instance_path, serial_sessions, jobs, Config.end_time)
+
+# Only the first process (the leader) starts and cleans the lab and precompiles
+# the examples, the lock is held until it exits. The other processes wait until
+# the leader has reset the status of the boards left by a previous run. A
+# worker that becomes the leader when gunicorn replaces a dead one finds the
+# startup of the session done, and only takes over the cleaning at its end.
+with FileLock(os.path.join(run_path, 'startup.lock')):
+    leader_lock = FileLock(os.path.join(run_path, 'leader.lock'))
+    is_leader = leader_lock.acquire(blocking=False)
+    resumed = is_leader and startup.done()
+    if is_leader and not resumed:
+        startup.reset()
+        shutil.rmtree(os.path.join(run_path, 'metrics'), ignore_errors=True)
+
+# The arduino-cli daemon of the daemon backend is shared by all the processes.
+# If a killed leader left one running, the one of the new leader cannot bind
+# the port and exits, and the running one keeps serving all the processes.
+if is_leader and Config.arduino_cli_backend == 'daemon' and Config.arduino_cli_daemon_address is None:
+    start_daemon(Config.arduino_cli_daemon_port)
+
+# Timings and counters added up over all the processes
+metrics.share(os.path.join(run_path, 'metrics'))
+
+# Start the thread that starts the boards and cleans the lab at the end
+clean_lab = cleanLab(boards, user_end_time, app.instance_path, serial_sessions, jobs, workspace, startup)
+if is_leader:
+    clean_lab.start()
 
 # Flask-Login configuration
 login_manager = LoginManager()
@@ -37,13 +111,15 @@ def load_user(user_id):
     return user
 
 # Create the subfolders for the compilations
-try:
-    for board in boards.keys():
-        os.makedirs(os.path.join(app.instance_path, 'compilations', board))
-        for dir in ['build', 'cache', 'temp_sketch']:
-            os.makedirs(os.path.join(app.instance_path, 'compilations', board, dir))
-except OSError:
-    pass
+for board in boards.keys():
+    for dir in ['build', 'temp_sketch']:
+        os.makedirs(os.path.join(workspace.path, board, dir), exist_ok=True)
+
+# Precompile the examples in the background so the app starts serving immediately
+precompile_thread = threading.Thread(target=precompile_examples, daemon=True,
+                                args=(boards, compile_cache, app.instance_path))
+if is_leader and not resumed:
+    precompile_thread.start()
 
 # Register blueprints - moved to the end to avoid circular imports
 def register_blueprints():
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from .shared_state import FileLock
+
+
+# Placeholder stored in the cached stderr instead of the sketch folder path,
+# so an entry can be served to any board that shares the same FQBN
+SKETCH_PATH_TOKEN = '{{sketch_path}}'
+
+# Only the flashable images are kept from the build folder
+ARTIFACT_EXTENSIONS = ('.hex', '.bin')
+
+# Age of a temporary entry folder after which its put() is considered dead.
+# A put() only copies a few files, the folders of the ones in progress in
+# other processes are much younger.
+STALE_TMP_SECONDS = 3600
+
+
+def normalize_sketch(code):
+    # The compiler reads every line ending as a new line. Anything else, even
+    # trailing whitespace, may change the image (a raw string literal) or the
+    # positions in the diagnostics.
+    return code.replace('\r\n', '\n').replace('\r', '\n')
+
+# Class to store compilation results addressed by the content that produces them.
+# Each entry is a folder named after its key with the artifacts and a meta.json
+# file containing the return code and the stderr of the compilation.
+class CompileCache(object):
+    def __init__(self, cache_path, max_size):
+        self.cache_path = cache_path
+        self.max_size = max_size # in bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> size, least recently used first
+        self.size = 0
+        self.examples = {} # example name -> keys of its precompiled entries
+        # The pins are also saved in a file, so the processes that did not
+        # precompile the examples do not evict them either
+        self.pins_file = os.path.join(cache_path, 'pins.json')
+
+        os.makedirs(self.cache_path, exist_ok=True)
+        self._load()
+
+    # Rebuild the LRU index from the entries already on disk
+    def _load(self):
+        entries = []
+        for key in os.listdir(self.cache_path):
+            if key.endswith('.tmp'):
+                # Leftover of an interrupted write, or a write in progress in
+                # another process if it is recent
+                tmp_path = os.path.join(self.cache_path, key)
+                try:
+                    if time.time() - os.path.getmtime(tmp_path) > STALE_TMP_SECONDS:
+                        shutil.rmtree(tmp_path, ignore_errors=True)
+                except OSError:
+                    pass # Renamed or removed by its put() in the meantime
+                continue
+            meta_file = os.path.join(self.cache_path, key, 'meta.json')
+            if os.path.isfile(meta_file):
+                entries.append((os.path.getmtime(meta_file), key))
+        for _, key in sorted(entries):
+            entry_size = self._entry_size(key)
+            self.entries[key] = entry_size
+            self.size += entry_size
+
+    def _entry_size(self, key):
+        entry_path = os.path.join(self.cache_path, key)
+        return sum(os.path.getsize(os.path.join(entry_path, file))
+                        for file in os.listdir(entry_path))
+
+    # Keys pinned by any process, by example name
+    def _load_pins(self):
+        try:
+            with open(self.pins_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _evict(self):
+        pinned = set().union(*self.examples.values(), *self._load_pins().values())
+        for key in list(self.entries):
+            if self.size <= self.max_size:
+                break
+            if key not in pinned:
+                shutil.rmtree(os.path.join(self.cache_path, key), ignore_errors=True)
+                self.size -= self.entries.pop(key)
+
+    # Index an entry by example name and protect it from eviction
+    def pin(self, key, example):
+        with self.lock:
+            if key in self.entries:
+                self.examples.setdefault(example, set()).add(key)
+                with FileLock(self.pins_file + '.lock'):
+                    pins = self._load_pins()
+                    pins[example] = sorted(set(pins.get(example, [])) | self.examples[example])
+                    with open(self.pins_file + '.new', 'w') as f:
+                        json.dump(pins, f)
+                    os.replace(self.pins_file + '.new', self.pins_file)
+
+    @staticmethod
+    def make_key(code, fqbn, toolchain_version):
+        digest = hashlib.sha256()
+        for part in [normalize_sketch(code), fqbn, toolchain_version]:
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    # Return the cached result as a dict or None if the key is not stored.
+    # Entries written by other processes are added to the index when found.
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                if not os.path.isfile(os.path.join(self.cache_path, key, 'meta.json')):
+                    return None
+                self.entries[key] = self._entry_size(key)
+                self.size += self.entries[key]
+            meta_file = os.path.join(self.cache_path, key, 'meta.json')
+            try:
+                with open(meta_file) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                # Entry removed or corrupted from outside, forget it
+                self.size -= self.entries.pop(key)
+                return None
+            self.entries.move_to_end(key)
+            os.utime(meta_file)
+            return meta
+
+    def put(self, key, returncode, stderr, sketch_path, build_path, sketch_name):
+        entry_path = os.path.join(self.cache_path, key)
+        tmp_path = tempfile.mkdtemp(prefix=key, suffix='.tmp', dir=self.cache_path)
+
+        artifacts = []
+        if returncode == 0:
+            for extension in ARTIFACT_EXTENSIONS:
+                artifact = os.path.join(build_path, sketch_name + extension)
+                if os.path.isfile(artifact):
+                    shutil.copyfile(artifact, os.path.join(tmp_path, 'sketch' + extension))
+                    artifacts.append(extension)
+
+        meta = {
+            'returncode': returncode,
+            'stderr': stderr.replace(sketch_path, SKETCH_PATH_TOKEN),
+            'artifacts': artifacts,
+        }
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)
+            shutil.rmtree(entry_path, ignore_errors=True)
+            try:
+                os.rename(tmp_path, entry_path)
+            except OSError:
+                # Another process stored the same entry in the meantime
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                if not os.path.isdir(entry_path):
+                    return
+            entry_size = self._entry_size(key)
+            self.entries[key] = entry_size
+            self.size += entry_size
+            self._evict()
+
+    # Copy the cached artifacts into a build folder as if they had just been compiled
+    def restore(self, key, meta, sketch_path, build_path, sketch_name):
+        entry_path = os.path.join(self.cache_path, key)
+        os.makedirs(build_path, exist_ok=True)
+        for extension in meta['artifacts']:
+            shutil.copyfile(os.path.join(entry_path, 'sketch' + extension),
+                            os.path.join(build_path, sketch_name + extension))
+        return meta['stderr'].replace(SKETCH_PATH_TOKEN, sketch_path)
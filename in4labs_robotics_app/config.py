@@ -12,6 +12,75 @@ class Config(object):
         }
     }
 
+    # Maximum size in bytes of the compilation artifacts cache
+    compile_cache_size = 64 * 1024 * 1024
+
+    # RAM backed filesystem for the compilations of the session and their size
+    # budget in bytes. The instance folder is used if it is not available
+    workspace_root = os.environ.get('WORKSPACE_ROOT', '/dev/shm')
+    workspace_size = 192 * 1024 * 1024
+
+    # USB hub where the boards are connected and sysfs mount point used to find them
+    usb_hub = '1-1'
+    sysfs_root = os.environ.get('SYSFS_ROOT', '/sys')
+
+    # Folder of the locks shared by all the labs of the Raspberry Pi, it must be
+    # mounted in every lab container. CPU slots for compilations of all the labs
+    # and seconds waiting for a slot or the USB hub
+    scheduler_path = os.environ.get('SCHEDULER_PATH', '/tmp/in4labs_scheduler')
+    cpu_slots = int(os.environ.get('CPU_SLOTS', max((os.cpu_count() or 1) - 1, 1)))
+    scheduler_timeout = 120
+
+    # Seconds before the end of the session reserved to clean the lab
+    clean_margin = 10
+    # Timeout in seconds and retries of each stop upload when cleaning the lab
+    stop_timeout = 8
+    stop_retries = 1
+    # Seconds waiting at startup for a board that is not enumerated yet
+    startup_discovery_timeout = 30
+
+    # Hard limits in seconds of a compilation and an upload, the processes are
+    # killed when they are reached
+    compile_timeout = 180
+    upload_timeout = 60
+
+    # Uploader of the AVR boards: 'stk500' flashes them from the app, falling
+    # back to arduino-cli if it fails, and 'cli' always uses arduino-cli.
+    # Reading back the flash after the upload is optional, as in arduino-cli
+    avr_uploader = os.environ.get('AVR_UPLOADER', 'stk500')
+    avr_verify = False
+
+    # Worker threads running the compile and upload jobs
+    job_workers = max(os.cpu_count() or 1, 2)
+
+    # Backend used to run arduino-cli: 'cli' spawns a process per action and
+    # 'daemon' talks to a long-lived 'arduino-cli daemon' through gRPC
+    arduino_cli_backend = os.environ.get('ARDUINO_CLI_BACKEND', 'cli')
+    # Address of an already running daemon. If not set, the leader process of
+    # the app spawns one on arduino_cli_daemon_port, shared by all the processes
+    arduino_cli_daemon_address = os.environ.get('ARDUINO_CLI_DAEMON_ADDRESS')
+    arduino_cli_daemon_port = 50051
+    arduino_cli_daemon_timeout = 10 # seconds
+
+    # Motion script mode: serial speed of the interpreter firmware and maximum
+    # waypoints of a script (the sequence numbers of its packets must not wrap)
+    motion_baudrate = 115200
+    motion_max_waypoints = 200
+
+    # Code suggestion API, it can be replaced by a local stand-in server
+    suggest_url = os.environ.get('SUGGEST_URL', 'https://open.ieec.uned.es/v_innovacion/api.php')
+    suggest_timeout = (3, 30) # connect and read seconds of the request to the API
+    suggest_wait = 35 # seconds a /suggest request waits for the suggestion
+    suggest_cache_ttl = 3600 # seconds
+    suggest_cache_size = 256 # suggestions
+
+    # File where the requests and jobs of the session are recorded, see trace.py.
+    # Not set by default, the session is not recorded
+    trace_path = os.environ.get('TRACE_PATH')
+
+    # Log every timing as a JSON line (structured logs)
+    log_metrics = os.environ.get('LOG_METRICS', '0') == '1'
+
     # Docker environment variables
     server_name = os.environ.get('SERVER_NAME')
     lab_name = os.environ.get('LAB_NAME')
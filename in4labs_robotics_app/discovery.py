@@ -0,0 +1,72 @@
+import glob
+import os
+import re
+import socket
+import threading
+
+
+NETLINK_KOBJECT_UEVENT = 15
+
+
+# Class to find the serial number and tty of the boards connected to the ports
+# of the USB hub by reading sysfs. The result is cached per port and refreshed
+# when the kernel reports a hotplug event on that port (e.g. after a reset
+# of the hub with uhubctl), so the tty paths stay correct.
+class BoardDiscovery(object):
+    def __init__(self, sysfs_root, usb_hub):
+        self.devices_path = os.path.join(sysfs_root, 'bus', 'usb', 'devices')
+        self.usb_hub = usb_hub # e.g. '1-1', the ports are '1-1.1', '1-1.2'...
+        self.cache = {}
+        self.lock = threading.Lock()
+        self.watcher = None
+
+    def _read(self, usb_port):
+        device_path = os.path.join(self.devices_path, f'{self.usb_hub}.{usb_port}')
+        try:
+            with open(os.path.join(device_path, 'serial')) as f:
+                serial_number = f.read().strip()
+        except OSError:
+            return None # Nothing connected to the port
+
+        # CDC ACM boards expose <interface>/tty/ttyACMx and FTDI based ones <interface>/ttyUSBx
+        ttys = glob.glob(os.path.join(device_path, f'{self.usb_hub}.{usb_port}:*', 'tty', 'tty*')) + \
+                glob.glob(os.path.join(device_path, f'{self.usb_hub}.{usb_port}:*', 'tty*'))
+        ttys = [os.path.basename(tty) for tty in ttys if os.path.basename(tty) != 'tty']
+        usb_driver = sorted(ttys)[0] if ttys else None
+
+        return {'serial_number': serial_number, 'usb_driver': usb_driver}
+
+    def refresh(self, usb_port):
+        device = self._read(usb_port)
+        with self.lock:
+            self.cache[usb_port] = device
+        return device
+
+    def get(self, usb_port):
+        with self.lock:
+            if usb_port in self.cache:
+                return self.cache[usb_port]
+        return self.refresh(usb_port)
+
+    # Listen to the kernel hotplug events and refresh the ports they refer to.
+    # The callback is called with the port after every refresh.
+    def watch(self, usb_ports, callback):
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            sock.bind((0, 1)) # Let the kernel choose the port id
+        except (AttributeError, OSError) as e:
+            print(f'USB hotplug events not available ({e}), boards are only refreshed on reset')
+            return
+
+        def run():
+            while True:
+                event = sock.recv(8192).split(b'\0')
+                devpath = next((field[8:].decode('utf-8', 'replace') for field in event
+                                    if field.startswith(b'DEVPATH=')), '')
+                for usb_port in usb_ports:
+                    if re.search(rf'/{re.escape(self.usb_hub)}\.{usb_port}(/|:|$)', devpath):
+                        self.refresh(usb_port)
+                        callback(usb_port)
+
+        self.watcher = threading.Thread(target=run, daemon=True)
+        self.watcher.start()
@@ -0,0 +1,151 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from .process_runner import ProcessCancelled, process_context, tool_log
+from .shared_state import FileLock, JobStore
+
+
+class Job(object):
+    def __init__(self, id, board, action):
+        self.id = id
+        self.board = board
+        self.action = action
+        self.status = 'queued' # queued -> running -> done | failed | cancelled
+        self.result = None
+        self.created = time.time()
+        self.finished = threading.Event()
+
+    def to_dict(self):
+        return {'job_id': self.id, 'board': self.board, 'action': self.action,
+                'status': self.status, 'result': self.result}
+
+# Class to run the compile and upload actions in a pool of worker threads.
+# Actions on the same board are serialized with a per board lock, while
+# actions on different boards run in parallel. Each board has its own queue
+# and only its first job is handed to the pool, so a board with many pending
+# jobs does not take all the workers.
+# The board locks are file locks and the status of the jobs is kept in a
+# JobStore inside run_path, so several server processes can share them. The
+# output of the processes run by a job is written to its output file and a
+# job is cancelled by creating its cancel file, also from another process.
+# With a TraceRecorder every finished job is added to the session trace.
+class JobQueue(object):
+    def __init__(self, max_workers, run_path, max_jobs=100, max_age=3600, trace=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.run_path = run_path
+        self.store = JobStore(os.path.join(run_path, 'jobs.sqlite'))
+        self.max_jobs = max_jobs # Finished jobs kept in memory
+        self.max_age = max_age # Seconds finished jobs are kept in the store
+        self.jobs = OrderedDict()
+        self.board_queues = {} # board -> pending jobs, the first one is running
+        self.lock = threading.Lock()
+        self.trace = trace
+
+    def board_lock(self, board):
+        return FileLock(os.path.join(self.run_path, f'board-{board}.lock'))
+
+    def output_path(self, job_id):
+        return os.path.join(self.run_path, f'job-{job_id}.log')
+
+    def _cancel_path(self, job_id):
+        return os.path.join(self.run_path, f'job-{job_id}.cancel')
+
+    # Stop a queued or running job, its processes are killed
+    def cancel(self, job_id):
+        open(self._cancel_path(job_id), 'w').close()
+
+    # Stop the queued and running jobs of a board, also those of other processes.
+    # The stop jobs are kept, so overlapping stops of the lab (e.g. a reset near
+    # the end of the session) do not cancel each other.
+    def cancel_board(self, board):
+        for job_id in self.store.active(board, exclude_action='stop'):
+            self.cancel(job_id)
+
+    def cancelled(self, job_id):
+        return os.path.exists(self._cancel_path(job_id))
+
+    def _create(self, board, action):
+        job = Job(uuid.uuid4().hex, board, action)
+        open(self.output_path(job.id), 'w').close()
+        self.store.save(job)
+        with self.lock:
+            self.jobs[job.id] = job
+            self._prune()
+        return job
+
+    # Queue function(*args) and return the job right away. The function must
+    # return a dict, which becomes the result of the job.
+    def submit(self, board, action, function, *args):
+        job = self._create(board, action)
+        with self.lock:
+            queue = self.board_queues.setdefault(board, deque())
+            queue.append((job, function, args))
+            if len(queue) == 1:
+                self.executor.submit(self._run, job, function, args)
+        return job
+
+    # Run the job in the calling thread holding the lock of its board. The
+    # synchronous jobs are recorded in the trace by their request, with the
+    # tools they run, so only the queued ones are recorded here.
+    def _execute(self, job, function, args, traced):
+        with self.board_lock(job.board), (tool_log() if traced else nullcontext()) as tools:
+            job.status = 'running'
+            self.store.save(job)
+            start = time.time()
+            try:
+                if self.cancelled(job.id):
+                    raise ProcessCancelled('Cancelled before starting')
+                with process_context(self.output_path(job.id), lambda: self.cancelled(job.id)):
+                    job.result = function(*args)
+                job.status = 'done'
+            except ProcessCancelled as e:
+                job.result = {'board': job.board, 'error': str(e)}
+                job.status = 'cancelled'
+            except Exception as e:
+                job.result = {'board': job.board, 'error': str(e)}
+                job.status = 'failed'
+            finally:
+                self.store.save(job)
+                job.finished.set()
+                if traced and self.trace is not None:
+                    self.trace.record_job(job, start - job.created, time.time() - start, tools)
+
+    def _run(self, job, function, args):
+        self._execute(job, function, args, traced=True)
+        # Hand the next job of the board to the pool
+        with self.lock:
+            queue = self.board_queues[job.board]
+            queue.popleft()
+            if queue:
+                self.executor.submit(self._run, *queue[0])
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in ('done', 'failed', 'cancelled')]
+        for job_id in finished[:max(len(self.jobs) - self.max_jobs, 0)]:
+            del self.jobs[job_id]
+            for path in [self.output_path(job_id), self._cancel_path(job_id)]:
+                if os.path.exists(path):
+                    os.remove(path)
+        if len(finished) > self.max_jobs:
+            self.store.prune(self.max_age)
+
+    # Return the job as a dict, also if it was queued by another process
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        return self.store.load(job_id)
+
+    # Run function(*args) in the calling thread holding the lock of the board and
+    # return its result. The job is kept like the queued ones, so it can also be
+    # cancelled (e.g. by the stop of the lab at the end of the session).
+    def run(self, board, action, function, *args):
+        job = self._create(board, action)
+        self._execute(job, function, args, traced=False)
+        return job.result
@@ -1,20 +1,86 @@
+import concurrent.futures
+import functools
+import json
 import os
 import subprocess
 import time
 from datetime import datetime, timezone, timedelta
 
-import pexpect
 import requests
-from flask import current_app, render_template, jsonify, send_file, request, url_for, redirect, flash
+import serial
+from flask import current_app, render_template, jsonify, request, url_for, redirect, flash, \
+                    Response, stream_with_context, g, make_response
 from flask_login import current_user, login_user, login_required
 
-from .utils import create_editor, create_navtab
-from in4labs_robotics_app import boards, user, user_end_time
+from .utils import ExampleCatalog
+from in4labs_robotics_app import app, boards, user, user_end_time, compile_cache, serial_sessions, jobs, \
+                                discovery, suggestions, workspace, startup, trace
 from in4labs_robotics_app.lab_bp import bp
 from in4labs_robotics_app.config import Config
-from in4labs_robotics_app.utils import upload_sketch
+from in4labs_robotics_app.metrics import metrics
+from in4labs_robotics_app.process_runner import start_tool_log, stop_tool_log
+from in4labs_robotics_app.motion import MotionError, SerialTransport, pack_script, stream_script, \
+                                        validate_waypoints
+from in4labs_robotics_app.scheduler import get_scheduler
+from in4labs_robotics_app.startup import USABLE
+from in4labs_robotics_app.utils import upload_sketch, compile_sketch, compile_motion_interpreter, stop_boards, \
+                                        update_boards_config
 
 
+# Examples and rendered editors, indexed once at startup
+examples = ExampleCatalog(os.path.join(app.instance_path, 'examples'), boards)
+
+# Time every request of the lab, and record it in the session trace if enabled
+@bp.before_request
+def start_timer():
+    g.start_time = time.monotonic()
+    if trace is not None:
+        g.tools = start_tool_log()
+
+@bp.after_request
+def observe_request(response):
+    if request.endpoint is not None and 'start_time' in g:
+        seconds = time.monotonic() - g.start_time
+        route = request.endpoint.split('.')[-1]
+        metrics.observe('request_seconds', seconds, route=route, status=response.status_code)
+        if trace is not None and 'tools' in g:
+            stop_tool_log()
+            response_json = response.get_json(silent=True) if response.is_json else None
+            trace.record_request(route, request.method, response.status_code, seconds,
+                                    request.values, g.tools, response_json)
+    return response
+
+# Metrics in the Prometheus text format. No login is required so they can be scraped.
+@bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Status of the startup of the boards. No login is required so it can be used
+# as the readiness probe of the container.
+@bp.route('/ready', methods=['GET'])
+def ready():
+    report = startup.report()
+    all_ready = all(board_status['status'] in USABLE for board_status in report.values())
+    return jsonify(ready=all_ready, boards=report), 200 if all_ready else 503
+
+# Actions on a board answer 503 until the board has been found and stopped at
+# startup. The board is found in this process the first time it is used.
+def board_ready(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        board = request.values.get('board')
+        if board not in boards:
+            return jsonify(board=board, error=f'Board {board} not found'), 404
+        if not startup.usable(board):
+            board_status = startup.get(board)
+            error = board_status['error'] or 'The board is starting, try again in a few seconds'
+            resp = jsonify(board=board, status=board_status['status'], error=error)
+            return resp, 503, {'Retry-After': '2'}
+        if 'serial_number' not in boards[board]:
+            update_boards_config({board: boards[board]}, discovery, check_connected=False)
+        return view(*args, **kwargs)
+    return wrapper
+
 # Default route for login
 @bp.route('/', methods=['GET', 'POST'])
 def login():
@@ -33,11 +99,7 @@ def login():
 @bp.route('/index')
 @login_required
 def index():
-    navtabs = []
-    editors = []
-    for board_conf in boards.items():
-        navtabs.append(create_navtab(board_conf))
-        editors.append(create_editor(board_conf))
+    navtabs, editors = examples.get_page()
     return render_template('index.html', boards=boards, navtabs=navtabs,
                                 editors=editors, cam_url=Config.cam_url, 
                                 end_time=user_end_time.strftime('%Y-%m-%dT%H:%M:%S.%fZ'))
@@ -48,17 +110,48 @@ def get_example():
     board = request.args.get('board')
     example = request.args.get('example')      
     
-    examples_path = os.path.join(current_app.instance_path, 'examples')
-    board_path = os.path.join(examples_path, board)
-    commons_path = os.path.join(examples_path, 'Commons')
-    
-    example_file = None
-    for path in [board_path, commons_path]:
-        if os.path.isdir(path) and example in os.listdir(path):
-            example_file = os.path.join(path, example)
-            break
+    example_file = examples.get_example(board, example)
+    if example_file is None:
+        return jsonify(board=board, error=f'Example {example} not found'), 404
+
+    content, etag = example_file
+    resp = make_response(content)
+    resp.mimetype = 'text/plain'
+    resp.set_etag(etag)
+    # Answer 304 Not Modified if the browser already has this version
+    return resp.make_conditional(request)
+
+# Actions run by the job queue. They receive the instance path because
+# current_app is not available inside the worker threads.
+def compile_job(board, code, instance_path):
+    workspace.make_room()
+    result = compile_sketch((board, boards[board]), code, compile_cache, instance_path)
+    return {'board': board, 'error': result.stderr}
+
+def execute_job(board, target, instance_path):
+    # The serial port must be free to upload
+    with serial_sessions.paused(board):
+        result = upload_sketch((board, boards[board]), target, instance_path)
+    return {'board': board, 'error': result.stderr}
 
-    return send_file(example_file, mimetype='text')
+def motion_load_job(board, instance_path):
+    workspace.make_room()
+    result = compile_motion_interpreter((board, boards[board]), compile_cache, instance_path)
+    if result.returncode != 0:
+        return {'board': board, 'error': result.stderr}
+    with serial_sessions.paused(board):
+        result = upload_sketch((board, boards[board]), 'motion', instance_path)
+    return {'board': board, 'error': result.stderr}
+
+def motion_run_job(board, waypoints):
+    usb_driver = boards[board]['usb_driver']
+    serial_session = serial_sessions.get_session(board, f'/dev/{usb_driver}', Config.motion_baudrate)
+    try:
+        with metrics.timer('stage_seconds', stage='motion', board=board):
+            summary = stream_script(SerialTransport(serial_session), pack_script(waypoints))
+    except (MotionError, serial.SerialException) as e:
+        return {'board': board, 'error': str(e)}
+    return {'board': board, 'error': '', **summary}
 
 @bp.route('/compile', methods=['POST'])
 @login_required
@@ -66,40 +159,102 @@ def compile():
     board = request.form['board']
     code = request.form['text']
 
-    fqbn = boards[board]['fqbn']
-        
-    compilation_path = os.path.join(current_app.instance_path, 'compilations', board)
-    sketch_path = os.path.join(compilation_path, 'temp_sketch')
-
-    with open(os.path.join(sketch_path, 'temp_sketch.ino'), 'w') as f:
-        f.write(code)
+    # Asynchronous requests get a job to poll in /job_status
+    if request.form.get('async', default=0, type=int):
+        job = jobs.submit(board, 'compile', compile_job, board, code, current_app.instance_path)
+        return jsonify(job.to_dict()), 202
 
-    command = ['arduino-cli', 'compile', '--fqbn', fqbn,
-        '--build-cache-path', os.path.join(compilation_path, 'cache'), 
-        '--build-path', os.path.join(compilation_path, 'build'), 
-        sketch_path]
+    result = jobs.run(board, 'compile', compile_job, board, code, current_app.instance_path)
 
-    result = subprocess.run(command, capture_output=True, text=True) 
-
-    resp = jsonify(board=board, error=result.stderr)
+    resp = jsonify(result)
     return resp
 
 @bp.route('/execute', methods=['POST'])
 @login_required
+@board_ready
 def execute():
     board = request.form['board']
     target = request.form['target']
+
+    if request.form.get('async', default=0, type=int):
+        job = jobs.submit(board, 'execute', execute_job, board, target, current_app.instance_path)
+        return jsonify(job.to_dict()), 202
+
+    result = jobs.run(board, 'execute', execute_job, board, target, current_app.instance_path)
     
-    for board_conf in boards.items():
-        if board_conf[0] == board:
-            result = upload_sketch(board_conf, target)
-            break 
-    
-    resp = jsonify(board=board, error=result.stderr)
+    resp = jsonify(result)
+    return resp
+
+@bp.route('/job_status', methods=['GET'])
+@login_required
+def job_status():
+    job_id = request.args.get('job_id')
+
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify(job_id=job_id, status='unknown'), 404
+
+    resp = jsonify(job)
+    return resp
+
+# Server-Sent Events stream with the output of the processes of a job while it
+# runs. It ends with an 'end' event holding the job. With cancel_on_disconnect
+# the job is cancelled if the client goes away before it finishes.
+@bp.route('/job_stream', methods=['GET'])
+@login_required
+def job_stream():
+    job_id = request.args.get('job_id', '')
+    cancel_on_disconnect = request.args.get('cancel_on_disconnect', default=0, type=int)
+
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify(job_id=job_id, status='unknown'), 404
+
+    def events():
+        finished = False
+        try:
+            with open(jobs.output_path(job_id)) as output:
+                partial = ''
+                idle = 0
+                while True:
+                    job = jobs.get(job_id)
+                    lines = (partial + output.read()).split('\n')
+                    partial = lines.pop()
+                    for line in lines:
+                        yield f'data: {line}\n\n'
+                    if job['status'] in ('done', 'failed', 'cancelled'):
+                        if partial:
+                            yield f'data: {partial}\n\n'
+                        finished = True
+                        yield f'event: end\ndata: {json.dumps(job)}\n\n'
+                        break
+                    idle = 0 if lines else idle + 1
+                    if idle >= 10:
+                        idle = 0
+                        yield ': keep-alive\n\n' # Detects closed connections
+                    time.sleep(0.2)
+        finally:
+            if cancel_on_disconnect and not finished:
+                jobs.cancel(job_id)
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@bp.route('/job_cancel', methods=['POST'])
+@login_required
+def job_cancel():
+    job_id = request.form['job_id']
+
+    if jobs.get(job_id) is None:
+        return jsonify(job_id=job_id, status='unknown'), 404
+    jobs.cancel(job_id)
+
+    resp = jsonify(job_id=job_id)
     return resp
 
 @bp.route('/monitor', methods=['GET'])
 @login_required
+@board_ready
 def monitor():
     board = request.args.get('board')
     baudrate = request.args.get('baudrate', default=9600, type=int)
@@ -107,34 +262,119 @@ def monitor():
 
     usb_driver = boards[board]['usb_driver']
 
-    command = f'arduino-cli monitor -p /dev/{usb_driver} --quiet --config baudrate={baudrate}'
-    # NOTE: pexpect is used because arduino-cli monitor expects to run in an interactive 
-    #       terminal environment and subprocess.run() does not work properly.
-    child = pexpect.spawn(command)
-    
-    try:
-        child.expect(pexpect.EOF, timeout=seconds)
-    except pexpect.TIMEOUT:
-        pass
-
-    output = child.before.decode('utf-8')
-    
-    child.close()
+    with metrics.timer('stage_seconds', stage='monitor', board=board):
+        monitor_session = serial_sessions.start_monitor(board, f'/dev/{usb_driver}', baudrate, seconds)
+        lines = []
+        try:
+            while not monitor_session.stopped.is_set():
+                lines += monitor_session.read_lines(timeout=seconds)
+            lines += monitor_session.read_lines(timeout=0)
+        finally:
+            serial_sessions.end_monitor(board, monitor_session)
+    output = '\n'.join(lines)
         
     resp = jsonify(board=board, output=output)
     return resp
 
+# Server-Sent Events stream with the serial output of a board. The monitor
+# session is started by the stream itself, so the whole session is served by
+# the same worker process. It ends when the monitor is stopped (from any
+# worker), when its time is up or when the client goes away.
+@bp.route('/monitor/stream', methods=['GET'])
+@login_required
+@board_ready
+def monitor_stream():
+    board = request.args.get('board')
+    baudrate = request.args.get('baudrate', default=9600, type=int)
+    seconds = request.args.get('seconds', default=10, type=int)
+
+    usb_driver = boards[board]['usb_driver']
+
+    monitor = serial_sessions.start_monitor(board, f'/dev/{usb_driver}', baudrate, seconds)
+
+    def events():
+        try:
+            while True:
+                lines = monitor.read_lines(timeout=1)
+                for line in lines:
+                    yield f'data: {line}\n\n'
+                if not lines:
+                    if monitor.stopped.is_set():
+                        break
+                    yield ': keep-alive\n\n' # Detects closed connections
+            yield 'event: end\ndata: \n\n'
+        finally:
+            serial_sessions.end_monitor(board, monitor)
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@bp.route('/monitor/stop', methods=['POST'])
+@login_required
+def monitor_stop():
+    board = request.form['board']
+
+    serial_sessions.stop_monitor(board)
+
+    resp = jsonify(board=board)
+    return resp
+
+# Motion script mode: the interpreter firmware is loaded once and then the
+# scripts are streamed to it through the serial port, without compiling
+@bp.route('/motion/load', methods=['POST'])
+@login_required
+@board_ready
+def motion_load():
+    board = request.form['board']
+
+    if boards[board]['fqbn'].split(':')[1] != 'avr':
+        return jsonify(board=board, error='The motion script mode is only available for AVR boards'), 400
+
+    if request.form.get('async', default=0, type=int):
+        job = jobs.submit(board, 'motion_load', motion_load_job, board, current_app.instance_path)
+        return jsonify(job.to_dict()), 202
+
+    result = jobs.run(board, 'motion_load', motion_load_job, board, current_app.instance_path)
+
+    resp = jsonify(result)
+    return resp
+
+@bp.route('/motion/run', methods=['POST'])
+@login_required
+@board_ready
+def motion_run():
+    board = request.form['board']
+
+    try:
+        script = json.loads(request.form['script'])
+    except ValueError as e:
+        return jsonify(board=board, error=f'The script is not valid JSON: {e}'), 400
+    waypoints, errors = validate_waypoints(script, Config.motion_max_waypoints)
+    if errors:
+        return jsonify(board=board, error='\n'.join(errors)), 400
+
+    if request.form.get('async', default=0, type=int):
+        job = jobs.submit(board, 'motion_run', motion_run_job, board, waypoints)
+        return jsonify(job.to_dict()), 202
+
+    result = jobs.run(board, 'motion_run', motion_run_job, board, waypoints)
+
+    resp = jsonify(result)
+    return resp
+
 @bp.route('/suggest', methods=['POST'])
 @login_required
 def suggest():
     board = request.form['board']
     code = request.form['text']
 
-    data = {'action': '16', 'text': code}
-    url = 'https://open.ieec.uned.es/v_innovacion/api.php'
-
-    r = requests.post(url, data=data)
-    suggestion = r.text
+    try:
+        suggestion = suggestions.suggest(code, Config.suggest_wait)
+    except concurrent.futures.TimeoutError:
+        # The suggestion is cached when it arrives, so the user can ask again
+        return jsonify(board=board, error='The suggestion service is taking too long'), 504
+    except requests.RequestException as e:
+        return jsonify(board=board, error=f'The suggestion service failed: {e}'), 502
 
     resp = jsonify(board=board, suggestion=suggestion)
     return resp
@@ -143,14 +383,26 @@ def suggest():
 @login_required
 def reset():
     # Uhubctl is used to power on/off the USB ports of the Raspberry Pi
-    command = ['uhubctl', '-a', 'cycle', '-l', '1-1', '-d', '2']
-    result = subprocess.run(command, capture_output=True, text=True)
+    # The hub is shared with the other labs, wait for their uploads to finish
+    command = ['uhubctl', '-a', 'cycle', '-l', Config.usb_hub, '-d', '2']
+    with get_scheduler().hub_exclusive():
+        with metrics.timer('stage_seconds', stage='hub_cycle'):
+            result = subprocess.run(command, capture_output=True, text=True)
+        # Let the boards be enumerated again before anyone uses them
+        time.sleep(1)
     
-    # Load the stop code in all the boards
-    time.sleep(1)
-    for board_conf in boards.items():
-        upload_sketch(board_conf, 'stop')
+    # The boards may get a different tty after being powered on again
+    for config in boards.values():
+        discovery.refresh(config['usb_port'])
+    update_boards_config(boards, discovery, check_connected=False)
+
+    # Load the stop code in all the boards in parallel
+    with metrics.timer('stage_seconds', stage='stop_all'):
+        report = stop_boards(boards, current_app.instance_path, serial_sessions, jobs,
+                                Config.stop_timeout, Config.stop_retries, Config.clean_margin)
+    for board, board_report in report.items():
+        startup.record(board, board_report)
     
-    # Return the output of the command for debugging purposes
-    resp = jsonify(result=result.stdout)
+    # Return the output of the command and the stop report for debugging purposes
+    resp = jsonify(result=result.stdout, boards=report)
     return resp
\ No newline at end of file
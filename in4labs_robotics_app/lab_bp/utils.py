@@ -1,19 +1,12 @@
+import hashlib
 import os
+import threading
+import time
 
-from flask import current_app
-
-
-def fill_examples(board):
-    board_path = os.path.join(current_app.instance_path, 'examples', board)
-    commons_path = os.path.join(current_app.instance_path, 'examples', 'Commons')
-
-    examples = []
-    for path in [board_path, commons_path]:
-        if os.path.isdir(path):
-            examples += [file for file in os.listdir(path) if file.endswith('.ino')]
 
+def fill_examples(examples):
     # Sort them alphabetically
-    examples.sort()
+    examples = sorted(examples)
 
     # Convert example names to show spaces instead of underscores and remove .ino extension 
     example_names = [example.replace('_', ' ').replace('.ino', '') for example in examples]
@@ -27,6 +20,84 @@ def fill_examples(board):
     
     return examples_html
 
+# Class to keep the examples of every board in memory together with the
+# rendered navtabs and editors of the index page. The examples folders are
+# checked for changes (mtime) at most every check_interval seconds, and the
+# catalog is built again only if something changed.
+class ExampleCatalog(object):
+    def __init__(self, examples_path, boards, check_interval=2):
+        self.examples_path = examples_path
+        self.boards = boards
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.last_check = 0
+        self.signature = None
+        self._build()
+
+    def _example_paths(self, board):
+        return [os.path.join(self.examples_path, board), os.path.join(self.examples_path, 'Commons')]
+
+    # mtimes of the examples folders and files. A new, removed or renamed file
+    # changes the folder mtime and an edited file its own mtime.
+    def _signature(self):
+        signature = []
+        paths = {path for board in self.boards for path in self._example_paths(board)}
+        for path in sorted(paths):
+            try:
+                signature.append((path, os.stat(path).st_mtime_ns))
+            except OSError:
+                signature.append((path, None))
+        for examples in self.examples.values():
+            for file_path, _, _ in examples.values():
+                try:
+                    signature.append((file_path, os.stat(file_path).st_mtime_ns))
+                except OSError:
+                    signature.append((file_path, None))
+        return signature
+
+    def _build(self):
+        examples = {} # board -> example -> (file path, content, etag)
+        for board in self.boards:
+            examples[board] = {}
+            for path in reversed(self._example_paths(board)): # Board examples override Commons
+                if os.path.isdir(path):
+                    for example in os.listdir(path):
+                        if example.endswith('.ino'):
+                            file_path = os.path.join(path, example)
+                            with open(file_path, 'rb') as f:
+                                content = f.read()
+                            etag = hashlib.sha1(content).hexdigest()
+                            examples[board][example] = (file_path, content, etag)
+        self.examples = examples
+
+        self.navtabs = []
+        self.editors = []
+        for board_conf in self.boards.items():
+            self.navtabs.append(create_navtab(board_conf))
+            self.editors.append(create_editor(board_conf, examples[board_conf[0]].keys()))
+
+        self.signature = self._signature()
+
+    def _check(self):
+        with self.lock:
+            if time.monotonic() - self.last_check < self.check_interval:
+                return
+            self.last_check = time.monotonic()
+            if self._signature() != self.signature:
+                self._build()
+
+    def get_page(self):
+        self._check()
+        return self.navtabs, self.editors
+
+    # Return the (content, etag) of an example or None if it does not exist
+    def get_example(self, board, example):
+        self._check()
+        entry = self.examples.get(board, {}).get(example)
+        if entry is None:
+            return None
+        return entry[1], entry[2]
+
 def create_navtab(board_conf):
     board = board_conf[0]
     config = board_conf[1]
@@ -39,10 +110,10 @@ def create_navtab(board_conf):
 
     return navtab_html
 
-def create_editor(board_conf):
+def create_editor(board_conf, examples):
     board = board_conf[0]
 
-    examples = fill_examples(board)
+    examples = fill_examples(examples)
 
     editor_html = f'''
                 <div class="tab-pane fade active show" id="nav-{board}" role="tabpanel" aria-labelledby="nav-{board}-tab">
@@ -0,0 +1,168 @@
+import atexit
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Upper bounds in seconds of the histogram buckets, from a cached request to a slow upload
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+# Class to collect timings and counters of the lab actions in memory. Every
+# series is identified by its name and labels (board, fqbn, stage...) and
+# everything is exposed in the Prometheus text format. Once shared, every
+# process of the server saves its series in a file of a common folder every
+# save_interval seconds if they changed, when it answers a scrape and when it
+# exits, and render() adds up the files of all of them, so any worker answers
+# the scrape with the totals of the server (those of the other workers up to
+# save_interval seconds old).
+class Metrics(object):
+    def __init__(self, prefix='in4labs'):
+        self.prefix = prefix
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.path = None
+        self.file = None
+        self.changed = False
+
+    def share(self, path, save_interval=5):
+        os.makedirs(path, exist_ok=True)
+        with self.lock:
+            self.path = path
+            # The pid may be reused by a later worker, the start time makes the file unique
+            self.file = os.path.join(path, f'{os.getpid()}-{time.time_ns()}.json')
+            self.changed = True
+        self.save()
+        threading.Thread(target=self._save_periodically, args=(save_interval,), daemon=True).start()
+        atexit.register(self.save)
+
+    def _save_periodically(self, save_interval):
+        while True:
+            time.sleep(save_interval)
+            self.save()
+
+    def save(self):
+        with self.lock:
+            if self.file is None or not self.changed:
+                return
+            self._save()
+            self.changed = False
+
+    def _save(self):
+        series = {
+            'histograms': [[name, labels, h.counts, h.sum, h.count]
+                            for (name, labels), h in self.histograms.items()],
+            'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+        }
+        tmp_file = self.file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(series, f)
+        os.replace(tmp_file, self.file)
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+            self.changed = True
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps({'metric': name, 'seconds': round(value, 4), **labels}))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            self.changed = True
+
+    # Context manager to observe the time spent inside it
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def _labels(self, labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+    # Series of this process, added to those saved by the other processes.
+    # The files of the workers that have exited are kept, so the counters
+    # never go backwards.
+    def _collect(self):
+        with self.lock:
+            histograms = {key: (list(h.counts), h.sum, h.count) for key, h in self.histograms.items()}
+            counters = dict(self.counters)
+            path, own_file = self.path, self.file
+        if path is None:
+            return histograms, counters
+
+        for file in os.listdir(path):
+            file = os.path.join(path, file)
+            if file == own_file or not file.endswith('.json'):
+                continue
+            try:
+                with open(file) as f:
+                    series = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, labels, counts, total, count in series['histograms']:
+                key = (name, tuple(tuple(label) for label in labels))
+                old_counts, old_total, old_count = histograms.get(key, ([0] * len(BUCKETS), 0, 0))
+                histograms[key] = ([a + b for a, b in zip(old_counts, counts)], old_total + total, old_count + count)
+            for name, labels, value in series['counters']:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+        return histograms, counters
+
+    def render(self):
+        self.save()
+        histograms, counters = self._collect()
+
+        lines = []
+        for name in sorted({key[0] for key in histograms}):
+            metric = f'{self.prefix}_{name}'
+            lines.append(f'# TYPE {metric} histogram')
+            for (series_name, labels), (counts, total, count) in sorted(histograms.items()):
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(BUCKETS, counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{metric}_bucket{self._labels(labels, [("le", le)])} {cumulative}')
+                lines.append(f'{metric}_sum{self._labels(labels)} {total}')
+                lines.append(f'{metric}_count{self._labels(labels)} {count}')
+        for name in sorted({key[0] for key in counters}):
+            metric = f'{self.prefix}_{name}_total'
+            lines.append(f'# TYPE {metric} counter')
+            for (series_name, labels), value in sorted(counters.items()):
+                if series_name == name:
+                    lines.append(f'{metric}{self._labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+# Shared by the whole app, like the toolchain backend
+metrics = Metrics()
@@ -0,0 +1,194 @@
+import struct
+import time
+
+from .process_runner import POLL_INTERVAL, ProcessCancelled, is_cancelled
+
+
+# Host side of the motion script mode. A script is a list of Braccio waypoints
+# that is validated, packed and streamed to the interpreter firmware of
+# arduino/firmware/motion_interpreter.ino, which has to be running on the board.
+# See the firmware for the packet format.
+
+SYNC = 0xA5
+ACK = 0x06
+NAK = 0x15
+DONE = 0x04
+
+BEGIN = ord('B')
+WAYPOINT = ord('W')
+END = ord('E')
+
+# Same order as the arguments of Braccio.ServoMovement()
+JOINTS = ('step_delay', 'base', 'shoulder', 'elbow', 'wrist_ver', 'wrist_rot', 'gripper')
+# Limits of the Braccio library, the step delay is in milliseconds per degree
+LIMITS = {
+    'step_delay': (10, 30),
+    'base': (0, 180),
+    'shoulder': (15, 165),
+    'elbow': (0, 180),
+    'wrist_ver': (0, 180),
+    'wrist_rot': (0, 180),
+    'gripper': (10, 73),
+}
+
+# Packets sent without an answer. 4 packets of 12 bytes fit in the 64 byte
+# receive buffer of an UNO while it is moving and not reading.
+WINDOW = 4
+# Longest movement: 180 degrees at the highest step delay
+MAX_MOVEMENT_SECONDS = 180 * LIMITS['step_delay'][1] / 1000
+
+
+class MotionError(Exception):
+    pass
+
+# Check a script given as a list of waypoints, each a list of 7 values in the
+# order of JOINTS or a dict with those keys. Return the waypoints as tuples and
+# the list of errors found, empty if the script is valid.
+def validate_waypoints(waypoints, max_waypoints):
+    if not isinstance(waypoints, list) or not waypoints:
+        return [], ['The script must be a non empty list of waypoints']
+    if len(waypoints) > max_waypoints:
+        return [], [f'The script has {len(waypoints)} waypoints, the maximum is {max_waypoints}']
+
+    valid = []
+    errors = []
+    for number, waypoint in enumerate(waypoints, start=1):
+        if isinstance(waypoint, dict):
+            missing = [joint for joint in JOINTS if joint not in waypoint]
+            if missing:
+                errors.append(f'Waypoint {number}: missing {", ".join(missing)}')
+                continue
+            values = [waypoint[joint] for joint in JOINTS]
+        elif isinstance(waypoint, list) and len(waypoint) == len(JOINTS):
+            values = waypoint
+        else:
+            errors.append(f'Waypoint {number}: expected {len(JOINTS)} values ({", ".join(JOINTS)})')
+            continue
+
+        for joint, value in zip(JOINTS, values):
+            low, high = LIMITS[joint]
+            if isinstance(value, bool) or not isinstance(value, int) or not low <= value <= high:
+                errors.append(f'Waypoint {number}: {joint} must be an integer between {low} and {high}')
+        valid.append(tuple(values))
+    return (valid if not errors else []), errors
+
+def pack_packet(packet_type, seq, payload=b''):
+    header = struct.pack('<BBBB', SYNC, packet_type, seq, len(payload))
+    checksum = (packet_type + seq + len(payload) + sum(payload)) & 0xFF
+    return header + payload + bytes([checksum])
+
+# Return the packets of a script: BEGIN, a WAYPOINT per waypoint and END,
+# numbered from 0 (the sequence numbers wrap around at 256)
+def pack_script(waypoints):
+    packets = [pack_packet(BEGIN, 0)]
+    for seq, waypoint in enumerate(waypoints, start=1):
+        packets.append(pack_packet(WAYPOINT, seq % 256, struct.pack('<7B', *waypoint)))
+    packets.append(pack_packet(END, (len(waypoints) + 1) % 256))
+    return packets
+
+# Adapter of a SerialSession of serial_monitor to the transport interface
+# used by stream_script: write(data) and read(timeout) -> bytes
+class SerialTransport(object):
+    def __init__(self, serial_session):
+        self.serial_session = serial_session
+        self.position = serial_session.ring.end # Ignore the output before the script
+
+    def write(self, data):
+        self.serial_session.write(data)
+
+    def read(self, timeout):
+        data, self.position = self.serial_session.read(self.position, timeout)
+        return data
+
+def check_cancelled():
+    if is_cancelled():
+        raise ProcessCancelled('Motion script cancelled')
+
+# Parser of the answers of the interpreter, (code, seq) pairs mixed with any
+# other output of the board. The job is checked for a cancellation while it
+# waits for them, as the board may take minutes to answer.
+class Replies(object):
+    def __init__(self, transport):
+        self.transport = transport
+        self.buffer = bytearray()
+
+    def next(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            while self.buffer and self.buffer[0] not in (ACK, NAK, DONE):
+                del self.buffer[0]
+            if len(self.buffer) >= 2:
+                reply = (self.buffer[0], self.buffer[1])
+                del self.buffer[:2]
+                return reply
+            check_cancelled()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self.buffer += self.transport.read(min(remaining, POLL_INTERVAL))
+
+# Send the packets of pack_script() keeping up to window packets without an
+# answer, resend from the packet the interpreter asks for or from the oldest
+# unanswered one on timeouts, and wait until the last waypoint is reached.
+# Return a summary of the transfer or raise MotionError, or ProcessCancelled if
+# the job running it is cancelled.
+def stream_script(transport, packets, window=WINDOW, begin_timeout=10, max_retries=3):
+    start = time.monotonic()
+    replies = Replies(transport)
+    reply_timeout = MAX_MOVEMENT_SECONDS + 1
+    resent = 0
+
+    # The board may still be starting (opening the port resets an UNO)
+    deadline = time.monotonic() + begin_timeout
+    while True:
+        check_cancelled()
+        transport.write(packets[0])
+        reply = replies.next(min(1, max(deadline - time.monotonic(), 0)))
+        if reply == (ACK, 0):
+            break
+        if time.monotonic() >= deadline:
+            raise MotionError('The motion interpreter is not answering, load it in the board first')
+
+    acked = 1 # Packets answered, in order
+    sent = 1
+    retries = 0
+    while acked < len(packets):
+        check_cancelled()
+        while sent < len(packets) and sent - acked < window:
+            transport.write(packets[sent])
+            sent += 1
+        reply = replies.next(reply_timeout)
+        if reply is None:
+            retries += 1
+            if retries > max_retries:
+                raise MotionError(f'No answer from the motion interpreter after {max_retries} retries')
+            resent += sent - acked
+            sent = acked
+            continue
+
+        code, seq = reply
+        # Position of the answered packet among the unanswered ones (or the
+        # next one to send, if a NAK comes after the ACKs were lost)
+        index = next((i for i in range(acked, sent + 1) if i % 256 == seq), None)
+        if code == ACK and index == sent:
+            index = None
+        if code == ACK and index is not None:
+            acked = index + 1
+            retries = 0
+        elif code == NAK and index is not None:
+            # Every packet before the one asked for was received
+            resent += sent - index
+            acked = sent = index
+
+    # The end packet is answered when queued, DONE comes after the last movement
+    done_timeout = MAX_MOVEMENT_SECONDS * min(len(packets) - 2, 16) + 1
+    end_seq = (len(packets) - 1) % 256
+    while True:
+        reply = replies.next(done_timeout)
+        if reply is None:
+            raise MotionError('The motion interpreter did not finish the script')
+        if reply == (DONE, end_seq):
+            break
+
+    return {'waypoints': len(packets) - 2, 'resent': resent,
+            'seconds': round(time.monotonic() - start, 3)}
@@ -0,0 +1,224 @@
+import difflib
+import re
+
+
+# Fast checks of a sketch done before running the compiler. They only look for
+# errors that the compiler would also report (missing setup() or loop(),
+# unbalanced brackets and calls to methods that the Braccio library does not
+# have) and give up whenever the sketch uses something they cannot follow,
+# like conditional compilation or macros, so a valid sketch is never rejected.
+
+BRACKETS = {')': '(', ']': '[', '}': '{'}
+
+# Public methods of the Braccio library and their number of arguments
+BRACCIO_METHODS = {
+    'begin': (0, 1),
+    'ServoMovement': (7, 7),
+}
+SERVO_MOVEMENT_ARGS = 'stepDelay, base, shoulder, elbow, wrist_ver, wrist_rot, gripper'
+
+
+# The ' of 1'000'000 (C++14) does not start a character literal, but the one of L'a' does
+def is_digit_separator(code, index):
+    match = re.search(r'\w+$', code[max(index - 64, 0):index])
+    return match is not None and match.group()[0].isdigit()
+
+# Join the lines ended by a backslash, as the preprocessor does before anything
+# else (a splice may even split the '//' of a comment). Return the joined code
+# and the index in code of each of its characters, and of its end.
+def join_spliced_lines(code):
+    parts = []
+    indexes = []
+    last = 0
+    for match in re.finditer(r'\\[ \t\r]*\n', code):
+        parts.append(code[last:match.start()])
+        indexes += range(last, match.start())
+        last = match.end()
+    parts.append(code[last:])
+    indexes += range(last, len(code) + 1)
+    return ''.join(parts), indexes
+
+# Return the code with the comments and the contents of the string and
+# character literals replaced by spaces, so the positions do not change, and
+# whether it has an unterminated comment. Return None for code with raw strings.
+# The spliced lines must be joined first.
+def strip_code(code):
+    if re.search(r'(^|[^\w])(u8|u|U|L)?R"', code):
+        return None, False
+
+    result = []
+    i = 0
+    state = 'code'
+    while i < len(code):
+        char = code[i]
+        pair = code[i:i + 2]
+        if state == 'code':
+            if pair == '//':
+                state = 'line_comment'
+                result.append('  ')
+                i += 2
+                continue
+            if pair == '/*':
+                state = 'block_comment'
+                result.append('  ')
+                i += 2
+                continue
+            if char == '"' or (char == "'" and not is_digit_separator(code, i)):
+                state = char
+            result.append(char)
+        elif state == 'line_comment':
+            if char == '\n':
+                state = 'code'
+            result.append('\n' if char == '\n' else ' ')
+        elif state == 'block_comment':
+            if pair == '*/':
+                state = 'code'
+                result.append('  ')
+                i += 2
+                continue
+            result.append('\n' if char == '\n' else ' ')
+        else: # Inside a string or character literal, state is its quote
+            if char == '\\' and i + 1 < len(code):
+                result.append('  ')
+                i += 2
+                continue
+            if char == state or char == '\n': # An unterminated literal ends with the line
+                state = 'code'
+                result.append(char)
+            else:
+                result.append(' ')
+        i += 1
+    return ''.join(result), state == 'block_comment'
+
+def position(code, index):
+    line = code.count('\n', 0, index) + 1
+    column = index - (code.rfind('\n', 0, index) + 1) + 1
+    return line, column
+
+# Preprocessor directives, their continuation lines are already joined
+def directive_lines(stripped):
+    return list(re.finditer(r'^[ \t]*#[^\n]*', stripped, re.MULTILINE))
+
+def check_brackets(stripped):
+    directives = directive_lines(stripped)
+    # Brackets may be split between the branches of an #if or inside macros
+    for directive in directives:
+        if re.match(r'\s*#\s*(if|ifdef|ifndef|elif|else)\b', directive.group()) or \
+                (re.match(r'\s*#\s*define\b', directive.group()) and re.search(r'[()\[\]{}]', directive.group())):
+            return []
+    # Hide the directives without changing the positions
+    for directive in directives:
+        hidden = re.sub(r'[^\n]', ' ', directive.group())
+        stripped = stripped[:directive.start()] + hidden + stripped[directive.end():]
+
+    stack = []
+    for index, char in enumerate(stripped):
+        if char in '([{':
+            stack.append((char, index))
+        elif char in BRACKETS:
+            if not stack:
+                return [(index, f"expected declaration before '{char}' token")]
+            opening, _ = stack.pop()
+            if opening != BRACKETS[char]:
+                expected = {v: k for k, v in BRACKETS.items()}[opening]
+                return [(index, f"expected '{expected}' before '{char}' token")]
+    if stack:
+        opening, index = stack[-1]
+        expected = {v: k for k, v in BRACKETS.items()}[opening]
+        return [(len(stripped.rstrip()), f"expected '{expected}' at end of input"),
+                (index, f"note: to match this '{opening}'")]
+    return []
+
+# Headers known not to define setup() or loop() themselves
+PLAIN_HEADERS = {'Arduino.h', 'Braccio.h', 'BraccioV2.h', 'Servo.h', 'Wire.h', 'SPI.h', 'EEPROM.h'}
+
+def check_functions(code, stripped):
+    # A sketch with its own main() does not need them
+    if re.search(r'\bmain\b', stripped):
+        return []
+    includes = re.findall(r'^\s*#\s*include\s*[<"]([^>"]+)[>"]', code, re.MULTILINE)
+    if not set(includes) <= PLAIN_HEADERS:
+        return []
+    errors = []
+    for function in ['setup', 'loop']:
+        if not re.search(rf'\b{function}\b', stripped):
+            errors.append((0, f"undefined reference to '{function}', every sketch needs a 'void {function}()' function"))
+    return errors
+
+# Return the number of arguments of the call whose '(' is at index, or None if
+# it cannot be told
+def count_arguments(stripped, index):
+    depth = 0
+    arguments = 0
+    empty = True
+    for char in stripped[index:]:
+        if char in '([{':
+            depth += 1
+            if depth == 1:
+                continue
+        elif char in ')]}':
+            depth -= 1
+            if depth == 0:
+                return arguments + (0 if empty else 1)
+        elif char == ',' and depth == 1:
+            arguments += 1
+            continue
+        elif char == '<' and depth >= 1:
+            return None # Commas of template arguments cannot be told apart
+        if depth >= 1 and not char.isspace():
+            empty = False
+    return None
+
+def check_braccio(code, stripped):
+    if not re.search(r'^\s*#\s*include\s*[<"]Braccio\.h[>"]', code, re.MULTILINE) or \
+            re.search(r'^\s*#\s*include\s*[<"]BraccioV2\.h[>"]', code, re.MULTILINE):
+        return []
+    # A macro could change what the calls mean or hold several arguments
+    for directive in directive_lines(stripped):
+        if re.match(r'\s*#\s*define\s+Braccio\b', directive.group()) or \
+                (re.match(r'\s*#\s*define\b', directive.group()) and ',' in directive.group()):
+            return []
+
+    errors = []
+    for match in re.finditer(r'\bBraccio\s*\.\s*(\w+)\s*\(', stripped):
+        method = match.group(1)
+        if method not in BRACCIO_METHODS:
+            message = f"'class _Braccio' has no member named '{method}'"
+            suggestions = difflib.get_close_matches(method, BRACCIO_METHODS, n=1)
+            if suggestions:
+                message += f"; did you mean '{suggestions[0]}'?"
+            errors.append((match.start(1), message))
+            continue
+        arguments = count_arguments(stripped, match.end() - 1)
+        low, high = BRACCIO_METHODS[method]
+        if arguments is not None and not low <= arguments <= high:
+            message = f"no matching function for call to '_Braccio::{method}' with {arguments} arguments"
+            if method == 'ServoMovement':
+                message += f', it takes ({SERVO_MOVEMENT_ARGS})'
+            errors.append((match.start(1), message))
+    return errors
+
+# Return the diagnostics of the sketch in the format of the compiler, with
+# sketch_file as the file name, or None if no error was found
+def precheck_sketch(code, sketch_file):
+    joined, indexes = join_spliced_lines(code)
+    stripped, unterminated_comment = strip_code(joined)
+    if stripped is None:
+        return None
+    if unterminated_comment:
+        index = joined.rfind('/*')
+        errors = [(index, 'unterminated comment')]
+    else:
+        errors = check_brackets(stripped) + check_functions(joined, stripped) + check_braccio(joined, stripped)
+    if not errors:
+        return None
+
+    lines = []
+    for index, message in errors:
+        # The positions are reported in the lines of the sketch as written
+        line, column = position(code, indexes[index])
+        if message.startswith('note: '):
+            lines.append(f'{sketch_file}:{line}:{column}: {message}')
+        else:
+            lines.append(f'{sketch_file}:{line}:{column}: error: {message}')
+    return '\n'.join(lines) + '\nCompilation error: exit status 1\n'
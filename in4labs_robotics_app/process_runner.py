@@ -0,0 +1,137 @@
+import os
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Runner of the external tools (arduino-cli, dfu-util...). Every process runs
+# in its own process group, so a timeout or a cancellation kills it together
+# with the programs it started (e.g. avrdude). The output is read line by line
+# while the process runs and appended to the output file of the job in
+# progress, if any, so it can be streamed to the browser.
+
+# Seconds between the SIGTERM and the SIGKILL of a process group
+KILL_GRACE = 2
+# Seconds between checks of the timeout and the cancellation
+POLL_INTERVAL = 0.1
+
+context = threading.local()
+
+
+class ProcessCancelled(Exception):
+    pass
+
+# Context manager to set the output file and the cancellation check (a function
+# returning True when the job must stop) of the processes run by this thread
+@contextmanager
+def process_context(output_path, cancelled):
+    context.output_path = output_path
+    context.cancelled = cancelled
+    try:
+        yield
+    finally:
+        context.output_path = None
+        context.cancelled = None
+
+# Start collecting the tool, exit code and duration of the processes run by
+# this thread, for the session trace. Return the list where they are added.
+def start_tool_log():
+    context.tools = []
+    return context.tools
+
+def stop_tool_log():
+    context.tools = None
+
+@contextmanager
+def tool_log():
+    tools = start_tool_log()
+    try:
+        yield tools
+    finally:
+        stop_tool_log()
+
+def log_tool(name, returncode, seconds):
+    tools = getattr(context, 'tools', None)
+    if tools is not None:
+        tools.append({'tool': name, 'exit_code': returncode, 'seconds': round(seconds, 3)})
+
+# For the actions that do not run a process (e.g. the arduino-cli daemon backend)
+def write_output(text):
+    output_path = getattr(context, 'output_path', None)
+    if output_path and text:
+        with open(output_path, 'a') as f:
+            f.write(text)
+
+def is_cancelled():
+    cancelled = getattr(context, 'cancelled', None)
+    return cancelled is not None and cancelled()
+
+def kill_group(process):
+    for sig, grace in [(signal.SIGTERM, KILL_GRACE), (signal.SIGKILL, None)]:
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            break # Already finished
+        try:
+            process.wait(timeout=grace)
+            break
+        except subprocess.TimeoutExpired:
+            pass
+    process.wait()
+
+# Same as subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+# but also raising ProcessCancelled if the job of the thread is cancelled
+def run_process(command, timeout=None):
+    output_path = getattr(context, 'output_path', None)
+    cancelled = getattr(context, 'cancelled', None)
+    output_file = open(output_path, 'a') if output_path else None
+    output_lock = threading.Lock()
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                errors='replace', start_new_session=True)
+    outputs = {'stdout': [], 'stderr': []}
+
+    def read(stream, name):
+        for line in stream:
+            outputs[name].append(line)
+            if output_file is not None:
+                with output_lock:
+                    if not output_file.closed:
+                        output_file.write(line)
+                        output_file.flush()
+        stream.close()
+
+    readers = [threading.Thread(target=read, args=(process.stdout, 'stdout'), daemon=True),
+                threading.Thread(target=read, args=(process.stderr, 'stderr'), daemon=True)]
+    for reader in readers:
+        reader.start()
+
+    start = time.monotonic()
+    deadline = None if timeout is None else start + timeout
+    try:
+        while True:
+            try:
+                process.wait(timeout=POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            if deadline is not None and time.monotonic() >= deadline:
+                kill_group(process)
+                raise subprocess.TimeoutExpired(command, timeout, ''.join(outputs['stdout']),
+                                                ''.join(outputs['stderr']))
+            if cancelled is not None and cancelled():
+                kill_group(process)
+                raise ProcessCancelled(f'{command[0]} cancelled')
+    finally:
+        # The pipes are closed when the whole group has finished
+        for reader in readers:
+            reader.join(timeout=KILL_GRACE)
+        if output_file is not None:
+            with output_lock:
+                output_file.close()
+        log_tool(os.path.basename(command[0]), process.returncode, time.monotonic() - start)
+
+    return subprocess.CompletedProcess(command, process.returncode,
+                                        stdout=''.join(outputs['stdout']), stderr=''.join(outputs['stderr']))
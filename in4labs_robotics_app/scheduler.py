@@ -0,0 +1,83 @@
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from .config import Config
+from .metrics import metrics
+from .shared_state import FileLock
+
+
+# Scheduler of the resources shared by all the labs running on the same Raspberry
+# Pi. Its locks are files in a folder mounted in every lab container, so:
+# - Compilations take one of cpu_slots CPU slots and wait when all are taken.
+# - Uploads share the USB hub, while a power cycle of the hub takes it alone, so
+#   it waits for the uploads in progress and no upload starts during the cycle.
+class ResourceScheduler(object):
+    def __init__(self, path, cpu_slots, usb_hub, timeout):
+        self.path = path
+        self.cpu_slots = cpu_slots
+        self.hub_lock_path = os.path.join(path, f'hub-{usb_hub}.lock')
+        self.hub_pending_path = os.path.join(path, f'hub-{usb_hub}.pending')
+        self.timeout = timeout # Seconds waiting for a resource before raising TimeoutError
+        os.makedirs(self.path, exist_ok=True)
+
+    @contextmanager
+    def cpu_slot(self):
+        start = time.monotonic()
+        # Start from a random slot so the labs do not all try the same one first
+        slots = list(range(self.cpu_slots))
+        random.shuffle(slots)
+        while True:
+            for slot in slots:
+                lock = FileLock(os.path.join(self.path, f'cpu-{slot}.lock'))
+                if lock.acquire(blocking=False):
+                    break
+            else:
+                if time.monotonic() - start > self.timeout:
+                    raise TimeoutError(f'No CPU slot free in {self.timeout} seconds')
+                time.sleep(0.1)
+                continue
+            break
+        metrics.observe('stage_seconds', time.monotonic() - start, stage='cpu_wait')
+        try:
+            yield
+        finally:
+            lock.release()
+
+    # Uploads and other actions that need the boards of the hub connected
+    @contextmanager
+    def hub_shared(self):
+        start = time.monotonic()
+        # New uploads wait for a pending power cycle, so it is not starved
+        while os.path.exists(self.hub_pending_path) and time.monotonic() - start < self.timeout:
+            time.sleep(0.1)
+        with FileLock(self.hub_lock_path, shared=True, timeout=self.timeout):
+            metrics.observe('stage_seconds', time.monotonic() - start, stage='hub_wait')
+            yield
+
+    # Actions on the whole hub, like a power cycle
+    @contextmanager
+    def hub_exclusive(self):
+        start = time.monotonic()
+        open(self.hub_pending_path, 'w').close()
+        try:
+            with FileLock(self.hub_lock_path, timeout=self.timeout):
+                metrics.observe('stage_seconds', time.monotonic() - start, stage='hub_wait')
+                yield
+        finally:
+            if os.path.exists(self.hub_pending_path):
+                os.remove(self.hub_pending_path)
+
+scheduler = None
+scheduler_lock = threading.Lock()
+
+# Return the scheduler of the config, shared by the whole app like the toolchain
+def get_scheduler():
+    global scheduler
+    with scheduler_lock:
+        if scheduler is None:
+            scheduler = ResourceScheduler(Config.scheduler_path, Config.cpu_slots,
+                                            Config.usb_hub, Config.scheduler_timeout)
+        return scheduler
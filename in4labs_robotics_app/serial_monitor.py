@@ -0,0 +1,273 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import serial
+
+from .shared_state import FileLock
+
+
+# Fixed size circular buffer of bytes shared by every reader of a serial port.
+# Positions are absolute (total bytes written), so each reader keeps its own
+# position and the data is stored once whatever the number of readers.
+class RingBuffer(object):
+    def __init__(self, size):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.size = size
+        self.end = 0
+
+    def write(self, data):
+        length = len(data)
+        # Only the last size bytes fit, but the position counts all of them
+        data = memoryview(data)[-self.size:]
+        start = (self.end + length - len(data)) % self.size
+        first = min(len(data), self.size - start)
+        self.view[start:start + first] = data[:first]
+        self.view[:len(data) - first] = data[first:]
+        self.end += length
+
+    # Return the data from position to the end of the buffer and the new position.
+    # Readers that fall behind more than the buffer size lose the oldest data.
+    def read(self, position):
+        position = max(position, self.end - self.size)
+        start = position % self.size
+        length = self.end - position
+        first = min(length, self.size - start)
+        data = bytes(self.view[start:start + first]) + bytes(self.view[:length - first])
+        return data, self.end
+
+# Thread that keeps the serial port of a board open during the whole session.
+# Opening the port resets an UNO, so it is opened once and only released
+# (paused) while a sketch is being uploaded. While the port is open a shared
+# lock is held on port_lock_path, and the port is also released when the
+# pause_flag file exists, so an upload from another server process can take it.
+class SerialSession(threading.Thread):
+    def __init__(self, port, baudrate, port_lock_path, pause_flag, buffer_size=64 * 1024):
+        super(SerialSession, self).__init__(daemon=True)
+        self.port = port
+        self.baudrate = baudrate
+        self.port_lock = FileLock(port_lock_path, shared=True)
+        self.pause_flag = pause_flag
+        self.ring = RingBuffer(buffer_size)
+        self.start_position = 0 # Position where the output of the running sketch starts
+        self.condition = threading.Condition()
+        self.serial = None
+        self.paused = False
+        self.closed = False
+        self.port_released = threading.Event()
+
+    def _open(self):
+        if not self.port_lock.acquire(blocking=False):
+            raise serial.SerialException(f'{self.port} is being used by an upload')
+        try:
+            self.serial = serial.Serial(self.port, self.baudrate, timeout=0.2)
+        except Exception:
+            self.port_lock.release()
+            raise
+        with self.condition:
+            self.start_position = self.ring.end
+            self.condition.notify_all()
+
+    def run(self):
+        while not self.closed:
+            # Checked before the pause flag, which is also created by the
+            # uploads of this process and would keep pause() waiting
+            if self.paused:
+                self._close_port()
+                with self.condition:
+                    while self.paused and not self.closed:
+                        # Also for a pause() done before this thread saw the resume()
+                        self.port_released.set()
+                        self.condition.wait()
+                continue
+            if os.path.exists(self.pause_flag):
+                # Upload from another process
+                self._close_port()
+                time.sleep(0.2)
+                continue
+            try:
+                if self.serial is None:
+                    self._open()
+                data = self.serial.read(self.serial.in_waiting or 1)
+            except (serial.SerialException, OSError):
+                # Board unplugged or reset, try to open the port again
+                self._close_port()
+                time.sleep(0.5)
+                continue
+            if data:
+                with self.condition:
+                    self.ring.write(data)
+                    self.condition.notify_all()
+        self._close_port()
+
+    def _close_port(self):
+        if self.serial is not None:
+            self.serial.close()
+            self.serial = None
+            self.port_lock.release()
+
+    # Release the serial port (e.g. to upload a sketch) until resume() is called
+    def pause(self):
+        with self.condition:
+            self.port_released.clear()
+            self.paused = True
+            self.condition.notify_all()
+        # The port is closed by the reader thread, wait for it
+        if self.is_alive():
+            self.port_released.wait(timeout=5)
+
+    def resume(self):
+        with self.condition:
+            self.paused = False
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def set_baudrate(self, baudrate):
+        # Changing the speed of an open port does not reset the board
+        self.baudrate = baudrate
+        if self.serial is not None:
+            self.serial.baudrate = baudrate
+
+    # Send data to the board, waiting up to timeout seconds for the port to be open
+    def write(self, data, timeout=5):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.serial is None and not self.closed and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+            if self.serial is None:
+                raise serial.SerialException(f'{self.port} is not open')
+            self.serial.write(data)
+
+    # Return the bytes from position on, waiting up to timeout seconds for new
+    # ones, and the position to use in the next call
+    def read(self, position, timeout):
+        with self.condition:
+            if self.ring.end <= position and not self.closed:
+                self.condition.wait(timeout)
+            return self.ring.read(position)
+
+# Reader of a serial session that decodes its output into lines for a single
+# monitor stream. It stops by itself when its time is up, when the stop_flag
+# file is touched after it started (a stop from any process of the server), or
+# when its serial session is closed (e.g. replaced after the board got a new
+# tty), which would no longer wait for data.
+class MonitorSession(object):
+    def __init__(self, serial_session, seconds, stop_flag=None):
+        self.serial_session = serial_session
+        self.position = serial_session.start_position
+        self.deadline = time.monotonic() + seconds
+        self.started = time.time()
+        self.stop_flag = stop_flag
+        self.partial = ''
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _stop_requested(self):
+        try:
+            return os.path.getmtime(self.stop_flag) >= self.started
+        except OSError:
+            return False
+
+    # Return the complete lines received, waiting up to timeout seconds
+    def read_lines(self, timeout):
+        if time.monotonic() >= self.deadline or self.serial_session.closed or \
+                (self.stop_flag and self._stop_requested()):
+            self.stopped.set()
+        if self.stopped.is_set():
+            lines = [self.partial] if self.partial else []
+            self.partial = ''
+            return lines
+        data, self.position = self.serial_session.read(self.position,
+                                    min(timeout, max(self.deadline - time.monotonic(), 0)))
+        text = self.partial + data.decode('utf-8', 'replace').replace('\r\n', '\n')
+        lines = text.split('\n')
+        self.partial = lines.pop()
+        return lines
+
+# Class to keep one serial session per board shared by all its monitor readers
+class SerialManager(object):
+    def __init__(self, run_path):
+        self.run_path = run_path
+        self.sessions = {}
+        self.monitors = {}
+        self.lock = threading.Lock()
+
+    def get_session(self, board, port, baudrate):
+        with self.lock:
+            session = self.sessions.get(board)
+            if session is not None and session.port != port:
+                # The board got a new tty (e.g. after a reset of the USB hub)
+                session.close()
+                session = None
+            if session is None:
+                session = SerialSession(port, baudrate,
+                                        os.path.join(self.run_path, f'port-{board}.lock'),
+                                        os.path.join(self.run_path, f'port-{board}.pause'))
+                self.sessions[board] = session
+                session.start()
+            elif session.baudrate != baudrate:
+                session.set_baudrate(baudrate)
+            return session
+
+    def start_monitor(self, board, port, baudrate, seconds):
+        monitor = MonitorSession(self.get_session(board, port, baudrate), seconds,
+                                    os.path.join(self.run_path, f'monitor-{board}.stop'))
+        with self.lock:
+            old_monitor = self.monitors.get(board)
+            self.monitors[board] = monitor
+        if old_monitor is not None:
+            old_monitor.stop()
+        return monitor
+
+    # Forget a monitor that has ended, unless another one has replaced it
+    def end_monitor(self, board, monitor):
+        monitor.stop()
+        with self.lock:
+            if self.monitors.get(board) is monitor:
+                del self.monitors[board]
+
+    # Stop the monitor of a board, whatever the process that serves it
+    def stop_monitor(self, board):
+        stop_flag = os.path.join(self.run_path, f'monitor-{board}.stop')
+        open(stop_flag, 'a').close()
+        os.utime(stop_flag)
+        with self.lock:
+            monitor = self.monitors.pop(board, None)
+        if monitor is not None:
+            monitor.stop()
+
+    # Context manager to release the serial port of a board while uploading.
+    # The sessions of other processes see the pause flag and close the port,
+    # then the exclusive port lock is granted. It must be used holding the
+    # board lock, so there is only one pause per board at a time.
+    @contextmanager
+    def paused(self, board):
+        pause_flag = os.path.join(self.run_path, f'port-{board}.pause')
+        open(pause_flag, 'w').close()
+        with self.lock:
+            session = self.sessions.get(board)
+        if session is not None:
+            session.pause()
+        try:
+            with FileLock(os.path.join(self.run_path, f'port-{board}.lock'), timeout=5):
+                yield
+        finally:
+            os.remove(pause_flag)
+            if session is not None:
+                session.resume()
+
+    def close(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions = {}
+            self.monitors = {}
+        for session in sessions:
+            session.close()
@@ -0,0 +1,86 @@
+import fcntl
+import json
+import os
+import sqlite3
+import time
+
+
+# Lock on a file shared by all the processes of the app (e.g. the workers of
+# the production server). Every instance opens its own file descriptor, so it
+# also works between threads of the same process.
+class FileLock(object):
+    def __init__(self, path, shared=False, timeout=None):
+        self.path = path
+        self.shared = shared
+        self.timeout = timeout # None waits forever
+        self.fd = None
+
+    def acquire(self, blocking=True):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        operation = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            try:
+                fcntl.flock(fd, operation | (fcntl.LOCK_NB if (not blocking or deadline) else 0))
+                self.fd = fd
+                return True
+            except BlockingIOError:
+                if not blocking or time.monotonic() >= deadline:
+                    os.close(fd)
+                    return False
+                time.sleep(0.05)
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        if not self.acquire():
+            raise TimeoutError(f'Could not lock {self.path} in {self.timeout} seconds')
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+# Status of the jobs stored in a SQLite database, so any worker can answer
+# the polling of a job queued by another one
+class JobStore(object):
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, board TEXT, '
+                                'action TEXT, status TEXT, result TEXT, created REAL)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def save(self, job):
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)',
+                                (job.id, job.board, job.action, job.status,
+                                json.dumps(job.result), job.created))
+
+    # Return the job as a dict like Job.to_dict() or None if it does not exist
+    def load(self, job_id):
+        with self._connect() as connection:
+            row = connection.execute('SELECT id, board, action, status, result FROM jobs WHERE id = ?',
+                                        (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {'job_id': row[0], 'board': row[1], 'action': row[2],
+                'status': row[3], 'result': json.loads(row[4])}
+
+    # Ids of the queued and running jobs of a board, except those of exclude_action
+    def active(self, board, exclude_action=None):
+        with self._connect() as connection:
+            rows = connection.execute("SELECT id FROM jobs WHERE board = ? AND status IN ('queued', 'running') "
+                                        "AND action IS NOT ?", (board, exclude_action)).fetchall()
+        return [row[0] for row in rows]
+
+    def prune(self, max_age):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM jobs WHERE created < ? AND status IN ('done', 'failed', 'cancelled')",
+                                (time.time() - max_age,))
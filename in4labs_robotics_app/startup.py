@@ -0,0 +1,117 @@
+import json
+import os
+import threading
+import time
+
+from .metrics import metrics
+from .utils import update_boards_config, stop_board
+
+
+# Startup of the boards in the background, so the app serves the login and
+# index pages as soon as it is imported. The leader finds every board in sysfs
+# (waiting for the ones enumerated late) and loads the stop code in it, and
+# keeps the status of each board in a file of the run folder, so all the
+# workers know which boards are ready. The status is one of:
+# - 'pending': the board has not been found yet.
+# - 'stopping': the board was found and the stop code is being loaded.
+# - 'ready': the board can be used.
+# - 'failed': the stop code could not be loaded, the board can still be used.
+# - 'disconnected': the board was not found in time.
+# When every board has a final status a marker with the session (its end time)
+# is written, so a leader that replaces a dead one does not start the lab again.
+USABLE = ('ready', 'failed')
+
+
+class LabStartup(object):
+    def __init__(self, boards, discovery, run_path, instance_path, serial_sessions, job_queue, session):
+        self.boards = boards
+        self.discovery = discovery
+        self.run_path = run_path
+        self.instance_path = instance_path # It's not possible to access current_app inside a thread
+        self.serial_sessions = serial_sessions
+        self.job_queue = job_queue
+        self.session = session
+        self.finished = threading.Event() # Set in the leader when every board has a final status
+
+    def _path(self, board):
+        return os.path.join(self.run_path, f'startup-{board}.json')
+
+    def set(self, board, status, error=''):
+        path = self._path(board)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'status': status, 'error': error, 'time': time.time()}, f)
+        os.replace(path + '.tmp', path)
+
+    def get(self, board):
+        try:
+            with open(self._path(board)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'status': 'pending', 'error': '', 'time': None}
+
+    def _done_path(self):
+        return os.path.join(self.run_path, 'startup.done')
+
+    # Whether the startup of this session has already finished, maybe in a
+    # worker that is gone
+    def done(self):
+        try:
+            with open(self._done_path()) as f:
+                return f.read() == self.session
+        except OSError:
+            return False
+
+    def usable(self, board):
+        return self.get(board)['status'] in USABLE
+
+    def report(self):
+        return {board: self.get(board) for board in self.boards}
+
+    # Forget the status of a previous run, called by the leader before serving
+    def reset(self):
+        for board in self.boards:
+            self.set(board, 'pending')
+
+    # Record the result of stop_board() (e.g. after a reset of the lab)
+    def record(self, board, report):
+        self.set(board, 'ready' if report['ok'] else 'failed', '' if report['ok'] else report['error'])
+
+    # Load the stop code in a board already found, as its startup job
+    def start_board(self, board, start, stop_timeout, stop_retries, deadline):
+        report = stop_board((board, self.boards[board]), self.instance_path, self.serial_sessions,
+                            stop_timeout, stop_retries, deadline)
+        self.record(board, report)
+        if not report['ok']:
+            print(f'Could not stop {board}: {report["error"]}')
+        metrics.observe('stage_seconds', time.monotonic() - start, stage='startup', board=board)
+
+    # Start all the boards in parallel, each one as soon as it is found. The
+    # wait for the boards enumerated late is done here and not in their jobs,
+    # which hold the board lock, so the jobs that do not need the board (e.g.
+    # an async compile) do not queue behind it.
+    def run(self, discovery_timeout, stop_timeout, stop_retries, margin):
+        start = time.monotonic()
+        deadline = start + discovery_timeout + margin
+        pending = dict(self.boards)
+        startup_jobs = []
+        while True:
+            for board, config in list(pending.items()):
+                if self.discovery.refresh(config['usb_port']) is not None:
+                    del pending[board]
+                    update_boards_config({board: config}, self.discovery)
+                    self.set(board, 'stopping')
+                    startup_jobs.append(self.job_queue.submit(board, 'startup', self.start_board, board, start,
+                                                              stop_timeout, stop_retries, deadline))
+            if not pending or time.monotonic() - start > discovery_timeout:
+                break
+            time.sleep(1)
+        for board, config in pending.items():
+            self.set(board, 'disconnected', f'Board with USB port {config["usb_port"]} is not connected')
+
+        for job in startup_jobs:
+            job.finished.wait()
+            if job.status in ('failed', 'cancelled'):
+                self.set(job.board, 'failed', job.result['error'])
+        with open(self._done_path(), 'w') as f:
+            f.write(self.session)
+        self.finished.set()
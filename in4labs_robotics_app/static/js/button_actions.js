@@ -103,8 +103,8 @@ function onCompileCode(board) {
     $.ajax({
         type: "POST",
         url: "compile",
-        data: {board:board, text:text},
-        success: compilationFeedback,
+        data: {board:board, text:text, async:1},
+        success: function(job) { streamJob(job, compilationFeedback) },
         error: ajaxError
     });
 
@@ -113,6 +113,88 @@ function onCompileCode(board) {
     loader.show();
 }
 
+/**
+ * Function that polls the status of a back-end job until it finishes and then
+ * passes its result to the callback.
+ *
+ * @param job, the job returned by the back-end.
+ * @param callback, the function that receives the result of the job.
+ */
+function pollJob(job, callback) {
+
+    $.ajax({
+        type: "GET",
+        url: "job_status",
+        data: {job_id:job.job_id},
+        success: function(response) {
+            if (response.status == "queued" || response.status == "running") {
+                setTimeout(function() { pollJob(job, callback) }, 500);
+            } else {
+                jobFinished(response, callback);
+            }
+        },
+        error: ajaxError
+    });
+}
+
+/**
+ * Function that passes the result of a finished back-end job to the callback,
+ * or tells the user why the job did not finish.
+ *
+ * @param response, the job with its final status.
+ * @param callback, the function that receives the result of the job.
+ */
+function jobFinished(response, callback) {
+
+    if (response.status == "done") {
+        callback(response.result);
+    } else if (response.status == "cancelled") {
+        $('#loader-bg').hide();
+        $('#modal_message').modal('show');
+        $('#modal-msg').text(messages.JOB_CANCELLED);
+    } else {
+        ajaxError();
+    }
+}
+
+/**
+ * Function that shows the output of a back-end job while it runs and then
+ * passes its result to the callback. The job is cancelled if the page is
+ * closed. Falls back to polling if the stream cannot be opened.
+ *
+ * @param job, the job returned by the back-end.
+ * @param callback, the function that receives the result of the job.
+ */
+function streamJob(job, callback) {
+
+    let output = $('#loader-output');
+    output.empty();
+
+    let source = new EventSource('job_stream?cancel_on_disconnect=1&job_id=' + encodeURIComponent(job.job_id));
+    let started = false;
+    source.onopen = function() {
+        started = true;
+    };
+    source.onmessage = function(event) {
+        output.append(document.createTextNode(event.data + '\n'));
+        output.scrollTop(output.prop('scrollHeight'));
+    };
+    source.addEventListener('end', function(event) {
+        source.close();
+        output.empty();
+        jobFinished(JSON.parse(event.data), callback);
+    });
+    source.onerror = function() {
+        source.close();
+        output.empty();
+        if (!started) {
+            pollJob(job, callback);
+        } else {
+            ajaxError();
+        }
+    };
+}
+
 /**
  * Function that is triggered when the user wants to execute the compiled code
  */
@@ -122,8 +204,8 @@ function onExecuteCode(board) {
     $.ajax({
         type: "POST",
         url: "execute",
-        data: {board:board, target:"user"},
-        success: executionFeedback,
+        data: {board:board, target:"user", async:1},
+        success: function(job) { streamJob(job, executionFeedback) },
         error: ajaxError
     });
 
@@ -154,18 +236,8 @@ function setupMonitor(board) {
  */
 function onMonitor(board, baudrate, seconds) {
 
-    // Send the instruction through an Ajax Post
-    $.ajax({
-        type: "GET",
-        url: "monitor",
-        data: {board:board, baudrate:baudrate, seconds:seconds},
-        success: monitoringFeedback,
-        error: ajaxError
-    });
-
-    // Display loader animation
-    let loader = $('#loader-bg');
-    loader.show();
+    // The stream starts the monitor session in the back-end
+    monitoringStream(board, baudrate, seconds);
 }
 
 /**
@@ -262,7 +334,7 @@ function compilationFeedback(response) {
 /**
  * Function that is executed once a program execution process has been performed in the back-end.
  *
- * @param response, contains the board used.
+ * @param response, contains the board used and the upload error, if any.
  */
 function executionFeedback(response) {
 
@@ -271,6 +343,20 @@ function executionFeedback(response) {
     loader.hide();
 
     let board = response.board
+    let error = response.error
+    // If the upload failed
+    if (error) {
+        // Print the error message
+        $('#modal_dialog').addClass('modal-xl');
+        $('#modal_message').modal('show');
+        $('#modal-msg').text(messages.EXECUTION_ERROR).after('<pre>' + error + '</pre>');
+
+        $('#modal_message').one('hidden.bs.modal', function() {
+            $('#modal_message pre').remove();
+            $('#modal_dialog').removeClass('modal-xl');
+        })
+        return;
+    }
     
     // Enable the monitor button after a successful execution
     $('#button-monitor-'+board).prop('disabled', false);
@@ -280,25 +366,40 @@ function executionFeedback(response) {
 }
 
 /**
- * Function that is executed once a monitoring process has been performed in the back-end.
+ * Function that starts a monitor session in the back-end and appends its
+ * serial output to the modal as it arrives.
  *
- * @param response, contains the board used and the serial monitor result.
+ * @param board, the board to monitor.
+ * @param baudrate, the speed of the serial port.
+ * @param seconds, the duration of the monitor session.
  */
-function monitoringFeedback(response) {
-
-    // Hide loader animation
-    let loader = $('#loader-bg');
-    loader.hide();
-
-    let board = response.board
-    let output = response.output
+function monitoringStream(board, baudrate, seconds) {
 
-    // Print the monitor result in the modal
     $('#modal_dialog').addClass('modal-lg');
     $('#modal_message').modal('show');
-    $('#modal-msg').text(messages.SERIAL_OUTPUT).after('<pre>' + output + '</pre>');
-    
-    $('#modal_message').on('hidden.bs.modal', function() {
+    $('#modal-msg').text(messages.SERIAL_OUTPUT).after('<pre></pre>');
+    let output = $('#modal_message pre');
+
+    let source = new EventSource('monitor/stream?' + $.param({board:board, baudrate:baudrate, seconds:seconds}));
+    source.onmessage = function(event) {
+        output.append(document.createTextNode(event.data + '\n'));
+        output.scrollTop(output.prop('scrollHeight'));
+    };
+    source.addEventListener('end', function() {
+        source.close();
+    });
+    // Do not reconnect, it would start another monitor session
+    source.onerror = function() {
+        source.close();
+    };
+
+    $('#modal_message').one('hidden.bs.modal', function() {
+        source.close();
+        $.ajax({
+            type: "POST",
+            url: "monitor/stop",
+            data: {board:board}
+        });
         $('#modal_message pre').remove();
         $('#modal_dialog').removeClass('modal-lg');
     })
@@ -345,14 +446,21 @@ function resetLabFeedback(response) {
 
 /**
  * Function that is executed in case that an ajax operation finishes abnormally.
+ *
+ * @param xhr, the request that failed, if any.
  */
-function ajaxError() {
+function ajaxError(xhr) {
 
     // Hide loader animation
     let loader = $('#loader-bg');
     loader.hide();
 
-    // Back-end error
     $('#modal_message').modal('show');
-    $('#modal-msg').text(messages.UNEXPECTED_ERROR);
+    if (xhr && xhr.status == 503 && xhr.responseJSON && ['pending', 'stopping'].includes(xhr.responseJSON.status)) {
+        // The board is still being prepared at the start of the session
+        $('#modal-msg').text(messages.BOARD_STARTING);
+    } else {
+        // Back-end error
+        $('#modal-msg').text(messages.UNEXPECTED_ERROR);
+    }
 }
@@ -6,6 +6,8 @@ var messages = {
     COMPILATION_ERROR: "Compilation error:",
     EXECUTION_ERROR:   "Execution error:",
     UNEXPECTED_ERROR:  "Unexpected error. Please, try to reset the lab.",
+    JOB_CANCELLED:     "The action was cancelled.",
+    BOARD_STARTING:    "The board is being prepared for your session. Please, try again in a few seconds.",
     SERIAL_OUTPUT:   "Serial output:",
     SERIAL_OUTPUT_CONFIG:   "Serial output configuration.",
     SUGGEST:   "Suggestions:",
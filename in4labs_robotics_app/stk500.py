@@ -0,0 +1,212 @@
+import subprocess
+import time
+
+import serial
+
+from .process_runner import ProcessCancelled, is_cancelled, write_output
+
+
+# In-process uploader for the AVR boards with an STK500v1 bootloader (optiboot
+# on the UNO), used instead of launching arduino-cli, which launches avrdude.
+# The Intel HEX image is read into a single buffer of whole flash pages and
+# every page is sent with its address in one write. The bootloader erases each
+# page as it writes it and there is no chip erase, so every page covered by the
+# HEX file is written whatever its contents, and the flash is not read back
+# unless asked.
+
+STK_OK = 0x10
+STK_INSYNC = 0x14
+CRC_EOP = 0x20
+STK_GET_SYNC = 0x30
+STK_ENTER_PROGMODE = 0x50
+STK_LEAVE_PROGMODE = 0x51
+STK_LOAD_ADDRESS = 0x55
+STK_PROG_PAGE = 0x64
+STK_READ_PAGE = 0x74
+STK_READ_SIGN = 0x75
+
+# MCU of the supported boards: signature, flash page size in bytes, flash
+# available to the sketch (without the bootloader) and bootloader baudrate
+BOARDS = {
+    'arduino:avr:uno': {'signature': b'\x1e\x95\x0f', 'page_size': 128, 'flash_size': 32256, 'baudrate': 115200},
+}
+
+# Attempts and seconds per attempt to get in sync with the bootloader after the reset
+SYNC_ATTEMPTS = 5
+SYNC_TIMEOUT = 0.3
+# Seconds to wait for the answer of any other command (a page write takes ~5 ms)
+REPLY_TIMEOUT = 1
+
+
+class Stk500Error(Exception):
+    pass
+
+def supported(fqbn):
+    return fqbn in BOARDS
+
+# Flash contents of a HEX file, padded with 0xFF up to a whole number of
+# pages, and the pages that its data records cover
+class FlashImage(object):
+    def __init__(self, data, page_size, covered):
+        self.data = data
+        self.page_size = page_size
+        self.covered = covered # Page numbers
+
+    # (byte address, contents) of the pages to write. The pages not covered by
+    # the file are skipped, like avrdude does, the others are written even if
+    # they are all 0xFF, or they would keep the bytes of the previous sketch.
+    def pages(self):
+        view = memoryview(self.data)
+        for page_number in sorted(self.covered):
+            address = page_number * self.page_size
+            yield address, view[address:address + self.page_size]
+
+    def page_count(self):
+        return len(self.data) // self.page_size
+
+def read_hex(path, page_size, flash_size):
+    records = []
+    base = 0
+    end = 0
+    with open(path) as f:
+        for number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                if line[0] != ':':
+                    raise ValueError
+                record = bytes.fromhex(line[1:])
+            except ValueError:
+                raise Stk500Error(f'{path}:{number}: not an Intel HEX record')
+            if len(record) < 5 or len(record) != 5 + record[0] or sum(record) & 0xFF:
+                raise Stk500Error(f'{path}:{number}: bad length or checksum')
+            length, address, record_type, data = record[0], (record[1] << 8) | record[2], record[3], record[4:-1]
+            if record_type == 0x00:
+                records.append((base + address, data))
+                end = max(end, base + address + length)
+            elif record_type == 0x01:
+                break
+            elif record_type == 0x02: # Extended segment address
+                base = int.from_bytes(data, 'big') << 4
+            elif record_type == 0x04: # Extended linear address
+                base = int.from_bytes(data, 'big') << 16
+            # 0x03 and 0x05 are start addresses, not needed by the bootloader
+    if end > flash_size:
+        raise Stk500Error(f'The sketch uses {end} bytes, the maximum is {flash_size}')
+
+    data = bytearray(b'\xff' * (-(-end // page_size) * page_size))
+    covered = set()
+    for address, record_data in records:
+        data[address:address + len(record_data)] = record_data
+        if record_data:
+            covered.update(range(address // page_size, (address + len(record_data) - 1) // page_size + 1))
+    return FlashImage(data, page_size, covered)
+
+# Client of the bootloader on an open serial port
+class Stk500Programmer(object):
+    def __init__(self, port_serial):
+        self.serial = port_serial
+
+    # Restart the board so the bootloader runs, like avrdude does
+    def reset(self):
+        try:
+            self.serial.dtr = False
+            self.serial.rts = False
+            time.sleep(0.25)
+            self.serial.dtr = True
+            self.serial.rts = True
+            time.sleep(0.05)
+        except (OSError, serial.SerialException):
+            pass # No modem lines, e.g. a pty
+        self.serial.reset_input_buffer()
+
+    def _read(self, size, timeout):
+        self.serial.timeout = timeout
+        data = self.serial.read(size)
+        if len(data) < size:
+            raise Stk500Error(f'No answer from the bootloader ({len(data)} of {size} bytes)')
+        return data
+
+    # Send a command and return the data of its answer
+    def command(self, data, reply_size=0, timeout=REPLY_TIMEOUT):
+        self.serial.write(bytes(data) + bytes([CRC_EOP]))
+        reply = self._read(reply_size + 2, timeout)
+        if reply[0] != STK_INSYNC or reply[-1] != STK_OK:
+            raise Stk500Error(f'Unexpected answer from the bootloader: {reply.hex()}')
+        return reply[1:-1]
+
+    def sync(self):
+        for _ in range(SYNC_ATTEMPTS):
+            try:
+                self.command([STK_GET_SYNC], timeout=SYNC_TIMEOUT)
+                return
+            except Stk500Error:
+                self.serial.reset_input_buffer()
+        raise Stk500Error(f'Not in sync with the bootloader after {SYNC_ATTEMPTS} attempts')
+
+    def load_address(self, address):
+        word = address // 2
+        self.command([STK_LOAD_ADDRESS, word & 0xFF, word >> 8])
+
+    # The address and the page go in a single write: the bootloader answers the
+    # address at once, and only the page write must be waited for
+    def write_page(self, address, page):
+        word = address // 2
+        self.serial.write(bytes([STK_LOAD_ADDRESS, word & 0xFF, word >> 8, CRC_EOP,
+                                    STK_PROG_PAGE, len(page) >> 8, len(page) & 0xFF, ord('F')]) +
+                            page + bytes([CRC_EOP]))
+        reply = self._read(4, REPLY_TIMEOUT)
+        if reply != bytes([STK_INSYNC, STK_OK, STK_INSYNC, STK_OK]):
+            raise Stk500Error(f'Unexpected answer from the bootloader: {reply.hex()}')
+
+    def read_page(self, address, size):
+        self.load_address(address)
+        return self.command([STK_READ_PAGE, size >> 8, size & 0xFF, ord('F')], size)
+
+# Flash the HEX file to the board on port. Return a CompletedProcess like the
+# arduino-cli upload and raise Stk500Error if the upload could not be done,
+# subprocess.TimeoutExpired after timeout seconds and ProcessCancelled if the
+# job is cancelled.
+def upload_hex(fqbn, port, input_file, timeout, verify=False):
+    command = ['stk500', fqbn, port, input_file]
+    board = BOARDS[fqbn]
+    image = read_hex(input_file, board['page_size'], board['flash_size'])
+    deadline = time.monotonic() + timeout
+
+    try:
+        port_serial = serial.Serial(port, board['baudrate'], timeout=REPLY_TIMEOUT)
+    except (OSError, serial.SerialException) as e:
+        raise Stk500Error(f'Could not open {port}: {e}')
+    with port_serial:
+        programmer = Stk500Programmer(port_serial)
+        try:
+            programmer.reset()
+            programmer.sync()
+            signature = programmer.command([STK_READ_SIGN], 3)
+            if signature != board['signature']:
+                raise Stk500Error(f'Device signature {signature.hex()} does not match {fqbn}')
+            programmer.command([STK_ENTER_PROGMODE])
+
+            pages = list(image.pages())
+            write_output(f'Writing {len(pages)} of {image.page_count()} pages ({len(image.data)} bytes)\n')
+            for number, (address, page) in enumerate(pages, start=1):
+                if time.monotonic() > deadline:
+                    raise subprocess.TimeoutExpired(command, timeout)
+                if is_cancelled():
+                    raise ProcessCancelled('Upload cancelled')
+                programmer.write_page(address, page)
+                if number % 16 == 0 or number == len(pages):
+                    write_output(f'Writing | {"#" * (50 * number // len(pages))} {100 * number // len(pages)}%\n')
+
+            if verify:
+                for address, page in pages:
+                    if programmer.read_page(address, len(page)) != page:
+                        raise Stk500Error(f'Verification error at address 0x{address:04x}')
+                write_output(f'{len(pages)} pages verified\n')
+
+            programmer.command([STK_LEAVE_PROGMODE])
+        except serial.SerialException as e:
+            raise Stk500Error(f'Serial error: {e}')
+
+    return subprocess.CompletedProcess(command, 0, stdout=f'{len(pages)} pages written\n', stderr='')
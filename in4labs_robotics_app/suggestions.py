@@ -0,0 +1,67 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .compile_cache import normalize_sketch
+from .metrics import metrics
+
+
+# Client of the external code suggestion API. The requests run in a small pool
+# of threads sharing a session, so connections are reused, and the callers
+# only wait for them up to a timeout. The suggestions are cached by the hash
+# of the code, and a request for code whose suggestion is already being
+# fetched waits for that one instead of sending another.
+class SuggestionClient(object):
+    def __init__(self, url, timeout, cache_ttl, cache_size, max_workers=4):
+        self.url = url
+        self.timeout = timeout # (connect, read) seconds of the upstream request
+        self.cache_ttl = cache_ttl # seconds
+        self.cache_size = cache_size # entries
+        self.cache = OrderedDict() # key -> (expiry time, suggestion), least recently used first
+        self.pending = {} # key -> future of the request in flight
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.session = requests.Session()
+        self.session.mount(url, HTTPAdapter(pool_connections=1, pool_maxsize=max_workers))
+
+    @staticmethod
+    def make_key(code):
+        return hashlib.sha256(normalize_sketch(code).encode('utf-8')).hexdigest()
+
+    def _fetch(self, key, code):
+        try:
+            with metrics.timer('stage_seconds', stage='suggest'):
+                r = self.session.post(self.url, data={'action': '16', 'text': code}, timeout=self.timeout)
+            r.raise_for_status()
+            with self.lock:
+                self.cache[key] = (time.monotonic() + self.cache_ttl, r.text)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            return r.text
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    # Return the suggestion for the code. Raise concurrent.futures.TimeoutError
+    # if it is not ready in timeout seconds (the request goes on and its result
+    # is cached) or the requests exception of a failed upstream request.
+    def suggest(self, code, timeout):
+        key = self.make_key(code)
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.cache.move_to_end(key)
+                metrics.inc('suggest_cache', result='hit')
+                return entry[1]
+            future = self.pending.get(key)
+            if future is None:
+                metrics.inc('suggest_cache', result='miss')
+                future = self.pending[key] = self.executor.submit(self._fetch, key, code)
+            else:
+                metrics.inc('suggest_cache', result='in_flight')
+        return future.result(timeout)
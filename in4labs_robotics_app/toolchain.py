@@ -0,0 +1,132 @@
+import atexit
+import subprocess
+import threading
+
+from .config import Config
+from .metrics import metrics
+from .process_runner import ProcessCancelled, is_cancelled, run_process, write_output
+
+
+# Backend that spawns a new arduino-cli process for every action
+class CliToolchain(object):
+    def _run(self, command, timeout=None):
+        with metrics.timer('stage_seconds', stage='process', command=command[1]):
+            return run_process(command, timeout)
+
+    # Raise subprocess.TimeoutExpired if the compilation takes more than timeout seconds
+    def compile(self, fqbn, sketch_path, build_path, cache_path, timeout=None):
+        command = ['arduino-cli', 'compile', '--fqbn', fqbn,
+            '--build-cache-path', cache_path,
+            '--build-path', build_path,
+            sketch_path]
+        return self._run(command, timeout)
+
+    # Raise subprocess.TimeoutExpired if the upload takes more than timeout seconds
+    def upload(self, fqbn, port, input_file, timeout=None):
+        command = ['arduino-cli', 'upload', '--port', port,
+                    '--fqbn', fqbn, '--input-file', input_file]
+        return self._run(command, timeout)
+
+# Spawn the 'arduino-cli daemon' shared by all the processes of the server. Only
+# the leader process spawns it, and it is stopped when the leader exits.
+def start_daemon(port):
+    process = subprocess.Popen(['arduino-cli', 'daemon', '--port', str(port)],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    atexit.register(process.terminate)
+    return process
+
+# Backend that sends the actions to a single 'arduino-cli daemon' through its
+# gRPC API, so the core and library indexes are loaded only once. The daemon is
+# the one spawned by start_daemon() or an external one (e.g. a fake daemon).
+# It needs grpcio and the Python stubs generated from the arduino-cli rpc protos
+# (see the Dockerfile).
+class DaemonToolchain(object):
+    def __init__(self, address):
+        import grpc
+        from cc.arduino.cli.commands.v1 import (commands_pb2, commands_pb2_grpc, compile_pb2,
+                                                port_pb2, upload_pb2)
+        self.grpc = grpc
+        self.commands_pb2 = commands_pb2
+        self.compile_pb2 = compile_pb2
+        self.port_pb2 = port_pb2
+        self.upload_pb2 = upload_pb2
+
+        self.channel = grpc.insecure_channel(address)
+        try:
+            grpc.channel_ready_future(self.channel).result(timeout=Config.arduino_cli_daemon_timeout)
+        except grpc.FutureTimeoutError:
+            self.close()
+            raise
+        self.stub = commands_pb2_grpc.ArduinoCoreServiceStub(self.channel)
+
+        self.instance = self.stub.Create(commands_pb2.CreateRequest()).instance
+        for _ in self.stub.Init(commands_pb2.InitRequest(instance=self.instance)):
+            pass
+
+    # Join the output streams of a gRPC response into a CompletedProcess like
+    # the one returned by subprocess.run(), so callers do not see the difference
+    def _run(self, args, responses, raise_deadline=False):
+        stdout = b''
+        stderr = b''
+        returncode = 0
+        try:
+            for response in responses:
+                stdout += response.out_stream
+                stderr += response.err_stream
+                write_output((response.out_stream + response.err_stream).decode('utf-8', 'replace'))
+                if is_cancelled():
+                    responses.cancel()
+                    raise ProcessCancelled(f'{args[0]} cancelled')
+        except self.grpc.RpcError as e:
+            if raise_deadline and e.code() == self.grpc.StatusCode.DEADLINE_EXCEEDED:
+                raise
+            stderr += (e.details() or str(e)).encode('utf-8') + b'\n'
+            returncode = 1
+        return subprocess.CompletedProcess(args, returncode, stdout=stdout.decode('utf-8', 'replace'),
+                                            stderr=stderr.decode('utf-8', 'replace'))
+
+    def compile(self, fqbn, sketch_path, build_path, cache_path, timeout=None):
+        args = ['compile', fqbn, sketch_path]
+        request = self.compile_pb2.CompileRequest(instance=self.instance, fqbn=fqbn,
+                                                    sketch_path=sketch_path, build_path=build_path,
+                                                    build_cache_path=cache_path)
+        responses = self.stub.Compile(request, timeout=timeout)
+        try:
+            return self._run(args, responses, raise_deadline=True)
+        except self.grpc.RpcError:
+            raise subprocess.TimeoutExpired(args, timeout)
+
+    def upload(self, fqbn, port, input_file, timeout=None):
+        args = ['upload', fqbn, port]
+        request = self.upload_pb2.UploadRequest(instance=self.instance, fqbn=fqbn,
+                                                port=self.port_pb2.Port(address=port, protocol='serial'),
+                                                import_file=input_file)
+        responses = self.stub.Upload(request, timeout=timeout)
+        try:
+            return self._run(args, responses, raise_deadline=True)
+        except self.grpc.RpcError:
+            raise subprocess.TimeoutExpired(args, timeout)
+
+    def close(self):
+        self.channel.close()
+
+toolchain = None
+toolchain_lock = threading.Lock()
+
+def get_daemon_address():
+    return Config.arduino_cli_daemon_address or f'localhost:{Config.arduino_cli_daemon_port}'
+
+# Return the toolchain backend selected in the config. If the daemon cannot be
+# used (missing dependencies or not starting) the subprocess backend is used.
+def get_toolchain():
+    global toolchain
+    with toolchain_lock:
+        if toolchain is None:
+            if Config.arduino_cli_backend == 'daemon':
+                try:
+                    toolchain = DaemonToolchain(get_daemon_address())
+                except Exception as e:
+                    print(f'arduino-cli daemon not available ({e}), falling back to subprocesses')
+            if toolchain is None:
+                toolchain = CliToolchain()
+        return toolchain
@@ -0,0 +1,62 @@
+import hashlib
+import json
+import threading
+import time
+
+
+# Recorder of what a session did, enabled by setting TRACE_PATH. Every request
+# to the lab and every job appends one JSON line to the file: the route, the
+# board, the hash of the sketch (not the sketch itself), the timings and the
+# exit codes of the tools run. The file is only appended to, so all the
+# processes of the server can share it, and test/replay_trace.py can run the
+# session again with the stand-in tools.
+
+# Parameters of the requests kept in the trace, the sketch is kept as its hash
+TRACED_ARGS = ('target', 'baudrate', 'seconds', 'async', 'example', 'job_id')
+
+
+def sketch_hash(code):
+    return hashlib.sha256(code.encode('utf-8')).hexdigest()[:16]
+
+class TraceRecorder(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, entry_type, **entry):
+        entry = {'type': entry_type, 'time': round(time.time(), 3), **entry}
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        # A single write of a line opened in append mode is not mixed with the
+        # lines of other processes
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+    def record_request(self, route, method, status, seconds, values, tools, response_json=None):
+        entry = {'route': route, 'method': method, 'status': status,
+                    'start': round(time.time() - seconds, 3), 'seconds': round(seconds, 3)}
+        if values.get('board'):
+            entry['board'] = values['board']
+        if values.get('text') is not None:
+            entry['sketch'] = sketch_hash(values['text'])
+            entry['sketch_size'] = len(values['text'])
+        if values.get('script') is not None:
+            entry['script_size'] = len(values['script'])
+        args = {key: values[key] for key in TRACED_ARGS if key in values}
+        if args:
+            entry['args'] = args
+        if tools:
+            entry['tools'] = tools
+        # Whether the action succeeded, the answer has an error otherwise
+        if isinstance(response_json, dict) and 'error' in response_json:
+            entry['ok'] = not response_json['error']
+        # Asynchronous requests are linked to the entry of their job
+        if status == 202 and isinstance(response_json, dict) and 'job_id' in response_json:
+            entry['job_id'] = response_json['job_id']
+        self.record('request', **entry)
+
+    def record_job(self, job, queued_seconds, seconds, tools):
+        # Whether the action succeeded, e.g. a sketch with errors is a done job
+        ok = job.status == 'done' and not (isinstance(job.result, dict) and job.result.get('error'))
+        self.record('job', job_id=job.id, board=job.board, action=job.action, status=job.status, ok=ok,
+                    queued_seconds=round(queued_seconds, 3), seconds=round(seconds, 3), tools=tools)
@@ -1,13 +1,29 @@
 import os
-import subprocess
 import re
+import shutil
+import subprocess
+import hashlib
+import functools
+import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import threading
 import time
 from datetime import datetime, timezone
 
+import serial
 from flask import current_app
 from flask_login import UserMixin
 
+from .config import Config
+from .metrics import metrics
+from .precheck import precheck_sketch
+from .process_runner import log_tool, run_process, write_output
+from .scheduler import get_scheduler
+from .shared_state import FileLock
+from .stk500 import Stk500Error, supported as stk500_supported, upload_hex
+from .toolchain import get_toolchain
+
 
 class User(UserMixin):
     def __init__(self, id, email):
@@ -16,57 +32,352 @@ class User(UserMixin):
       
 # Class to clean the lab before and after the user session
 class cleanLab(threading.Thread):
-    def __init__(self, boards, user_end_time, instance_path):
+    def __init__(self, boards, user_end_time, instance_path, serial_sessions, job_queue, workspace, startup):
         super(cleanLab, self).__init__()
         self.boards = boards
         self.user_end_time = user_end_time
         self.instance_path = instance_path # It's not possible to access current_app inside a thread
+        self.serial_sessions = serial_sessions
+        self.job_queue = job_queue
+        self.workspace = workspace
+        self.startup = startup
+        self.report = None
 
     def clean(self):
-        for board_conf in self.boards.items():
-            upload_sketch(board_conf, 'stop', self.instance_path)
+        self.report = stop_boards(self.boards, self.instance_path, self.serial_sessions, self.job_queue,
+                                    Config.stop_timeout, Config.stop_retries, Config.clean_margin)
+        for board_report in self.report.values():
+            if not board_report['ok']:
+                print(f'Could not stop {board_report["board"]}: {board_report["error"]}')
  
     def run(self):
-        self.clean()
+        # The boards are found and stopped in the background at the start,
+        # unless a previous leader of this session already did it
+        if self.startup.done():
+            self.startup.finished.set()
+        else:
+            self.startup.run(Config.startup_discovery_timeout, Config.stop_timeout,
+                                Config.stop_retries, Config.clean_margin)
         remaining_secs = (self.user_end_time - datetime.now(timezone.utc)).total_seconds()
         if (remaining_secs > 0):
             time.sleep(remaining_secs)
-            self.clean()    
+            self.clean()
+            self.serial_sessions.close()
+            self.workspace.clean()
 
 # Function to get the serial number and USB driver of the boards 
 # depending on the USB port they are connected to
-def update_boards_config(boards_config):
-    result = subprocess.run(['dmesg'], capture_output=True, text=True)
-    dmesg_output = result.stdout
-
-    # Get serial numbers
-    pattern_serial = r'1-1.(\d): SerialNumber:\s(.*?)\n'
-    matches_serial = re.findall(pattern_serial, dmesg_output)
-    for match in matches_serial:
-        for config in boards_config.values():
-            if config['usb_port'] == match[0]:
-                config['serial_number'] = match[1]
-                break
-    
-    # Raise an exception if a board is not connected
+def update_boards_config(boards_config, discovery, check_connected=True):
     for config in boards_config.values():
-        if config.get('serial_number') is None:
-            raise Exception(f'Board with USB port {config["usb_port"]} is not connected')
-        
-    # Get USB drivers
-    pattern_usb = r'1-1.(\d).*?(tty\w\w\w\d)'
-    matches_usb = re.findall(pattern_usb, dmesg_output)
-    for match in matches_usb:
-        for config in boards_config.values():
-            if config['usb_port'] == match[0]:
-                config['usb_driver'] = match[1]
-                break
+        device = discovery.get(config['usb_port'])
+
+        # Raise an exception if a board is not connected
+        if device is None:
+            if check_connected:
+                raise Exception(f'Board with USB port {config["usb_port"]} is not connected')
+            continue
+
+        config['serial_number'] = device['serial_number']
+        if device['usb_driver'] is not None:
+            config['usb_driver'] = device['usb_driver']
 
     return boards_config
 
-def upload_sketch(board_conf, target, instance_path=None):
+# Fingerprint of the arduino-cli version and the installed cores and libraries.
+# It is part of the compile cache key so updating the toolchain invalidates it.
+@functools.lru_cache(maxsize=None)
+def get_toolchain_version():
+    digest = hashlib.sha256()
+    for command in [['arduino-cli', 'version'], ['arduino-cli', 'core', 'list'],
+                    ['arduino-cli', 'lib', 'list']]:
+        result = subprocess.run(command, capture_output=True, text=True)
+        digest.update(result.stdout.encode('utf-8'))
+    return digest.hexdigest()
+
+def compile_sketch(board_conf, code, compile_cache, instance_path=None):
     # Use current_app.instance_path if instance_path is not provided
     path = instance_path or current_app.instance_path
+
+    board = board_conf[0]
+    config = board_conf[1]
+
+    compilation_path = os.path.join(get_workspace_path(path), board)
+
+    # Trivial errors are reported right away, without running the compiler
+    sketch_file = os.path.join(compilation_path, 'temp_sketch', 'temp_sketch.ino')
+    with metrics.timer('stage_seconds', stage='precheck', board=board):
+        stderr = precheck_sketch(code, sketch_file)
+    if stderr is not None:
+        metrics.inc('precheck_rejections', board=board)
+        return subprocess.CompletedProcess(['precheck', sketch_file], 1, stdout='', stderr=stderr)
+
+    with metrics.timer('stage_seconds', stage='compile', board=board, fqbn=config['fqbn']):
+        return run_compilation(config['fqbn'], code, compile_cache, compilation_path, path)
+
+# Compile the interpreter of the motion script mode for a board. It is
+# precompiled with the examples, so it is usually served by the cache.
+def compile_motion_interpreter(board_conf, compile_cache, instance_path):
+    board = board_conf[0]
+    config = board_conf[1]
+
+    with open(os.path.join(instance_path, 'firmware', 'motion_interpreter.ino')) as f:
+        code = f.read()
+    compilation_path = os.path.join(get_workspace_path(instance_path), board, 'motion')
+    os.makedirs(os.path.join(compilation_path, 'temp_sketch'), exist_ok=True)
+    with metrics.timer('stage_seconds', stage='compile', board=board, fqbn=config['fqbn']):
+        return run_compilation(config['fqbn'], code, compile_cache, compilation_path, instance_path)
+
+# Folder on the RAM backed filesystem if it is available, or the fallback folder
+def get_ram_backed_path(name, fallback):
+    path = os.path.join(Config.workspace_root, name)
+    try:
+        os.makedirs(path, exist_ok=True)
+        if os.access(path, os.W_OK):
+            return path
+    except OSError:
+        pass
+    os.makedirs(fallback, exist_ok=True)
+    return fallback
+
+# Folder of the compilations of the session. It is on a RAM backed filesystem
+# when available to spare the SD card the writes of every compilation, and in
+# the instance folder otherwise.
+@functools.lru_cache(maxsize=None)
+def get_workspace_path(instance_path):
+    return get_ram_backed_path(f'in4labs_{Config.lab_name}', os.path.join(instance_path, 'compilations', 'workspace'))
+
+# Folder of the locks and state shared by the processes of the server (job
+# store and logs, metrics, startup status...). It is only needed while the
+# server runs, so it is also kept off the SD card when possible.
+@functools.lru_cache(maxsize=None)
+def get_run_path(instance_path):
+    return get_ram_backed_path(f'in4labs_{Config.lab_name}_run', os.path.join(instance_path, 'run'))
+
+# The precompiled core archives are shared by all the boards with the same FQBN
+def get_core_cache_path(instance_path, fqbn):
+    return os.path.join(instance_path, 'compilations', 'core_cache', fqbn.replace(':', '_'))
+
+# The first compilation that uses a core cache fills it, so it runs alone to
+# avoid several arduino-cli processes writing the same core archive. The lock
+# is a file next to the cache, as the server processes share it.
+warm_core_caches = set()
+
+# Key of the build folder of a sketch. Sketches that include the same libraries
+# share their compiled objects, so only the sketch itself is compiled again.
+def get_libraries_key(code):
+    includes = sorted(set(re.findall(r'^\s*#\s*include\s*[<"]([^>"]+)[>"]', code, re.MULTILINE)))
+    digest = hashlib.sha256('\n'.join(includes + [get_toolchain_version()]).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+# The objects of each set of libraries are shared by all the boards and examples
+# with the same FQBN. A folder is the build folder of arduino-cli, so only one
+# compilation uses it at a time, holding the file lock next to it. There is a
+# pool of them per set of libraries, one per CPU slot, and a compilation takes
+# a free one once it has its CPU slot, so it never waits for the folder.
+def get_objects_paths(instance_path, fqbn, code):
+    objects_path = os.path.join(get_workspace_path(instance_path), 'objects', fqbn.replace(':', '_'),
+                                get_libraries_key(code))
+    return [f'{objects_path}-{i}' for i in range(Config.cpu_slots)]
+
+# Lock the first free objects folder of the code and return its path
+@contextmanager
+def objects_folder(instance_path, fqbn, code, timeout):
+    objects_paths = get_objects_paths(instance_path, fqbn, code)
+    os.makedirs(os.path.dirname(objects_paths[0]), exist_ok=True)
+    deadline = time.monotonic() + timeout
+    while True:
+        for objects_path in objects_paths:
+            lock = FileLock(objects_path + '.lock')
+            if lock.acquire(blocking=False):
+                try:
+                    if os.path.isdir(objects_path):
+                        os.utime(objects_path) # Used now, see Workspace.make_room()
+                    yield objects_path
+                finally:
+                    lock.release()
+                return
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f'No objects folder free in {timeout} seconds')
+        time.sleep(0.05)
+
+# Compile the code inside a compilation folder with the 'build' and 'temp_sketch'
+# subfolders. The core cache and the objects are shared, see above.
+def run_compilation(fqbn, code, compile_cache, compilation_path, instance_path):
+    sketch_path = os.path.join(compilation_path, 'temp_sketch')
+    build_path = os.path.join(compilation_path, 'build')
+
+    with open(os.path.join(sketch_path, 'temp_sketch.ino'), 'w') as f:
+        f.write(code)
+
+    # Serve the artifacts from the cache without running the compiler
+    key = compile_cache.make_key(code, fqbn, get_toolchain_version())
+    meta = compile_cache.get(key)
+    if meta is not None:
+        try:
+            stderr = compile_cache.restore(key, meta, sketch_path, build_path, 'temp_sketch.ino')
+            metrics.inc('compile_cache', result='hit', fqbn=fqbn)
+            return subprocess.CompletedProcess(['compile', fqbn, sketch_path], meta['returncode'],
+                                                stdout='', stderr=stderr)
+        except OSError:
+            pass # Entry evicted while restoring, compile it again
+    metrics.inc('compile_cache', result='miss', fqbn=fqbn)
+
+    core_cache_path = get_core_cache_path(instance_path, fqbn)
+    os.makedirs(core_cache_path, exist_ok=True)
+
+    def compile_in(objects_path):
+        result = get_toolchain().compile(fqbn, sketch_path, objects_path, core_cache_path,
+                                            Config.compile_timeout)
+        # Leave the images where upload_sketch expects them, before another
+        # compilation replaces them
+        os.makedirs(build_path, exist_ok=True)
+        for extension in ['.hex', '.bin']:
+            artifact = os.path.join(objects_path, 'temp_sketch.ino' + extension)
+            if result.returncode == 0 and os.path.isfile(artifact):
+                shutil.copyfile(artifact, os.path.join(build_path, 'temp_sketch.ino' + extension))
+        return result
+
+    if core_cache_path in warm_core_caches:
+        with get_scheduler().cpu_slot(), objects_folder(instance_path, fqbn, code, Config.compile_timeout) as objects_path, \
+                metrics.timer('stage_seconds', stage='toolchain_compile', fqbn=fqbn):
+            result = compile_in(objects_path)
+    else:
+        with FileLock(core_cache_path + '.lock', timeout=Config.compile_timeout), get_scheduler().cpu_slot(), \
+                objects_folder(instance_path, fqbn, code, Config.compile_timeout) as objects_path, \
+                metrics.timer('stage_seconds', stage='toolchain_compile_cold', fqbn=fqbn):
+            result = compile_in(objects_path)
+            if result.returncode == 0:
+                warm_core_caches.add(core_cache_path)
+
+    # Cache failures only when the compiler reported an error in the sketch, not
+    # when the toolchain crashed or the workspace was full
+    if result.returncode == 0 or is_sketch_error(result.stderr, sketch_path):
+        compile_cache.put(key, result.returncode, result.stderr, sketch_path, build_path, 'temp_sketch.ino')
+    return(result)
+
+# Whether the stderr of a compilation has a compiler diagnostic for the sketch,
+# e.g. "<sketch_path>/temp_sketch.ino:12:5: error: ..."
+def is_sketch_error(stderr, sketch_path):
+    return (os.path.join(sketch_path, 'temp_sketch.ino') + ':') in (stderr or '')
+
+# Compile every example of every board in parallel so running an unmodified
+# example is served by the compile cache
+def precompile_examples(boards, compile_cache, instance_path):
+    examples_path = os.path.join(instance_path, 'examples')
+    jobs = {}
+    for board, config in boards.items():
+        paths = [os.path.join(examples_path, board), os.path.join(examples_path, 'Commons')]
+        if config['fqbn'].split(':')[1] == 'avr':
+            paths.append(os.path.join(instance_path, 'firmware')) # Motion interpreter
+        for path in paths:
+            if os.path.isdir(path):
+                for example in os.listdir(path):
+                    if example.endswith('.ino'):
+                        jobs[(config['fqbn'], example)] = os.path.join(path, example)
+
+    def precompile(job):
+        fqbn, example = job
+        with open(jobs[job]) as f:
+            code = f.read()
+        compilation_path = os.path.join(get_workspace_path(instance_path), 'examples',
+                                        fqbn.replace(':', '_'), example.replace('.ino', ''))
+        os.makedirs(os.path.join(compilation_path, 'temp_sketch'), exist_ok=True)
+        run_compilation(fqbn, code, compile_cache, compilation_path, instance_path)
+        key = compile_cache.make_key(code, fqbn, get_toolchain_version())
+        compile_cache.pin(key, example)
+        return key
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(precompile, sorted(jobs)))
+
+# Record of the image last flashed to a board, kept in the folder shared by all
+# the labs and their containers (see scheduler.py), so it survives the end of
+# the session: the stop upload at the start of a session is skipped after the
+# one at the end of the previous session. It is keyed by the USB serial number
+# of the board, so a replaced board is always flashed.
+def get_flashed_image_path(config):
+    serial_number = config.get('serial_number')
+    if not serial_number:
+        return None
+    return os.path.join(Config.scheduler_path, 'flashed', f'{serial_number}.json')
+
+def read_flashed_image(config):
+    flashed_image_path = get_flashed_image_path(config)
+    if flashed_image_path is None:
+        return None
+    try:
+        with open(flashed_image_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_flashed_image(config, image):
+    flashed_image_path = get_flashed_image_path(config)
+    if flashed_image_path is None:
+        return
+    if image is None:
+        if os.path.exists(flashed_image_path):
+            os.remove(flashed_image_path)
+        return
+    os.makedirs(os.path.dirname(flashed_image_path), exist_ok=True)
+    with open(flashed_image_path + '.tmp', 'w') as f:
+        json.dump(image, f)
+    os.replace(flashed_image_path + '.tmp', flashed_image_path)
+
+def get_image_hash(input_file):
+    with open(input_file, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+# Restart the sketch of an UNO without flashing it. Opening the port drops DTR,
+# which resets the board through its auto-reset capacitor. Not at 1200 baud,
+# which makes the boards with native USB (e.g. a Leonardo) enter the bootloader.
+def reset_board(port):
+    with serial.Serial(port, 115200) as board_serial:
+        board_serial.dtr = False
+        time.sleep(0.1)
+        board_serial.dtr = True
+
+# Return True if the sketch already on the board can be used instead of flashing
+# it again. The user sketch must start again as after an upload: an UNO is
+# reset, but there is no way to restart an esp32 sketch without flashing it.
+def upload_skippable(board_type, target, config):
+    if target != 'user':
+        return True
+    if board_type != 'avr':
+        return False
+    try:
+        reset_board(f'/dev/{config["usb_driver"]}')
+    except (serial.SerialException, OSError):
+        return False
+    return True
+
+# Flash an AVR board with the in-process uploader if it supports the board,
+# and with arduino-cli otherwise or if the in-process upload fails
+def upload_avr(fqbn, port, input_file, timeout):
+    if Config.avr_uploader == 'stk500' and stk500_supported(fqbn):
+        start = time.monotonic()
+        try:
+            result = upload_hex(fqbn, port, input_file, timeout, Config.avr_verify)
+            log_tool('stk500', 0, time.monotonic() - start)
+            return result
+        except Stk500Error as e:
+            log_tool('stk500', 1, time.monotonic() - start)
+            metrics.inc('stk500_fallbacks', fqbn=fqbn)
+            write_output(f'{e}, uploading with arduino-cli\n')
+        # The fallback gets the rest of the time of the upload
+        remaining = timeout - (time.monotonic() - start)
+        if remaining <= 0:
+            raise subprocess.TimeoutExpired(['upload', fqbn, port, input_file], timeout)
+        timeout = remaining
+    return get_toolchain().upload(fqbn, port, input_file, timeout)
+
+# Raise subprocess.TimeoutExpired if the upload takes more than timeout seconds.
+# The upload is skipped if the board already has the same image, the board is
+# only reset so the sketch starts again.
+def upload_sketch(board_conf, target, instance_path=None, timeout=None):
+    # Use current_app.instance_path if instance_path is not provided
+    path = instance_path or current_app.instance_path
+    timeout = timeout or Config.upload_timeout
     
     board = board_conf[0]
     config = board_conf[1]
@@ -79,7 +390,7 @@ def upload_sketch(board_conf, target, instance_path=None):
         serial_number = config['serial_number']
 
         if (target == 'user'): 
-            input_file = os.path.join(path, 'compilations', board, 'build','temp_sketch.ino.bin')
+            input_file = os.path.join(get_workspace_path(path), board, 'build','temp_sketch.ino.bin')
         else: # target == 'stop'
             input_file = os.path.join(path, 'compilations', 'precompiled','stop.ino.bin')
 
@@ -87,18 +398,88 @@ def upload_sketch(board_conf, target, instance_path=None):
                                         'tools', 'dfu-util', '0.11.0-arduino5', 'dfu-util')
         
         command = [dfu_util, '--serial', serial_number, '-D', input_file, '-Q']
+        upload = lambda: run_process(command, timeout)
     elif (board_type == 'avr'):
         usb_driver = config['usb_driver']
 
         if (target == 'user'): 
-            input_file = os.path.join(path, 'compilations', board, 'build','temp_sketch.ino.hex')
+            input_file = os.path.join(get_workspace_path(path), board, 'build','temp_sketch.ino.hex')
+        elif (target == 'motion'):
+            input_file = os.path.join(get_workspace_path(path), board, 'motion', 'build','temp_sketch.ino.hex')
         else: # target == 'stop'
             input_file = os.path.join(path, 'compilations', 'precompiled','stop.ino.hex')
 
-        command = ['arduino-cli', 'upload', '--port', f'/dev/{usb_driver}',
-                    '--fqbn', fqbn, '--input-file', input_file]    
+        command = ['upload', fqbn, f'/dev/{usb_driver}', input_file]
+        upload = lambda: upload_avr(fqbn, f'/dev/{usb_driver}', input_file, timeout)
     else:
         raise Exception(f'Board of type "{board_type}" is not supported')
-    
-    result = subprocess.run(command, capture_output=True, text=True) 
-    return(result) 
\ No newline at end of file
+
+    if not os.path.isfile(input_file):
+        # e.g. an execute before any successful compilation
+        return subprocess.CompletedProcess(command, 1, stdout='',
+                                            stderr=f'No compiled sketch to upload ({os.path.basename(input_file)})')
+
+    image = {'serial_number': config.get('serial_number'), 'fqbn': fqbn,
+             'hash': get_image_hash(input_file)}
+    if read_flashed_image(config) == image and upload_skippable(board_type, target, config):
+        metrics.inc('uploads_skipped', board=board)
+        return subprocess.CompletedProcess(command, 0, stdout='', stderr='')
+
+    # Forget the image first, a failed or interrupted upload leaves the flash unknown
+    write_flashed_image(config, None)
+    # Not while the USB hub is power cycled by any lab
+    with get_scheduler().hub_shared(), metrics.timer('stage_seconds', stage='upload', board=board, fqbn=fqbn):
+        result = upload()
+    if result.returncode == 0:
+        write_flashed_image(config, image)
+    return(result) 
+
+# Upload the stop sketch to a board, retrying on errors while there is time
+# left before the deadline (a time.monotonic() value). No attempt runs past
+# the deadline.
+def stop_board(board_conf, instance_path, serial_sessions, timeout, retries, deadline):
+    board = board_conf[0]
+    start = time.monotonic()
+    attempts = 0
+    ok = False
+    error = None
+    while True:
+        attempt_timeout = min(timeout, deadline - time.monotonic())
+        if attempt_timeout <= 0:
+            error = error or 'No time left to stop the board'
+            break
+        attempts += 1
+        try:
+            with serial_sessions.paused(board):
+                result = upload_sketch(board_conf, 'stop', instance_path, attempt_timeout)
+            error = result.stderr
+            ok = result.returncode == 0
+        except subprocess.TimeoutExpired:
+            error = f'Upload timed out after {attempt_timeout:.1f} seconds'
+        if ok or attempts > retries:
+            break
+        metrics.inc('stop_retries', board=board)
+    return {'board': board, 'ok': ok, 'attempts': attempts, 'error': error,
+            'duration': round(time.monotonic() - start, 3)}
+
+# Upload the stop sketch to all the boards in parallel and return a report per
+# board. The jobs of the user are cancelled first, so the stops do not wait
+# behind them. A stop job that failed or was cancelled gets a report like the
+# ones of stop_board().
+def stop_boards(boards, instance_path, serial_sessions, job_queue, timeout, retries, margin):
+    start = time.monotonic()
+    deadline = start + margin
+    for board in boards:
+        job_queue.cancel_board(board)
+    stop_jobs = [job_queue.submit(board, 'stop', stop_board, (board, config), instance_path,
+                                    serial_sessions, timeout, retries, deadline)
+                    for board, config in boards.items()]
+    report = {}
+    for job in stop_jobs:
+        job.finished.wait()
+        if job.status == 'done':
+            report[job.board] = job.result
+        else:
+            report[job.board] = {'board': job.board, 'ok': False, 'attempts': 0, 'error': job.result['error'],
+                                    'duration': round(time.monotonic() - start, 3)}
+    return report
\ No newline at end of file
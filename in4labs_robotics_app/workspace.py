@@ -0,0 +1,77 @@
+import os
+import shutil
+import time
+
+from .shared_state import FileLock
+
+
+# Folder of the compilations of a session (sketches and build folders of every
+# board and example, and the objects they share), usually on a RAM backed
+# filesystem. Its size is kept under a budget by removing the objects of the
+# least recently used sets of libraries, which only costs a slower compilation
+# the next time. The core cache and the compile cache are not here, they must
+# survive the session.
+class Workspace(object):
+    def __init__(self, path, max_size, min_age=120):
+        self.path = path
+        self.min_age = min_age # Seconds since the last use of objects that may be removed
+        os.makedirs(self.path, exist_ok=True)
+        # The budget cannot be larger than the filesystem (e.g. the 64 MB of the
+        # /dev/shm of a Docker container)
+        stat = os.statvfs(self.path)
+        self.max_size = min(max_size, int(stat.f_blocks * stat.f_frsize * 0.75))
+
+    @staticmethod
+    def _size(path):
+        size = 0
+        for root, _, files in os.walk(path):
+            for file in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, file))
+                except OSError:
+                    pass # Removed meanwhile
+        return size
+
+    def usage(self):
+        return self._size(self.path)
+
+    # Remove objects folders (objects/<fqbn>/<libraries key>-<n>) until the
+    # workspace fits in its budget. Objects used recently or locked by a
+    # compilation in progress are kept.
+    def make_room(self):
+        size = self.usage()
+        if size <= self.max_size:
+            return size
+        objects = []
+        objects_root = os.path.join(self.path, 'objects')
+        if os.path.isdir(objects_root):
+            for fqbn in os.listdir(objects_root):
+                fqbn_path = os.path.join(objects_root, fqbn)
+                if os.path.isdir(fqbn_path):
+                    objects += [os.path.join(fqbn_path, key) for key in os.listdir(fqbn_path)
+                                if os.path.isdir(os.path.join(fqbn_path, key))]
+        now = time.time()
+        for path in sorted(objects, key=os.path.getmtime):
+            if size <= self.max_size:
+                break
+            if now - os.path.getmtime(path) < self.min_age:
+                continue
+            lock = FileLock(path + '.lock')
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                objects_size = self._size(path)
+                shutil.rmtree(path, ignore_errors=True)
+                size -= objects_size
+            finally:
+                lock.release()
+        return size
+
+    # Remove everything at the end of the session
+    def clean(self):
+        for entry in os.listdir(self.path):
+            path = os.path.join(self.path, entry)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
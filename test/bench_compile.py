@@ -0,0 +1,110 @@
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+
+# Benchmark of the compile times of edited sketches with the previous layout
+# (a single build folder per board) and the one of the app (run_compilation():
+# a pool of build folders per FQBN and set of included libraries shared by all
+# the boards, and a core cache shared by FQBN). It alternates between examples
+# that use different libraries and between boards, as students do, editing them
+# on every compilation. Needs arduino-cli with the cores installed.
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+appdir = os.path.join(basedir, os.pardir, 'in4labs_robotics_app')
+examples_path = os.path.join(basedir, os.pardir, 'arduino', 'examples', 'Board_1')
+
+
+def load_utils(workdir):
+    # Import the modules without the package __init__, which starts a lab
+    os.environ.setdefault('USER_EMAIL', 'bench@email.com')
+    os.environ.setdefault('END_TIME', '2100-01-01T00:00:00.000000Z')
+    os.environ['WORKSPACE_ROOT'] = os.path.join(workdir, 'shm')
+    os.environ['SCHEDULER_PATH'] = os.path.join(workdir, 'scheduler')
+    package = types.ModuleType('in4labs_robotics_app')
+    package.__path__ = [appdir]
+    sys.modules['in4labs_robotics_app'] = package
+    from in4labs_robotics_app import utils
+    from in4labs_robotics_app.compile_cache import CompileCache
+    return utils, CompileCache
+
+# Previous layout: arduino-cli with the build folder of the board
+def compile_previous(fqbn, code, compilation_path):
+    sketch_path = os.path.join(compilation_path, 'temp_sketch')
+    os.makedirs(sketch_path, exist_ok=True)
+    with open(os.path.join(sketch_path, 'temp_sketch.ino'), 'w') as f:
+        f.write(code)
+    command = ['arduino-cli', 'compile', '--fqbn', fqbn,
+                '--build-cache-path', os.path.join(compilation_path, 'cache'),
+                '--build-path', os.path.join(compilation_path, 'build'), sketch_path]
+    return subprocess.run(command, capture_output=True, text=True)
+
+# Layout of the app
+def compile_app(utils, compile_cache, instance_path, fqbn, code, compilation_path):
+    os.makedirs(os.path.join(compilation_path, 'temp_sketch'), exist_ok=True)
+    return utils.run_compilation(fqbn, code, compile_cache, compilation_path, instance_path)
+
+def run(fqbn, examples, boards, runs, workdir):
+    utils, CompileCache = load_utils(workdir)
+    sketches = []
+    for example in examples:
+        with open(os.path.join(examples_path, example)) as f:
+            sketches.append(f.read())
+
+    results = {}
+    for layout in ['previous', 'app']:
+        instance_path = os.path.join(workdir, layout)
+        os.makedirs(instance_path)
+        compile_cache = CompileCache(os.path.join(instance_path, 'compilations', 'cache_store'), 64 * 1024 * 1024)
+        def compile(code, board):
+            compilation_path = os.path.join(instance_path, f'Board_{board}')
+            start = time.monotonic()
+            if layout == 'previous':
+                result = compile_previous(fqbn, code, compilation_path)
+            else:
+                result = compile_app(utils, compile_cache, instance_path, fqbn, code, compilation_path)
+            elapsed = time.monotonic() - start
+            if result.returncode != 0:
+                raise Exception(result.stderr)
+            return elapsed
+
+        # Warm up the core cache and the objects of every sketch in the first board
+        for code in sketches:
+            compile(code + '\n// Warm up\n', 1)
+        times = []
+        for i in range(runs):
+            code = sketches[i % len(sketches)] + f'\n// Edit {i}\n'
+            times.append(compile(code, 1 + (i // len(sketches)) % boards))
+        results[layout] = {'runs': runs, 'mean': statistics.mean(times),
+                            'median': statistics.median(times), 'max': max(times)}
+        print(f'{layout}: mean {results[layout]["mean"]:.2f} s, median {results[layout]["median"]:.2f} s')
+
+    results['speedup'] = results['previous']['mean'] / results['app']['mean']
+    print(f'Speedup: {results["speedup"]:.2f}x')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fqbn', default='arduino:avr:uno')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--boards', type=int, default=2, help='boards with the same FQBN')
+    parser.add_argument('--examples', nargs='+', default=['2._Wave_hello.ino', 'New_Sketch.ino'])
+    parser.add_argument('--output', help='JSON file to save the results')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='in4labs_bench_')
+    try:
+        results = run(args.fqbn, args.examples, args.boards, args.runs, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
@@ -0,0 +1,146 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+
+# Simulation of several labs sharing one Raspberry Pi. Every lab is a process
+# that compiles, uploads and sometimes power cycles the USB hub with the
+# stand-in tools of test/fakes, through the ResourceScheduler of the app or
+# without it. The intervals of every action are recorded to check that the
+# compilations never exceed the CPU slots and that no upload is running while
+# the hub is power cycled.
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+appdir = os.path.join(basedir, os.pardir, 'in4labs_robotics_app')
+
+
+def load_scheduler():
+    # Import the modules without the package __init__, which starts a lab
+    os.environ.setdefault('USER_EMAIL', 'bench@email.com')
+    os.environ.setdefault('END_TIME', '2100-01-01T00:00:00.000000Z')
+    package = types.ModuleType('in4labs_robotics_app')
+    package.__path__ = [appdir]
+    sys.modules['in4labs_robotics_app'] = package
+    from in4labs_robotics_app.scheduler import ResourceScheduler
+    return ResourceScheduler
+
+class NoScheduler(object):
+    def __init__(self, *args):
+        pass
+
+    def cpu_slot(self):
+        return NullContext()
+
+    def hub_shared(self):
+        return NullContext()
+
+    def hub_exclusive(self):
+        return NullContext()
+
+class NullContext(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+def lab(number, args, scheduler_path, events_path):
+    os.environ['PATH'] = os.path.join(basedir, 'fakes') + os.pathsep + os.environ['PATH']
+    if args.no_scheduler:
+        scheduler = NoScheduler()
+    else:
+        scheduler = load_scheduler()(scheduler_path, args.cpu_slots, '1-1', 300)
+    random.seed(number)
+    workdir = tempfile.mkdtemp(prefix=f'lab{number}_', dir=os.path.dirname(events_path))
+    sketch_path = os.path.join(workdir, 'temp_sketch')
+    os.makedirs(sketch_path)
+    with open(os.path.join(sketch_path, 'temp_sketch.ino'), 'w') as f:
+        f.write('void setup() {}\nvoid loop() {}\n')
+    build_path = os.path.join(workdir, 'build')
+
+    def record(action, start):
+        with open(events_path, 'a') as f:
+            f.write(json.dumps({'lab': number, 'action': action, 'start': start, 'end': time.time()}) + '\n')
+
+    for _ in range(args.actions):
+        action = random.choices(['compile', 'upload', 'cycle'], [5, 4, 1])[0]
+        if action == 'compile':
+            with scheduler.cpu_slot():
+                start = time.time()
+                subprocess.run(['arduino-cli', 'compile', '--fqbn', 'arduino:avr:uno', '--build-path', build_path,
+                                sketch_path], capture_output=True)
+                record(action, start)
+        elif action == 'upload':
+            with scheduler.hub_shared():
+                start = time.time()
+                subprocess.run(['arduino-cli', 'upload', '--port', '/dev/null', '--fqbn', 'arduino:avr:uno',
+                                '--input-file', os.path.join(build_path, 'temp_sketch.ino.hex')], capture_output=True)
+                record(action, start)
+        else:
+            with scheduler.hub_exclusive():
+                start = time.time()
+                subprocess.run(['uhubctl', '-a', 'cycle', '-l', '1-1', '-d', '2'], capture_output=True)
+                record(action, start)
+        time.sleep(random.random() * 0.2)
+
+def analyze(events, cpu_slots):
+    compiles = [event for event in events if event['action'] == 'compile']
+    changes = sorted([(event['start'], 1) for event in compiles] + [(event['end'], -1) for event in compiles])
+    concurrent = max_concurrent = 0
+    for _, change in changes:
+        concurrent += change
+        max_concurrent = max(max_concurrent, concurrent)
+
+    cycles = [event for event in events if event['action'] == 'cycle']
+    uploads = [event for event in events if event['action'] == 'upload']
+    broken = sum(1 for upload in uploads
+                    if any(upload['start'] < cycle['end'] and cycle['start'] < upload['end'] for cycle in cycles))
+    return {'compiles': len(compiles), 'max_concurrent_compiles': max_concurrent, 'cpu_slots': cpu_slots,
+            'uploads': len(uploads), 'cycles': len(cycles), 'uploads_during_cycles': broken}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--labs', type=int, default=4)
+    parser.add_argument('--actions', type=int, default=10, help='actions per lab')
+    parser.add_argument('--cpu-slots', type=int, default=2)
+    parser.add_argument('--compile-latency', type=float, default=0.5, help='seconds')
+    parser.add_argument('--upload-latency', type=float, default=0.5, help='seconds')
+    parser.add_argument('--uhubctl-latency', type=float, default=0.5, help='seconds')
+    parser.add_argument('--no-scheduler', action='store_true', help='run the labs without coordination')
+    parser.add_argument('--output', help='JSON file to save the results')
+    args = parser.parse_args()
+
+    os.environ['FAKE_COMPILE_LATENCY'] = str(args.compile_latency)
+    os.environ['FAKE_UPLOAD_LATENCY'] = str(args.upload_latency)
+    os.environ['FAKE_UHUBCTL_LATENCY'] = str(args.uhubctl_latency)
+
+    with tempfile.TemporaryDirectory() as shared:
+        events_path = os.path.join(shared, 'events.jsonl')
+        start = time.monotonic()
+        labs = [multiprocessing.Process(target=lab, args=(number, args, os.path.join(shared, 'scheduler'),
+                                                            events_path))
+                for number in range(args.labs)]
+        for process in labs:
+            process.start()
+        for process in labs:
+            process.join()
+        with open(events_path) as f:
+            events = [json.loads(line) for line in f]
+
+    results = analyze(events, args.cpu_slots)
+    results['seconds'] = round(time.monotonic() - start, 2)
+    print(json.dumps(results, indent=4))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+    if not args.no_scheduler and (results['max_concurrent_compiles'] > args.cpu_slots or
+                                    results['uploads_during_cycles']):
+        sys.exit('The scheduler did not keep the limits')
@@ -0,0 +1,113 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+from werkzeug.serving import make_server
+
+from benchmark import SERVER_NAME, LAB_NAME, USER_EMAIL, prepare_lab
+
+
+# Startup time of the lab. The app is started in a new process with the
+# stand-in tools of test/fakes and the fake board of benchmark.py, which may be
+# plugged some seconds later, and this script measures how long it takes until
+# the login page is served, until /ready reports the board ready and until the
+# first upload to the board is accepted.
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+
+# Run the app in this process, called in the child process
+def serve(args):
+    prepare_lab(args.workdir, args.suggest_port, args.board_delay)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    from in4labs_robotics_app import app
+    server = make_server('localhost', args.port, app, threaded=True)
+    server.serve_forever()
+
+def wait_for(request, timeout):
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        try:
+            if request().status_code < 400:
+                return True
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.05)
+    return False
+
+def run(args):
+    base_url = f'http://localhost:{args.port}/{SERVER_NAME}/{LAB_NAME}/'
+    workdir = tempfile.mkdtemp(prefix='in4labs_bench_')
+    command = [sys.executable, os.path.abspath(__file__), '--serve', '--workdir', workdir,
+                '--port', str(args.port), '--suggest-port', str(args.suggest_port),
+                '--board-delay', str(args.board_delay)]
+    env = dict(os.environ, FAKE_UPLOAD_LATENCY=str(args.upload_latency),
+                FAKE_COMPILE_LATENCY=str(args.compile_latency))
+    start = time.monotonic()
+    process = subprocess.Popen(command, env=env, cwd=basedir)
+    try:
+        session = requests.Session()
+        results = {'config': vars(args)}
+        if not wait_for(lambda: session.get(base_url), args.timeout):
+            raise Exception('The login page was not served')
+        results['login_page'] = time.monotonic() - start
+
+        session.post(base_url, data={'email': USER_EMAIL})
+        if not wait_for(lambda: session.get(base_url + 'index'), args.timeout):
+            raise Exception('The index page was not served')
+        results['index_page'] = time.monotonic() - start
+
+        # Uploads are answered 503 until the board is ready
+        rejected = []
+        def execute():
+            response = session.post(base_url + 'execute', data={'board': 'Board_1', 'target': 'stop', 'async': 1})
+            if response.status_code == 503:
+                rejected.append(response.json()['status'])
+            return response
+        if not wait_for(execute, args.timeout):
+            raise Exception('The board did not get ready')
+        results['first_upload'] = time.monotonic() - start
+        results['rejected_uploads'] = {status: rejected.count(status) for status in set(rejected)}
+
+        if not wait_for(lambda: session.get(base_url + 'ready'), args.timeout):
+            raise Exception('The lab did not get ready')
+        results['ready'] = time.monotonic() - start
+        results['boards'] = session.get(base_url + 'ready').json()['boards']
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for key in ['login_page', 'index_page', 'first_upload', 'ready']:
+        print(f'{key}: {results[key]:.3f} s')
+    print('rejected_uploads: ' + ', '.join(f'{status} {count}'
+                                        for status, count in results['rejected_uploads'].items()))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f'Results saved in {args.output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--board-delay', type=float, default=0, help='seconds until the board is plugged')
+    parser.add_argument('--compile-latency', type=float, default=2, help='seconds')
+    parser.add_argument('--upload-latency', type=float, default=4, help='seconds')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds waiting for each step')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--suggest-port', type=int, default=8766)
+    parser.add_argument('--output', default=os.path.abspath('bench_startup.json'))
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+    else:
+        run(args)
@@ -0,0 +1,162 @@
+import argparse
+import json
+import os
+import pty
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+
+# Flash time of the in-process STK500v1 uploader of the app against the stand-in
+# bootloader of test/fakes/stk500_board.py on a pty, which simulates the time
+# of the serial line at 115200 baud and of the page writes. The flash of the
+# stand-in is checked after every upload. The same images are flashed with the
+# current path: avrdude against the same stand-in if it is installed (or given
+# with --avrdude), and the stand-in arduino-cli of test/fakes otherwise, which
+# only measures the cost of launching the tool.
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+appdir = os.path.join(basedir, os.pardir, 'in4labs_robotics_app')
+sys.path.insert(0, os.path.join(basedir, 'fakes'))
+
+from stk500_board import FakeBootloader, FLASH_SIZE
+
+
+def load_stk500():
+    # Import the module without the package __init__, which starts a lab
+    package = types.ModuleType('in4labs_robotics_app')
+    package.__path__ = [appdir]
+    sys.modules['in4labs_robotics_app'] = package
+    from in4labs_robotics_app import stk500
+    return stk500
+
+# Write data as an Intel HEX file with 16 byte records, skipping the gaps (page numbers)
+def write_hex(path, data, gaps=()):
+    with open(path, 'w') as f:
+        for address in range(0, len(data), 16):
+            chunk = data[address:address + 16]
+            if address // 128 in gaps:
+                continue
+            record = bytes([len(chunk), address >> 8, address & 0xFF, 0]) + chunk
+            f.write(':' + (record + bytes([-sum(record) & 0xFF])).hex().upper() + '\n')
+        f.write(':00000001FF\n')
+
+# Sketch of size bytes and its gaps, some pages in the middle not covered by
+# the file like the gaps between the sections of a real image. Some other
+# pages are all 0xFF but covered, they must be written too.
+def sample_image(size, seed=0):
+    generator = random.Random(seed)
+    data = bytearray(generator.randrange(256) for _ in range(size))
+    pages = generator.sample(range(size // 128), size // 128 // 5)
+    gaps, blank = pages[:len(pages) // 2], pages[len(pages) // 2:]
+    for page in pages:
+        data[page * 128:(page + 1) * 128] = b'\xff' * 128
+    return bytes(data), set(gaps)
+
+def start_bootloader(time_scale):
+    master, slave = pty.openpty()
+    bootloader = FakeBootloader(master, time_scale=time_scale)
+    bootloader.start()
+    return bootloader, slave
+
+# Pages covered by the data records of a HEX file with 16 bit addresses
+def covered_pages(input_file):
+    pages = set()
+    with open(input_file) as f:
+        for line in f:
+            record = bytes.fromhex(line.strip()[1:])
+            if record and record[3] == 0:
+                address = (record[1] << 8) | record[2]
+                pages.update(range(address // 128, (address + record[0] - 1) // 128 + 1))
+    return pages
+
+# The stand-in starts with random flash, so a page the upload skipped does not match
+def check_flash(bootloader, stk500, input_file):
+    image = stk500.read_hex(input_file, 128, FLASH_SIZE)
+    return all(bootloader.flash[page * 128:(page + 1) * 128] == image.data[page * 128:(page + 1) * 128]
+                for page in covered_pages(input_file))
+
+def bench_stk500(stk500, input_file, args):
+    bootloader, slave = start_bootloader(args.time_scale)
+    start = time.monotonic()
+    stk500.upload_hex('arduino:avr:uno', os.ttyname(slave), input_file, 60, args.verify)
+    elapsed = time.monotonic() - start
+    return {'seconds': elapsed, 'pages_written': bootloader.pages_written,
+            'bytes_sent': bootloader.bytes_received, 'flash_ok': check_flash(bootloader, stk500, input_file)}
+
+def bench_avrdude(stk500, input_file, args):
+    bootloader, slave = start_bootloader(args.time_scale)
+    command = [args.avrdude, '-p', 'atmega328p', '-c', 'arduino', '-P', os.ttyname(slave),
+                '-b', '115200', '-D', f'-Uflash:w:{input_file}:i']
+    if args.avrdude_conf:
+        command.insert(1, f'-C{args.avrdude_conf}')
+    if not args.verify:
+        command.insert(1, '-V')
+    start = time.monotonic()
+    result = subprocess.run(command, capture_output=True, text=True)
+    elapsed = time.monotonic() - start
+    if result.returncode != 0:
+        raise Exception(f'avrdude failed: {result.stderr}')
+    return {'seconds': elapsed, 'pages_written': bootloader.pages_written,
+            'bytes_sent': bootloader.bytes_received, 'flash_ok': check_flash(bootloader, stk500, input_file)}
+
+def bench_cli(input_file, args):
+    command = ['arduino-cli', 'upload', '--port', '/dev/null', '--fqbn', 'arduino:avr:uno', '--input-file', input_file]
+    env = dict(os.environ, FAKE_UPLOAD_LATENCY='0')
+    env['PATH'] = os.path.join(basedir, 'fakes') + os.pathsep + env['PATH']
+    start = time.monotonic()
+    subprocess.run(command, capture_output=True, env=env)
+    return {'seconds': time.monotonic() - start}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=24 * 1024, help='bytes of the sample sketch')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--time-scale', type=float, default=1.0, help='time factor of the stand-in bootloader')
+    parser.add_argument('--verify', action='store_true', help='read back the flash after writing it')
+    parser.add_argument('--avrdude', default=shutil.which('avrdude'), help='avrdude to compare with')
+    parser.add_argument('--avrdude-conf', help='avrdude.conf of the avrdude given')
+    parser.add_argument('--output', default=os.path.abspath('bench_upload.json'))
+    args = parser.parse_args()
+
+    stk500 = load_stk500()
+    workdir = tempfile.mkdtemp(prefix='in4labs_bench_')
+    try:
+        images = {'stop': os.path.join(basedir, os.pardir, 'arduino', 'compilations', 'precompiled', 'stop.ino.hex'),
+                    'sample': os.path.join(workdir, 'sample.hex')}
+        write_hex(images['sample'], *sample_image(args.size))
+
+        results = {'config': vars(args), 'images': {}}
+        for name, input_file in images.items():
+            image = stk500.read_hex(input_file, 128, FLASH_SIZE)
+            result = {'bytes': len(image.data), 'pages': image.page_count(),
+                        'stk500': [bench_stk500(stk500, input_file, args) for _ in range(args.runs)]}
+            if args.avrdude:
+                result['avrdude'] = [bench_avrdude(stk500, input_file, args) for _ in range(args.runs)]
+            else:
+                result['cli_fake'] = [bench_cli(input_file, args) for _ in range(args.runs)]
+            results['images'][name] = result
+
+            print(f'{name}: {result["bytes"]} bytes, {result["pages"]} pages')
+            for path in ['stk500', 'avrdude', 'cli_fake']:
+                if path in result:
+                    runs = result[path]
+                    line = f'  {path}: best {min(run["seconds"] for run in runs):.3f} s'
+                    if 'pages_written' in runs[0]:
+                        line += f', {runs[0]["pages_written"]} pages written, ' \
+                                f'flash {"ok" if all(run["flash_ok"] for run in runs) else "WRONG"}'
+                    print(line)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f'Results saved in {args.output}')
+    if not all(run['flash_ok'] for result in results['images'].values()
+                for path in ['stk500', 'avrdude'] for run in result.get(path, [])):
+        sys.exit('The flash does not match the image')
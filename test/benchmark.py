@@ -0,0 +1,239 @@
+import argparse
+import json
+import logging
+import os
+import pty
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from werkzeug.serving import make_server
+
+
+# Load test of the lab HTTP endpoints. The app runs in this process with the
+# stand-in tools of test/fakes (arduino-cli, dfu-util and uhubctl) in the PATH,
+# the stand-in suggestion API of test/fakes/suggest_server.py,
+# a fake sysfs tree with one board and a pty as its serial port, so no
+# hardware is needed. Every endpoint is driven by concurrent clients and the
+# latency percentiles, throughput and blocking of a probe request are written
+# as JSON.
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+repodir = os.path.join(basedir, os.pardir)
+
+SERVER_NAME = 'bench_server'
+LAB_NAME = 'in4labs_robotics'
+USER_EMAIL = 'admin@email.com'
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(int(round(percent / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+def summary(latencies, elapsed):
+    return {
+        'requests': len(latencies),
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'mean': statistics.mean(latencies),
+        'throughput': len(latencies) / elapsed, # requests per second
+    }
+
+# Create the fake sysfs tree and the serial port of the board, the copy of the
+# instance folder and the environment of the app. The board appears in sysfs
+# after board_delay seconds. Return the serial port of the board.
+def prepare_lab(workdir, suggest_port, board_delay=0):
+    def plug_board():
+        sysfs_device = os.path.join(workdir, 'sysfs', 'bus', 'usb', 'devices', '1-1.1')
+        os.makedirs(os.path.join(sysfs_device, '1-1.1:1.0', 'tty', 'ttyACM0'))
+        with open(os.path.join(sysfs_device, 'serial'), 'w') as f:
+            f.write('BENCH0001\n')
+    os.makedirs(os.path.join(workdir, 'sysfs', 'bus', 'usb', 'devices'))
+    if board_delay:
+        threading.Timer(board_delay, plug_board).start()
+    else:
+        plug_board()
+
+    # The board prints a line every 100 ms on the pty
+    master, slave = pty.openpty()
+    def board_output():
+        count = 0
+        while True:
+            os.write(master, f'line {count}\r\n'.encode('utf-8'))
+            count += 1
+            time.sleep(0.1)
+    threading.Thread(target=board_output, daemon=True).start()
+
+    shutil.copytree(os.path.join(repodir, 'arduino'), os.path.join(workdir, 'arduino'))
+    os.chdir(workdir) # The app instance path is <cwd>/arduino
+
+    os.environ['PATH'] = os.path.join(basedir, 'fakes') + os.pathsep + os.environ['PATH']
+    sys.path.insert(0, os.path.join(basedir, 'fakes'))
+    from suggest_server import make_server as make_suggest_server
+    suggest_server = make_suggest_server(suggest_port)
+    threading.Thread(target=suggest_server.serve_forever, daemon=True).start()
+    os.environ.update({
+        'SERVER_NAME': SERVER_NAME,
+        'LAB_NAME': LAB_NAME,
+        'USER_EMAIL': USER_EMAIL,
+        'END_TIME': '2100-01-01T00:00:00.000000Z',
+        'SYSFS_ROOT': os.path.join(workdir, 'sysfs'),
+        'SCHEDULER_PATH': os.path.join(workdir, 'scheduler'),
+        'WORKSPACE_ROOT': os.path.join(workdir, 'shm'),
+        'SUGGEST_URL': f'http://localhost:{suggest_port}/api.php',
+        # The fake board has no bootloader, upload with the stand-in arduino-cli
+        'AVR_UPLOADER': 'cli',
+    })
+    sys.path.insert(0, repodir)
+    return os.ttyname(slave)
+
+# Prepare the lab and start the app once the board is ready
+def start_app(workdir, port, suggest_port):
+    serial_port = prepare_lab(workdir, suggest_port)
+    from in4labs_robotics_app import app, boards, startup, precompile_thread
+
+    # Measure the steady state, not the startup of the lab
+    precompile_thread.join()
+    startup.finished.wait()
+
+    # Serial port of the board relative to /dev
+    boards['Board_1']['usb_driver'] = os.path.relpath(serial_port, '/dev')
+
+    server = make_server('localhost', port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def new_client(base_url):
+    session = requests.Session()
+    session.post(base_url, data={'email': USER_EMAIL})
+    return session
+
+def make_requests(base_url, cache_hit_ratio):
+    with open(os.path.join(repodir, 'arduino', 'examples', 'Board_1', '2._Wave_hello.ino')) as f:
+        example = f.read()
+
+    def compile_request(session):
+        # Cache hits compile the example, misses a unique edit of it
+        code = example if random.random() < cache_hit_ratio else example + f'\n// {random.random()}\n'
+        return session.post(base_url + 'compile', data={'board': 'Board_1', 'text': code})
+
+    def suggest_request(session):
+        # Cache hits ask for the example, misses for a unique edit of it
+        code = example if random.random() < cache_hit_ratio else example + f'\n// {random.random()}\n'
+        return session.post(base_url + 'suggest', data={'board': 'Board_1', 'text': code})
+
+    return {
+        'index': lambda session: session.get(base_url + 'index'),
+        'get_example': lambda session: session.get(base_url + 'get_example',
+                                        params={'board': 'Board_1', 'example': '2._Wave_hello.ino'}),
+        'compile': compile_request,
+        'execute': lambda session: session.post(base_url + 'execute',
+                                        data={'board': 'Board_1', 'target': 'stop'}),
+        'monitor': lambda session: session.get(base_url + 'monitor',
+                                        params={'board': 'Board_1', 'baudrate': 9600, 'seconds': 1}),
+        'suggest': suggest_request,
+    }
+
+# Run clients x requests_per_client requests concurrently and return the latencies
+def load(base_url, request, clients, requests_per_client):
+    def client(_):
+        session = new_client(base_url)
+        latencies = []
+        for _ in range(requests_per_client):
+            start = time.monotonic()
+            response = request(session)
+            latencies.append(time.monotonic() - start)
+            if response.status_code >= 400:
+                raise Exception(f'{response.request.url} returned {response.status_code}')
+        return latencies
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        latencies = sum(executor.map(client, range(clients)), [])
+    return latencies, time.monotonic() - start
+
+# Latency of a cheap request alone and while another endpoint is under load.
+# A high ratio means the load blocks the workers that should serve it.
+def blocking(base_url, probe, request, clients, requests_per_client):
+    session = new_client(base_url)
+    def probe_latencies(count):
+        latencies = []
+        for _ in range(count):
+            start = time.monotonic()
+            probe(session)
+            latencies.append(time.monotonic() - start)
+            time.sleep(0.05)
+        return latencies
+
+    idle = probe_latencies(20)
+    loader = threading.Thread(target=load, args=(base_url, request, clients, requests_per_client))
+    loader.start()
+    loaded = []
+    while loader.is_alive():
+        loaded += probe_latencies(1)
+    loader.join()
+    return {'idle_p95': percentile(idle, 95), 'loaded_p95': percentile(loaded, 95),
+            'ratio': percentile(loaded, 95) / percentile(idle, 95)}
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='in4labs_bench_')
+    try:
+        start_app(workdir, args.port, args.suggest_port)
+        base_url = f'http://localhost:{args.port}/{SERVER_NAME}/{LAB_NAME}/'
+        bench_requests = make_requests(base_url, args.cache_hit_ratio)
+
+        results = {'config': vars(args), 'endpoints': {}, 'blocking': {}}
+        for endpoint in args.endpoints:
+            latencies, elapsed = load(base_url, bench_requests[endpoint], args.clients, args.requests)
+            results['endpoints'][endpoint] = summary(latencies, elapsed)
+            print(f'{endpoint}: ' + ', '.join(f'{key} {value:.3f}'
+                                    for key, value in results['endpoints'][endpoint].items()))
+
+        for endpoint in ['compile', 'execute', 'monitor', 'suggest']:
+            if endpoint in args.endpoints:
+                results['blocking'][endpoint] = blocking(base_url, bench_requests['get_example'],
+                                                bench_requests[endpoint], args.clients, args.requests)
+                print(f'get_example while {endpoint}: ratio {results["blocking"][endpoint]["ratio"]:.2f}')
+
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(f'Results saved in {args.output}')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=5, help='requests per client and endpoint')
+    parser.add_argument('--endpoints', nargs='+', default=['index', 'get_example', 'compile', 'execute', 'monitor', 'suggest'])
+    parser.add_argument('--cache-hit-ratio', type=float, default=0.5)
+    parser.add_argument('--compile-latency', type=float, default=2, help='seconds')
+    parser.add_argument('--upload-latency', type=float, default=4, help='seconds')
+    parser.add_argument('--suggest-latency', type=float, default=2, help='seconds')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--suggest-port', type=int, default=8766)
+    parser.add_argument('--output', default=os.path.abspath('bench_output.json'))
+    args = parser.parse_args()
+
+    os.environ['FAKE_COMPILE_LATENCY'] = str(args.compile_latency)
+    os.environ['FAKE_UPLOAD_LATENCY'] = str(args.upload_latency)
+    os.environ['FAKE_SUGGEST_LATENCY'] = str(args.suggest_latency)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    status = 1
+    try:
+        run(args)
+        status = 0
+    except Exception:
+        traceback.print_exc()
+    # The clean lab thread of the app waits until the end of the session
+    os._exit(status)
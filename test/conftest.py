@@ -0,0 +1,23 @@
+import os
+import sys
+import types
+
+
+# The tests import the modules of the app without the package __init__, which
+# starts a lab, like the benchmarks do
+basedir = os.path.abspath(os.path.dirname(__file__))
+appdir = os.path.join(basedir, os.pardir, 'in4labs_robotics_app')
+
+# The config of the app is read from the environment of the container
+os.environ.setdefault('USER_EMAIL', 'test@email.com')
+os.environ.setdefault('END_TIME', '2100-01-01T00:00:00.000000Z')
+
+package = types.ModuleType('in4labs_robotics_app')
+package.__path__ = [appdir]
+sys.modules.setdefault('in4labs_robotics_app', package)
+
+# Stand-ins of the boards, driven by the tests on pseudo terminals
+sys.path.insert(0, os.path.join(basedir, 'fakes'))
+
+# Not a test, it starts the lab in Docker
+collect_ignore = ['test.py']
@@ -0,0 +1,56 @@
+import argparse
+import os
+import time
+from concurrent import futures
+
+import grpc
+from cc.arduino.cli.commands.v1 import (commands_pb2, commands_pb2_grpc, common_pb2,
+                                        compile_pb2, upload_pb2)
+
+
+# Fake 'arduino-cli daemon' to check the daemon toolchain backend without boards.
+# Compilations write a dummy image in the build path and fail if the sketch
+# contains the word 'error'.
+class FakeArduinoCoreService(commands_pb2_grpc.ArduinoCoreServiceServicer):
+    def __init__(self, latency):
+        self.latency = latency
+
+    def Create(self, request, context):
+        return commands_pb2.CreateResponse(instance=common_pb2.Instance(id=1))
+
+    def Init(self, request, context):
+        yield commands_pb2.InitResponse()
+
+    def Compile(self, request, context):
+        time.sleep(self.latency)
+        sketch_name = os.path.basename(request.sketch_path)
+        with open(os.path.join(request.sketch_path, sketch_name + '.ino')) as f:
+            code = f.read()
+        if 'error' in code:
+            diagnostic = f'{request.sketch_path}/{sketch_name}.ino:1:1: error: fake compilation error\n'
+            yield compile_pb2.CompileResponse(err_stream=diagnostic.encode('utf-8'))
+            context.abort(grpc.StatusCode.INTERNAL, 'Compilation failed')
+        os.makedirs(request.build_path, exist_ok=True)
+        with open(os.path.join(request.build_path, sketch_name + '.ino.hex'), 'w') as f:
+            f.write(':00000001FF\n')
+        yield compile_pb2.CompileResponse(out_stream=b'Sketch uses 0 bytes of program storage space.\n')
+
+    def Upload(self, request, context):
+        time.sleep(self.latency)
+        if not os.path.isfile(request.import_file):
+            context.abort(grpc.StatusCode.NOT_FOUND, f'{request.import_file} not found')
+        yield upload_pb2.UploadResponse(out_stream=b'')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=50051)
+    parser.add_argument('--latency', type=float, default=0, help='seconds per compile/upload')
+    args = parser.parse_args()
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+    commands_pb2_grpc.add_ArduinoCoreServiceServicer_to_server(FakeArduinoCoreService(args.latency), server)
+    server.add_insecure_port(f'localhost:{args.port}')
+    server.start()
+    print(f'Fake arduino-cli daemon listening on localhost:{args.port}')
+    server.wait_for_termination()
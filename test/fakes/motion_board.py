@@ -0,0 +1,120 @@
+import os
+import random
+import select
+import threading
+import time
+
+
+# Stand-in for a board running arduino/firmware/motion_interpreter.ino. It
+# follows the same protocol on the master side of a pty, so the packing and
+# streaming of in4labs_robotics_app.motion can be tried without a Braccio.
+# Movements take time_scale times their real duration and corrupt_rate is the
+# probability of a received packet being corrupted on the line: one of its
+# bytes after SYNC is flipped as it arrives, before it is framed, so a
+# corrupted length is handled like the firmware does.
+SYNC = 0xA5
+ACK = 0x06
+NAK = 0x15
+DONE = 0x04
+
+QUEUE_SIZE = 16
+WAYPOINT_SIZE = 7
+
+
+class FakeMotionBoard(threading.Thread):
+    def __init__(self, fd, time_scale=0.01, corrupt_rate=0):
+        super(FakeMotionBoard, self).__init__(daemon=True)
+        self.fd = fd
+        self.time_scale = time_scale
+        self.corrupt_rate = corrupt_rate
+        self.queue = []
+        self.packet = bytearray()
+        self.corrupt_at = None # Byte of the packet being received to corrupt
+        self.pending = bytearray() # Received and not read yet, like the serial buffer
+        self.expected = 0
+        self.nak_sent = False
+        self.end_seq = None
+        self.position = [90, 45, 180, 180, 90, 10] # Safety position of Braccio.begin()
+        self.moves = [] # Waypoints executed
+        self.stopped = threading.Event()
+
+    def reply(self, code, seq):
+        os.write(self.fd, bytes([code, seq]))
+
+    def nak(self):
+        if not self.nak_sent:
+            self.reply(NAK, self.expected)
+            self.nak_sent = True
+
+    def handle_packet(self, packet):
+        packet_type, seq, length = packet[1], packet[2], packet[3]
+        if (packet_type + seq + length + sum(packet[4:4 + length])) & 0xFF != packet[4 + length]:
+            self.nak()
+            return
+
+        if packet_type == ord('B'):
+            self.queue = []
+            self.end_seq = None
+            self.expected = (seq + 1) % 256
+            self.nak_sent = False
+            self.reply(ACK, seq)
+            return
+        if seq != self.expected:
+            if (self.expected - seq) % 256 <= 128:
+                self.reply(ACK, seq)
+            else:
+                self.nak()
+            return
+
+        if packet_type == ord('W') and length == WAYPOINT_SIZE:
+            self.queue.append(bytes(packet[4:4 + WAYPOINT_SIZE]))
+        elif packet_type == ord('E'):
+            self.end_seq = seq
+        self.expected = (self.expected + 1) % 256
+        self.nak_sent = False
+        self.reply(ACK, seq)
+
+    def read_byte(self, byte):
+        if not self.packet:
+            if byte != SYNC:
+                return
+            self.corrupt_at = None
+            if random.random() < self.corrupt_rate:
+                # Within the size of a waypoint packet, the length is not known yet
+                self.corrupt_at = random.randrange(1, 5 + WAYPOINT_SIZE)
+        elif len(self.packet) == self.corrupt_at:
+            byte ^= 0xFF
+        self.packet.append(byte)
+        if len(self.packet) == 4 and self.packet[3] > WAYPOINT_SIZE:
+            self.packet = bytearray() # Not a packet or a corrupted length
+            self.nak()
+        elif len(self.packet) >= 4 and len(self.packet) == 5 + self.packet[3]:
+            packet, self.packet = self.packet, bytearray()
+            self.handle_packet(packet)
+
+    def move(self, waypoint):
+        # Braccio.ServoMovement() moves every joint one degree per step
+        steps = max(abs(target - current) for target, current in zip(waypoint[1:], self.position))
+        time.sleep(steps * waypoint[0] / 1000 * self.time_scale)
+        self.position = list(waypoint[1:])
+        self.moves.append(tuple(waypoint))
+
+    # Stop reading the pty before it is closed, its fd may be reused
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def run(self):
+        while not self.stopped.is_set():
+            # Wait a bit for data only if there is nothing else to do
+            idle = not self.queue and self.end_seq is None and not self.pending
+            if select.select([self.fd], [], [], 0.05 if idle else 0)[0]:
+                self.pending += os.read(self.fd, 64)
+            # Bytes are only read while there is room in the queue
+            while self.pending and len(self.queue) < QUEUE_SIZE:
+                self.read_byte(self.pending.pop(0))
+            if self.queue:
+                self.move(self.queue.pop(0))
+            elif self.end_seq is not None:
+                self.reply(DONE, self.end_seq)
+                self.end_seq = None
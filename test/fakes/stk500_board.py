@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+
+
+# Stand-in for an UNO running optiboot, the STK500v1 bootloader. It answers on
+# the master side of a pty the commands used by in4labs_robotics_app.stk500
+# and by avrdude, and keeps the flash in memory. The time of the bytes on the
+# serial line and of the page writes is simulated, multiplied by time_scale.
+STK_OK = 0x10
+STK_INSYNC = 0x14
+CRC_EOP = 0x20
+
+SIGNATURE = b'\x1e\x95\x0f' # ATmega328P
+PAGE_SIZE = 128
+FLASH_SIZE = 32768
+PAGE_WRITE_SECONDS = 0.0045
+
+# Bytes after the command byte, not counting CRC_EOP, of the fixed length commands
+FIXED_LENGTHS = {
+    0x30: 0, # Get sync
+    0x41: 1, # Get parameter
+    0x42: 20, # Set device
+    0x45: 5, # Set extended device
+    0x50: 0, # Enter programming mode
+    0x51: 0, # Leave programming mode
+    0x55: 2, # Load address
+    0x56: 4, # Universal
+    0x75: 0, # Read signature
+}
+
+
+class FakeBootloader(threading.Thread):
+    def __init__(self, fd, baudrate=115200, time_scale=1.0):
+        super(FakeBootloader, self).__init__(daemon=True)
+        self.fd = fd
+        self.byte_seconds = 10 / baudrate * time_scale # Start, 8 data and stop bits
+        self.page_write_seconds = PAGE_WRITE_SECONDS * time_scale
+        self.buffer = bytearray()
+        self.address = 0 # Byte address
+        # The flash keeps the previous sketch, the pages are only erased when written
+        self.flash = bytearray(os.urandom(FLASH_SIZE))
+        self.pages_written = 0
+        self.pages_read = 0
+        self.bytes_received = 0
+
+    def reply(self, data=b''):
+        answer = bytes([STK_INSYNC]) + data + bytes([STK_OK])
+        time.sleep(len(answer) * self.byte_seconds)
+        os.write(self.fd, answer)
+
+    # Length of the command at the start of the buffer, or None if incomplete
+    def command_length(self):
+        command = self.buffer[0]
+        if command in FIXED_LENGTHS:
+            return FIXED_LENGTHS[command] + 2
+        if command in (0x64, 0x74): # Program and read page
+            if len(self.buffer) < 3:
+                return None
+            size = (self.buffer[1] << 8) | self.buffer[2]
+            return 5 + (size if command == 0x64 else 0)
+        return 2 # Unknown commands have no arguments in optiboot
+
+    def handle(self, command):
+        code = command[0]
+        if command[-1] != CRC_EOP:
+            return # Out of sync, no answer like optiboot
+        if code == 0x41:
+            self.reply(b'\x03') # Version of the parameter asked
+            return
+        elif code == 0x55:
+            self.address = ((command[2] << 8) | command[1]) * 2
+        elif code == 0x56:
+            self.reply(b'\x00')
+            return
+        elif code == 0x64:
+            size = (command[1] << 8) | command[2]
+            start = self.address - self.address % PAGE_SIZE
+            self.flash[start:start + PAGE_SIZE] = b'\xff' * PAGE_SIZE # Page erase
+            self.flash[self.address:self.address + size] = command[4:4 + size]
+            self.pages_written += 1
+            time.sleep(self.page_write_seconds)
+        elif code == 0x74:
+            size = (command[1] << 8) | command[2]
+            self.pages_read += 1
+            self.reply(bytes(self.flash[self.address:self.address + size]))
+            return
+        elif code == 0x75:
+            self.reply(SIGNATURE)
+            return
+        self.reply()
+
+    def run(self):
+        while True:
+            try:
+                data = os.read(self.fd, 1024)
+            except OSError:
+                return # The pty was closed
+            if not data:
+                return
+            time.sleep(len(data) * self.byte_seconds)
+            self.bytes_received += len(data)
+            self.buffer += data
+            while self.buffer:
+                length = self.command_length()
+                if length is None or len(self.buffer) < length:
+                    break
+                command, self.buffer = self.buffer[:length], self.buffer[length:]
+                self.handle(command)
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+# Stand-in for the code suggestion API used by the benchmarks. It answers every
+# POST with a fixed suggestion after FAKE_SUGGEST_LATENCY seconds. Run it and
+# point the app to it with SUGGEST_URL=http://localhost:<port>/api.php
+class SuggestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        time.sleep(float(os.environ.get('FAKE_SUGGEST_LATENCY', 2)))
+        body = f'fake suggestion for {len(form.get("text", [""])[0])} characters of code'.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def make_server(port):
+    return ThreadingHTTPServer(('localhost', port), SuggestHandler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8766)
+    args = parser.parse_args()
+    make_server(args.port).serve_forever()
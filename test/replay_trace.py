@@ -0,0 +1,233 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmark import SERVER_NAME, LAB_NAME, repodir, new_client, percentile, start_app
+
+
+# Replay of a session recorded with TRACE_PATH (see in4labs_robotics_app/trace.py)
+# against the app running with the stand-in tools of test/fakes, like
+# benchmark.py. The requests are sent at the times they were recorded, divided
+# by --speed, and the stand-in tools take the time the real ones took (also
+# divided by --speed): each sketch compiles as long as it did in the session
+# and fails the same way. The latency of every route in the replay is compared
+# with the recorded one, so changes to caching, scheduling or concurrency can
+# be measured on a real workload. The sketches are not in the trace, each one
+# is replaced by an example with a comment holding its hash, so the compile
+# cache hits and misses are the same. Motion scripts are not in the trace
+# either and the motion requests are skipped, as are the requests that only
+# follow a job (job_status, job_stream), which the replay does itself.
+
+# Route of the trace -> path of the request
+REPLAYED = {
+    'index': 'index',
+    'get_example': 'get_example',
+    'compile': 'compile',
+    'execute': 'execute',
+    'monitor': 'monitor',
+    'monitor_stop': 'monitor/stop',
+    'suggest': 'suggest',
+    'reset': 'reset_lab',
+}
+UPLOAD_TOOLS = ('arduino-cli', 'stk500', 'dfu-util')
+
+
+def read_trace(path):
+    with open(path) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    requests_entries = sorted((entry for entry in entries if entry['type'] == 'request'), key=lambda e: e['start'])
+    jobs = {entry['job_id']: entry for entry in entries if entry['type'] == 'job'}
+    return requests_entries, jobs
+
+# Tools run for a request, by the request itself or by its job
+def entry_tools(entry, jobs):
+    job = jobs.get(entry.get('job_id'))
+    return entry.get('tools', []) + (job['tools'] if job else [])
+
+# Seconds of the first compilation of every sketch and its outcome: 'ok',
+# 'cached' (it was in the compile cache, e.g. an example), 'precheck' (rejected
+# before compiling) or 'compiler' (failed to compile)
+def sketch_outcomes(requests_entries, jobs):
+    outcomes = {}
+    for entry in requests_entries:
+        if entry['route'] != 'compile' or 'sketch' not in entry or entry['sketch'] in outcomes:
+            continue
+        tools = entry_tools(entry, jobs)
+        job = jobs.get(entry.get('job_id'))
+        ok = job['ok'] if job is not None else entry.get('ok', True)
+        if any(tool['exit_code'] != 0 for tool in tools):
+            outcome = 'compiler'
+        elif tools:
+            outcome = 'ok'
+        else:
+            outcome = 'cached' if ok else 'precheck'
+        outcomes[entry['sketch']] = (sum(tool['seconds'] for tool in tools), outcome)
+    return outcomes
+
+# Sketch with the same compile time and outcome as the recorded one
+def make_sketch(example, sketch, outcomes, speed):
+    seconds, outcome = outcomes.get(sketch, (0, 'cached'))
+    if outcome == 'cached':
+        return example # Precompiled at startup
+    code = example + f'\n// sketch {sketch}\n// fake-latency: {seconds / speed:.3f}\n'
+    if outcome == 'compiler':
+        code += '// error\n' # The stand-in compiler fails
+    elif outcome == 'precheck':
+        code += '}\n' # Rejected before compiling
+    return code
+
+def median_or(values, default):
+    return statistics.median(values) if values else default
+
+# Latencies of the stand-in upload and suggestion API, from the session
+def tool_latencies(requests_entries, jobs):
+    uploads = [tool['seconds'] for entry in requests_entries if entry['route'] == 'execute'
+                for tool in entry_tools(entry, jobs) if tool['tool'] in UPLOAD_TOOLS]
+    # Only the suggestions that were not cached
+    suggestions = [entry['seconds'] for entry in requests_entries
+                    if entry['route'] == 'suggest' and entry['status'] == 200 and entry['seconds'] > 0.05]
+    return median_or(uploads, 4), median_or(suggestions, 2)
+
+def wait_job(session, base_url, job_id):
+    while True:
+        job = session.get(base_url + 'job_status', params={'job_id': job_id}).json()
+        if job['status'] in ('done', 'failed', 'cancelled', 'unknown'):
+            return job
+        time.sleep(0.1)
+
+def replay_request(session, base_url, entry, jobs, example, outcomes, speed):
+    args = dict(entry.get('args', {}))
+    if 'board' in entry:
+        args['board'] = entry['board']
+    if 'sketch' in entry:
+        args['text'] = make_sketch(example, entry['sketch'], outcomes, speed)
+    if 'seconds' in args:
+        args['seconds'] = max(1, round(int(args['seconds']) / speed))
+    url = base_url + REPLAYED[entry['route']]
+
+    start = time.monotonic()
+    if entry['method'] == 'POST':
+        response = session.post(url, data=args)
+    else:
+        response = session.get(url, params=args)
+    result = {'route': entry['route'], 'status': response.status_code, 'recorded_status': entry['status'],
+                'seconds': time.monotonic() - start, 'recorded_seconds': entry['seconds']}
+
+    # Asynchronous requests are done when their job is, as in the browser
+    job = jobs.get(entry.get('job_id'))
+    if response.status_code == 202:
+        wait_job(session, base_url, response.json()['job_id'])
+        result['job_seconds'] = time.monotonic() - start
+        if job is not None:
+            result['recorded_job_seconds'] = entry['seconds'] + job['queued_seconds'] + job['seconds']
+    return result
+
+def route_summary(results, key):
+    values = [result[key] for result in results if key in result]
+    if not values:
+        return None
+    return {'p50': percentile(values, 50), 'p95': percentile(values, 95), 'max': max(values)}
+
+def run(args):
+    requests_entries, jobs = read_trace(args.trace)
+    requests_entries = [entry for entry in requests_entries if entry['route'] in REPLAYED]
+    if not requests_entries:
+        raise Exception(f'No requests to replay in {args.trace}')
+    outcomes = sketch_outcomes(requests_entries, jobs)
+    upload_latency, suggest_latency = tool_latencies(requests_entries, jobs)
+    os.environ['FAKE_UPLOAD_LATENCY'] = str(upload_latency / args.speed)
+    os.environ['FAKE_SUGGEST_LATENCY'] = str(suggest_latency / args.speed)
+    os.environ['FAKE_COMPILE_LATENCY'] = str(args.compile_latency / args.speed) # Sketches not compiled in the trace
+    with open(os.path.join(repodir, 'arduino', 'examples', 'Board_1', '2._Wave_hello.ino')) as f:
+        example = f.read()
+
+    workdir = tempfile.mkdtemp(prefix='in4labs_bench_')
+    try:
+        start_app(workdir, args.port, args.suggest_port)
+        base_url = f'http://localhost:{args.port}/{SERVER_NAME}/{LAB_NAME}/'
+        session = new_client(base_url)
+
+        first = requests_entries[0]['start']
+        start = time.monotonic()
+        results = []
+        results_lock = threading.Lock()
+        def replay(entry):
+            delay = (entry['start'] - first) / args.speed - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+            sent = time.monotonic() - start
+            try:
+                result = replay_request(session, base_url, entry, jobs, example, outcomes, args.speed)
+            except requests.RequestException as e:
+                result = {'route': entry['route'], 'error': str(e)}
+            result['sent'] = sent
+            with results_lock:
+                results.append(result)
+
+        # A thread per request in flight, as the recorded requests overlapped
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(replay, requests_entries))
+        elapsed = time.monotonic() - start
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'config': vars(args), 'requests': len(results), 'seconds': elapsed,
+                'recorded_seconds': (requests_entries[-1]['start'] - first) / args.speed,
+                'errors': sum(1 for result in results if 'error' in result),
+                'status_changes': sum(1 for result in results
+                                        if 'status' in result and result['status'] != result['recorded_status']),
+                'routes': {}, 'results': sorted(results, key=lambda result: result['sent'])}
+    for route in sorted({result['route'] for result in results}):
+        route_results = [result for result in results if result['route'] == route]
+        report['routes'][route] = {
+            'requests': len(route_results),
+            'replay': route_summary(route_results, 'seconds'),
+            'recorded': route_summary(route_results, 'recorded_seconds'),
+            'replay_job': route_summary(route_results, 'job_seconds'),
+            'recorded_job': route_summary(route_results, 'recorded_job_seconds'),
+        }
+        line = f'{route}: {len(route_results)} requests'
+        for name in ['replay', 'recorded', 'replay_job', 'recorded_job']:
+            if report['routes'][route][name] is not None:
+                line += f', {name} p95 {report["routes"][route][name]["p95"]:.3f}'
+        print(line)
+    print(f'{report["requests"]} requests in {elapsed:.1f} s, {report["errors"]} errors, '
+            f'{report["status_changes"]} with a different status')
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f'Results saved in {args.output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('trace', help='JSONL file recorded with TRACE_PATH')
+    parser.add_argument('--speed', type=float, default=1, help='times faster than the recorded session')
+    parser.add_argument('--compile-latency', type=float, default=2,
+                        help='seconds of the compilations not in the trace (examples)')
+    parser.add_argument('--concurrency', type=int, default=32, help='requests in flight at most')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--suggest-port', type=int, default=8766)
+    parser.add_argument('--output', default=os.path.abspath('replay_output.json'))
+    args = parser.parse_args()
+    args.trace = os.path.abspath(args.trace)
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    status = 1
+    try:
+        run(args)
+        status = 0
+    except Exception:
+        traceback.print_exc()
+    # The clean lab thread of the app waits until the end of the session
+    os._exit(status)
@@ -0,0 +1,79 @@
+import argparse
+import importlib.util
+import json
+import os
+import pty
+import sys
+
+import serial
+
+
+# Stream a motion script to the interpreter of the motion script mode and
+# print the transfer summary. With --fake the board is the stand-in of
+# test/fakes/motion_board.py on a pty, so no hardware is needed; otherwise the
+# interpreter must be running on the board connected to --port.
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(basedir, 'fakes'))
+
+# Load the motion module alone, importing the package would start the lab
+spec = importlib.util.spec_from_file_location(
+    'motion', os.path.join(basedir, os.pardir, 'in4labs_robotics_app', 'motion.py'))
+motion = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(motion)
+
+
+# Transport of in4labs_robotics_app.motion over a serial port opened here
+class PortTransport(object):
+    def __init__(self, port, baudrate):
+        self.serial = serial.Serial(port, baudrate, timeout=0)
+
+    def write(self, data):
+        self.serial.write(data)
+
+    def read(self, timeout):
+        self.serial.timeout = timeout
+        return self.serial.read(max(self.serial.in_waiting, 1))
+
+# Waypoints that sweep the base and the wrist, like the wave example
+def sample_script(count):
+    return [[10, 45 + (i % 2) * 90, 90, 90, 90, 70 + (i % 2) * 40, 73] for i in range(count)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('script', nargs='?', help='JSON file with the waypoints (a sample script if not given)')
+    parser.add_argument('--waypoints', type=int, default=50, help='waypoints of the sample script')
+    parser.add_argument('--port', help='serial port of a board running the interpreter')
+    parser.add_argument('--baudrate', type=int, default=115200)
+    parser.add_argument('--fake', action='store_true', help='stream to the pty stand-in')
+    parser.add_argument('--time-scale', type=float, default=0.01, help='movement time factor of the stand-in')
+    parser.add_argument('--corrupt-rate', type=float, default=0, help='corrupted packets of the stand-in')
+    args = parser.parse_args()
+
+    if args.script:
+        with open(args.script) as f:
+            script = json.load(f)
+    else:
+        script = sample_script(args.waypoints)
+    waypoints, errors = motion.validate_waypoints(script, 200)
+    if errors:
+        sys.exit('\n'.join(errors))
+    packets = motion.pack_script(waypoints)
+
+    if args.fake:
+        from motion_board import FakeMotionBoard
+        master, slave = pty.openpty()
+        board = FakeMotionBoard(master, args.time_scale, args.corrupt_rate)
+        board.start()
+        port = os.ttyname(slave)
+    else:
+        port = args.port
+
+    summary = motion.stream_script(PortTransport(port, args.baudrate), packets)
+    print(json.dumps(summary))
+    print(f'{sum(len(packet) for packet in packets)} bytes in {len(packets)} packets')
+    if args.fake:
+        if board.moves != waypoints:
+            sys.exit('The stand-in did not execute the script as sent')
+        print('The stand-in executed every waypoint in order')
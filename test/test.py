@@ -61,6 +61,7 @@ docker_env = {
     'USER_ID': 1,
     'END_TIME': end_time.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
     'CAM_URL': cam_url,
+    'SCHEDULER_PATH': '/scheduler',
 }
 
 # Run the container
@@ -69,7 +70,10 @@ container = client.containers.run(image_name,
                                   privileged=True, 
                                   remove=True, 
                                   tty=True,
-                                  volumes={'/dev/bus/usb': {'bind': '/dev/bus/usb', 'mode': 'rw'}},
+                                  shm_size='256m', # RAM workspace of the compilations
+                                  volumes={'/dev/bus/usb': {'bind': '/dev/bus/usb', 'mode': 'rw'},
+                                           # Locks shared by all the labs of the Raspberry Pi
+                                           '/tmp/in4labs_scheduler': {'bind': '/scheduler', 'mode': 'rw'}},
                                   ports={'8000/tcp': ('0.0.0.0', lab_port)}, 
                                   environment=docker_env)
 
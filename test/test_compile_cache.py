@@ -0,0 +1,53 @@
+import os
+import time
+
+from in4labs_robotics_app.compile_cache import STALE_TMP_SECONDS, CompileCache
+
+
+FQBN = 'arduino:avr:uno'
+VERSION = '0.34.2'
+
+
+def make_key(code):
+    return CompileCache.make_key(code, FQBN, VERSION)
+
+
+def test_line_endings_share_a_key():
+    code = 'void setup() {}\nvoid loop() {}\n'
+    assert make_key(code.replace('\n', '\r\n')) == make_key(code)
+    assert make_key(code.replace('\n', '\r')) == make_key(code)
+
+def test_whitespace_in_a_raw_string_changes_the_key():
+    code = 'const char *s = R"(line  \nend)";\nvoid setup() {}\nvoid loop() {}\n'
+    assert make_key(code) != make_key(code.replace('line  ', 'line'))
+
+def test_trailing_lines_change_the_key():
+    # The diagnostics at the end of input give the last line
+    code = 'void setup() {\n'
+    assert make_key(code) != make_key(code + '\n\n')
+
+def test_only_stale_temporary_folders_are_removed(tmp_path):
+    cache_path = str(tmp_path / 'cache')
+    os.makedirs(os.path.join(cache_path, 'recent.tmp'))
+    os.makedirs(os.path.join(cache_path, 'stale.tmp'))
+    old = time.time() - STALE_TMP_SECONDS - 60
+    os.utime(os.path.join(cache_path, 'stale.tmp'), (old, old))
+
+    CompileCache(cache_path, 1024 * 1024)
+    assert os.path.isdir(os.path.join(cache_path, 'recent.tmp'))
+    assert not os.path.exists(os.path.join(cache_path, 'stale.tmp'))
+
+def test_put_and_get(tmp_path):
+    build_path = tmp_path / 'build'
+    build_path.mkdir()
+    (build_path / 'sketch.ino.hex').write_text(':00000001FF\n')
+    cache = CompileCache(str(tmp_path / 'cache'), 1024 * 1024)
+    key = make_key('void setup() {}\nvoid loop() {}\n')
+
+    cache.put(key, 0, '/tmp/sketch/sketch.ino: ok\n', '/tmp/sketch', str(build_path), 'sketch.ino')
+    meta = cache.get(key)
+    assert meta['artifacts'] == ['.hex']
+    restore_path = str(tmp_path / 'restore')
+    assert cache.restore(key, meta, '/tmp/other', restore_path, 'sketch.ino') == '/tmp/other/sketch.ino: ok\n'
+    assert os.path.isfile(os.path.join(restore_path, 'sketch.ino.hex'))
+    assert not [name for name in os.listdir(str(tmp_path / 'cache')) if name.endswith('.tmp')]
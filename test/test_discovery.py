@@ -0,0 +1,85 @@
+import os
+import shutil
+
+import pytest
+
+from in4labs_robotics_app.discovery import BoardDiscovery
+
+
+# Fake sysfs tree with the layout of the boards on the USB hub 1-1, like the
+# one of benchmark.py: bus/usb/devices/<port>/serial and the tty of the board
+# in bus/usb/devices/<port>/<port>:1.0/tty/ttyACMx (CDC ACM) or
+# bus/usb/devices/<port>/<port>:1.0/ttyUSBx (FTDI)
+class FakeSysfs(object):
+    def __init__(self, root):
+        self.root = root
+        self.devices_path = os.path.join(root, 'bus', 'usb', 'devices')
+        os.makedirs(self.devices_path)
+
+    def plug(self, usb_port, serial_number, tty):
+        device_path = os.path.join(self.devices_path, f'1-1.{usb_port}')
+        interface_path = os.path.join(device_path, f'1-1.{usb_port}:1.0')
+        if tty.startswith('ttyACM'):
+            os.makedirs(os.path.join(interface_path, 'tty', tty))
+        else:
+            os.makedirs(os.path.join(interface_path, tty))
+        with open(os.path.join(device_path, 'serial'), 'w') as f:
+            f.write(serial_number + '\n')
+
+    def unplug(self, usb_port):
+        shutil.rmtree(os.path.join(self.devices_path, f'1-1.{usb_port}'))
+
+@pytest.fixture
+def sysfs(tmp_path):
+    return FakeSysfs(str(tmp_path / 'sys'))
+
+
+def test_finds_a_plugged_board(sysfs):
+    sysfs.plug('1', 'SN0001', 'ttyACM0')
+    discovery = BoardDiscovery(sysfs.root, '1-1')
+    assert discovery.refresh('1') == {'serial_number': 'SN0001', 'usb_driver': 'ttyACM0'}
+
+def test_finds_ftdi_boards(sysfs):
+    sysfs.plug('2', 'FT0001', 'ttyUSB0')
+    discovery = BoardDiscovery(sysfs.root, '1-1')
+    assert discovery.refresh('2') == {'serial_number': 'FT0001', 'usb_driver': 'ttyUSB0'}
+
+def test_empty_port(sysfs):
+    discovery = BoardDiscovery(sysfs.root, '1-1')
+    assert discovery.refresh('1') is None
+
+def test_plug_and_unplug(sysfs):
+    discovery = BoardDiscovery(sysfs.root, '1-1')
+    assert discovery.get('1') is None
+
+    sysfs.plug('1', 'SN0001', 'ttyACM0')
+    # The cached result is kept until the port is refreshed (a hotplug event)
+    assert discovery.get('1') is None
+    assert discovery.refresh('1')['usb_driver'] == 'ttyACM0'
+    assert discovery.get('1')['usb_driver'] == 'ttyACM0'
+
+    sysfs.unplug('1')
+    assert discovery.refresh('1') is None
+    assert discovery.get('1') is None
+
+def test_board_enumerated_again_on_another_tty(sysfs):
+    sysfs.plug('1', 'SN0001', 'ttyACM0')
+    discovery = BoardDiscovery(sysfs.root, '1-1')
+    assert discovery.get('1')['usb_driver'] == 'ttyACM0'
+
+    # e.g. after a power cycle of the hub with uhubctl
+    sysfs.unplug('1')
+    sysfs.plug('1', 'SN0001', 'ttyACM1')
+    assert discovery.refresh('1') == {'serial_number': 'SN0001', 'usb_driver': 'ttyACM1'}
+
+def test_ports_are_independent(sysfs):
+    sysfs.plug('1', 'SN0001', 'ttyACM0')
+    sysfs.plug('2', 'SN0002', 'ttyACM1')
+    discovery = BoardDiscovery(sysfs.root, '1-1')
+    assert discovery.get('1')['serial_number'] == 'SN0001'
+    assert discovery.get('2')['serial_number'] == 'SN0002'
+
+    sysfs.unplug('2')
+    discovery.refresh('2')
+    assert discovery.get('1')['serial_number'] == 'SN0001'
+    assert discovery.get('2') is None
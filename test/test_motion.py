@@ -0,0 +1,103 @@
+import os
+import pty
+import random
+import select
+import tty
+
+import pytest
+
+from motion_board import FakeMotionBoard
+from in4labs_robotics_app.motion import ACK, NAK, WAYPOINT, MotionError, pack_packet, pack_script, stream_script
+from in4labs_robotics_app.process_runner import ProcessCancelled, process_context
+
+
+# Transport of stream_script on the slave side of a pty, the stand-in of
+# test/fakes/motion_board.py is on the master side
+class PtyTransport(object):
+    def __init__(self, fd):
+        self.fd = fd
+        tty.setraw(fd) # The packets are binary, no line discipline
+
+    def write(self, data):
+        os.write(self.fd, data)
+
+    def read(self, timeout):
+        if select.select([self.fd], [], [], timeout)[0]:
+            return os.read(self.fd, 64)
+        return b''
+
+class FakeLine(object):
+    def __init__(self, corrupt_rate=0, board=True):
+        self.master, self.slave = pty.openpty()
+        self.transport = PtyTransport(self.slave)
+        self.board = None
+        if board:
+            self.board = FakeMotionBoard(self.master, time_scale=0.001, corrupt_rate=corrupt_rate)
+            self.board.start()
+
+    def close(self):
+        if self.board is not None:
+            self.board.stop()
+        for fd in [self.master, self.slave]:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+@pytest.fixture
+def line():
+    fake_line = FakeLine()
+    yield fake_line
+    fake_line.close()
+
+# Waypoints that sweep the base and the wrist, like the wave example
+def sample_script(count):
+    return [(10, 45 + (i % 2) * 90, 90, 90, 90, 70 + (i % 2) * 40, 73) for i in range(count)]
+
+
+def test_stream_a_script(line):
+    waypoints = sample_script(40)
+    summary = stream_script(line.transport, pack_script(waypoints))
+    assert summary['waypoints'] == 40
+    assert summary['resent'] == 0
+    assert line.board.moves == waypoints
+
+def test_sequence_numbers_wrap_around(line):
+    waypoints = sample_script(300)
+    stream_script(line.transport, pack_script(waypoints))
+    assert line.board.moves == waypoints
+
+def test_corrupted_packets_are_sent_again():
+    # A packet corrupted again when it is resent is only resent on the timeout
+    # of the sender, seconds later, so not too many of them
+    random.seed(0)
+    fake_line = FakeLine(corrupt_rate=0.1)
+    try:
+        waypoints = sample_script(60)
+        summary = stream_script(fake_line.transport, pack_script(waypoints))
+        assert summary['resent'] > 0
+        assert fake_line.board.moves == waypoints
+    finally:
+        fake_line.close()
+
+def test_corrupted_length_is_answered_with_a_nak(line):
+    line.transport.write(pack_packet(ord('B'), 0))
+    assert line.transport.read(1) == bytes([ACK, 0])
+    packet = bytearray(pack_packet(WAYPOINT, 1, bytes(sample_script(1)[0])))
+    packet[3] ^= 0xFF
+    line.transport.write(bytes(packet))
+    assert line.transport.read(1) == bytes([NAK, 1])
+
+def test_no_interpreter_answering():
+    fake_line = FakeLine(board=False)
+    try:
+        with pytest.raises(MotionError, match='not answering'):
+            stream_script(fake_line.transport, pack_script(sample_script(2)), begin_timeout=0.5)
+    finally:
+        fake_line.close()
+
+def test_cancelled(line):
+    with process_context(None, lambda: True):
+        with pytest.raises(ProcessCancelled):
+            stream_script(line.transport, pack_script(sample_script(2)))
+    assert line.board.moves == []
@@ -0,0 +1,65 @@
+import glob
+import os
+
+import pytest
+
+from in4labs_robotics_app.precheck import precheck_sketch
+
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+sketches = sorted(glob.glob(os.path.join(basedir, os.pardir, 'arduino', '**', '*.ino'), recursive=True))
+
+SKETCH_FILE = '/tmp/temp_sketch/temp_sketch.ino'
+
+# Valid sketches the checks could get wrong, the compiler accepts all of them
+VALID = {
+    'spliced line comment': 'void setup() { /\\\n/ comment {\n}\nvoid loop() {}\n',
+    'comment continued by a backslash': 'void setup() {} // comment \\\n{\nvoid loop() {}\n',
+    'spliced end of block comment': 'void setup() {} /* { *\\\n/\nvoid loop() {}\n',
+    'spliced name': 'void set\\\nup() {}\nvoid loop() {}\n',
+    'spliced CRLF line': 'void setup() { /\\\r\n/ {\r\n}\r\nvoid loop() {}\r\n',
+    'macro on several lines': '#define MOVE(x) \\\n  Braccio.ServoMovement(20, x, 90, 90, 90, 90, 73)\n'
+                                '#include <Braccio.h>\nvoid setup() { Braccio.begin(); }\nvoid loop() { MOVE(0); }\n',
+    'brackets in literals': 'void setup() { Serial.print("{(["); char c = \'}\'; }\nvoid loop() {}\n',
+    'escaped quote': 'void setup() { Serial.print("\\"{"); }\nvoid loop() {}\n',
+    'brackets in block comment': 'void setup() { /* } */ }\nvoid loop() {}\n',
+    'digit separator': "void setup() { long n = 1'000'000; }\nvoid loop() {}\n",
+    'raw string': 'void setup() { Serial.print(R"(})"); }\nvoid loop() {}\n',
+    'brackets split between #if branches': '#if 1\nvoid setup() {\n#else\nvoid setup() { {\n#endif\n}\nvoid loop() {}\n',
+    'own main': 'int main() { return 0; }\n',
+    'unknown header': '#include "sketch.h"\n',
+    'template arguments': '#include <Braccio.h>\nvoid setup() { Braccio.begin(max<int>(0, 1)); }\nvoid loop() {}\n',
+    'BraccioV2': '#include <BraccioV2.h>\nBraccio arm;\nvoid setup() { arm.setJointCenter(WRIST_ROT, 90); }\nvoid loop() {}\n',
+}
+
+# Sketches with errors and the first diagnostic expected, line and column
+INVALID = {
+    'missing brace': ('void setup() {\n\nvoid loop() {}\n', "3:15: error: expected '}' at end of input"),
+    'extra parenthesis': ('void setup() { delay(1)); }\nvoid loop() {}\n', "1:24: error: expected '}' before ')' token"),
+    'missing loop': ('void setup() {}\n', "1:1: error: undefined reference to 'loop'"),
+    'unterminated comment': ('void setup() {}\nvoid loop() {}\n/* end\n', '3:1: error: unterminated comment'),
+    'unknown method': ('#include <Braccio.h>\nvoid setup() { Braccio.being(); }\nvoid loop() {}\n',
+                        "2:24: error: 'class _Braccio' has no member named 'being'; did you mean 'begin'?"),
+    'wrong arguments': ('#include <Braccio.h>\nvoid setup() { Braccio.ServoMovement(20, 90, 90); }\nvoid loop() {}\n',
+                        "2:24: error: no matching function for call to '_Braccio::ServoMovement' with 3 arguments"),
+    'error after a splice': ('#define A \\\n  1\nvoid setup() { )\nvoid loop() {}\n',
+                                "3:16: error: expected '}' before ')' token"),
+}
+
+
+@pytest.mark.parametrize('sketch', sketches, ids=os.path.basename)
+def test_shipped_sketches_are_accepted(sketch):
+    with open(sketch) as f:
+        assert precheck_sketch(f.read(), SKETCH_FILE) is None
+
+@pytest.mark.parametrize('name', sorted(VALID))
+def test_valid_sketches_are_accepted(name):
+    assert precheck_sketch(VALID[name], SKETCH_FILE) is None
+
+@pytest.mark.parametrize('name', sorted(INVALID))
+def test_errors_are_reported_like_the_compiler(name):
+    code, expected = INVALID[name]
+    stderr = precheck_sketch(code, SKETCH_FILE)
+    assert stderr is not None
+    assert stderr.startswith(f'{SKETCH_FILE}:{expected}')
+    assert stderr.endswith('Compilation error: exit status 1\n')
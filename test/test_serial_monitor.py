@@ -0,0 +1,172 @@
+import os
+import pty
+import time
+
+import pytest
+
+from in4labs_robotics_app.serial_monitor import MonitorSession, RingBuffer, SerialManager, SerialSession
+
+
+# Pseudo terminal standing in for the serial port of a board. The tests write
+# on the master side what the board would print. The port is a symlink to the
+# slave side, so the board can be "plugged again" on another pty.
+class FakePort(object):
+    def __init__(self, path):
+        self.path = path
+        self.master = None
+        self.plug()
+
+    def plug(self):
+        self.master, slave = pty.openpty()
+        if os.path.lexists(self.path):
+            os.remove(self.path)
+        os.symlink(os.ttyname(slave), self.path)
+        self.slave = slave
+
+    def unplug(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+    def print(self, text):
+        os.write(self.master, text.encode('utf-8'))
+
+    def close(self):
+        for fd in [self.master, self.slave]:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+@pytest.fixture
+def port(tmp_path):
+    fake_port = FakePort(str(tmp_path / 'ttyACM0'))
+    yield fake_port
+    fake_port.close()
+
+@pytest.fixture
+def session(tmp_path, port):
+    serial_session = SerialSession(port.path, 9600, str(tmp_path / 'port.lock'), str(tmp_path / 'port.pause'))
+    serial_session.start()
+    wait_open(serial_session)
+    yield serial_session
+    serial_session.close()
+    serial_session.join(timeout=2)
+
+def wait_open(serial_session, timeout=3):
+    deadline = time.monotonic() + timeout
+    while serial_session.serial is None:
+        assert time.monotonic() < deadline, 'The serial port was not opened'
+        time.sleep(0.02)
+
+# Read lines from the monitor until count have been received
+def read_lines(monitor, count, timeout=3):
+    lines = []
+    deadline = time.monotonic() + timeout
+    while len(lines) < count and time.monotonic() < deadline:
+        lines += monitor.read_lines(timeout=0.2)
+    return lines
+
+
+def test_ring_buffer_wraps_around():
+    ring = RingBuffer(8)
+    ring.write(b'abcdef')
+    data, position = ring.read(0)
+    assert (data, position) == (b'abcdef', 6)
+
+    ring.write(b'ghij')
+    data, position = ring.read(position)
+    assert (data, position) == (b'ghij', 10)
+
+def test_ring_buffer_drops_the_oldest_data_of_slow_readers():
+    ring = RingBuffer(8)
+    ring.write(b'0123456789')
+    data, position = ring.read(0)
+    assert (data, position) == (b'23456789', 10)
+
+def test_monitor_splits_lines(session, port):
+    monitor = MonitorSession(session, seconds=10)
+    port.print('hello\r\nworld\r\npart')
+    assert read_lines(monitor, 2) == ['hello', 'world']
+
+    # The partial line is kept until it is complete
+    port.print('ial\r\n')
+    assert read_lines(monitor, 1) == ['partial']
+
+def test_monitor_ends_when_its_time_is_up(session, port):
+    monitor = MonitorSession(session, seconds=0.3)
+    port.print('last\r\nunfinished')
+    lines = read_lines(monitor, 1)
+    time.sleep(0.4)
+    lines += monitor.read_lines(timeout=0.2)
+    assert lines == ['last', 'unfinished']
+    assert monitor.stopped.is_set()
+
+def test_readers_share_the_output(session, port):
+    first = MonitorSession(session, seconds=10)
+    second = MonitorSession(session, seconds=10)
+    port.print('shared\r\n')
+    assert read_lines(first, 1) == ['shared']
+    assert read_lines(second, 1) == ['shared']
+
+def test_pause_releases_the_port(session, port):
+    session.pause()
+    assert session.port_released.is_set()
+    assert session.serial is None
+
+    session.resume()
+    wait_open(session)
+    monitor = MonitorSession(session, seconds=10)
+    port.print('after upload\r\n')
+    assert read_lines(monitor, 1) == ['after upload']
+
+def test_reconnects_when_the_board_is_plugged_again(session, port):
+    monitor = MonitorSession(session, seconds=10)
+    port.print('before\r\n')
+    assert read_lines(monitor, 1) == ['before']
+
+    port.unplug()
+    time.sleep(0.3)
+    port.plug()
+    wait_open(session)
+    port.print('after\r\n')
+    assert read_lines(monitor, 1, timeout=5) == ['after']
+
+def test_manager_pause_does_not_wait_for_the_timeout(tmp_path, port):
+    manager = SerialManager(str(tmp_path))
+    manager.get_session('Board_1', port.path, 9600)
+    wait_open(manager.sessions['Board_1'])
+    try:
+        start = time.monotonic()
+        with manager.paused('Board_1'):
+            assert manager.sessions['Board_1'].serial is None
+        assert time.monotonic() - start < 2
+    finally:
+        manager.close()
+
+def test_manager_stops_a_monitor_from_another_process(tmp_path, port):
+    manager = SerialManager(str(tmp_path))
+    other_manager = SerialManager(str(tmp_path)) # Another worker of the server
+    try:
+        monitor = manager.start_monitor('Board_1', port.path, 9600, seconds=30)
+        other_manager.stop_monitor('Board_1')
+        monitor.read_lines(timeout=0.2)
+        assert monitor.stopped.is_set()
+
+        # A monitor started after the stop is not affected
+        time.sleep(0.05)
+        monitor = manager.start_monitor('Board_1', port.path, 9600, seconds=30)
+        monitor.read_lines(timeout=0.2)
+        assert not monitor.stopped.is_set()
+    finally:
+        manager.close()
+
+def test_monitor_stops_when_its_session_is_replaced(tmp_path, port):
+    manager = SerialManager(str(tmp_path))
+    try:
+        monitor = manager.start_monitor('Board_1', port.path, 9600, seconds=30)
+        # The board got a new tty, its old session is closed
+        manager.get_session('Board_1', str(tmp_path / 'ttyACM1'), 9600)
+        monitor.read_lines(timeout=0.2)
+        assert monitor.stopped.is_set()
+    finally:
+        manager.close()
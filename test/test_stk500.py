@@ -0,0 +1,146 @@
+import os
+import pty
+import subprocess
+
+import pytest
+
+from bench_upload import covered_pages, sample_image, write_hex
+from stk500_board import FakeBootloader, FLASH_SIZE
+from in4labs_robotics_app.process_runner import ProcessCancelled, process_context
+from in4labs_robotics_app.stk500 import BOARDS, Stk500Error, read_hex, upload_hex
+
+
+FQBN = 'arduino:avr:uno'
+# The serial line and the page writes of the stand-in take no time
+TIME_SCALE = 0
+
+# Stand-in that does not write one page, like a flash that fails to program
+class FaultyBootloader(FakeBootloader):
+    def __init__(self, fd, bad_page):
+        super(FaultyBootloader, self).__init__(fd, time_scale=TIME_SCALE)
+        self.bad_page = bad_page
+
+    def handle(self, command):
+        if command[0] == 0x64 and self.address // 128 == self.bad_page:
+            self.reply()
+            return
+        super(FaultyBootloader, self).handle(command)
+
+# Pty with a stand-in bootloader on the master side, the port is the slave side
+class FakeBoard(object):
+    def __init__(self, bootloader_class=FakeBootloader, **kwargs):
+        self.master, self.slave = pty.openpty()
+        self.port = os.ttyname(self.slave)
+        self.bootloader = None
+        if bootloader_class is not None:
+            self.bootloader = bootloader_class(self.master, **kwargs)
+            self.bootloader.start()
+
+    # The stand-in stops on the hangup of the slave side, before the master
+    # side is closed and its fd can be reused
+    def close(self):
+        os.close(self.slave)
+        if self.bootloader is not None:
+            self.bootloader.join()
+        os.close(self.master)
+
+@pytest.fixture
+def board():
+    fake_board = FakeBoard(time_scale=TIME_SCALE)
+    yield fake_board
+    fake_board.close()
+
+@pytest.fixture
+def hex_file(tmp_path):
+    data, gaps = sample_image(8192, seed=1)
+    path = str(tmp_path / 'sketch.hex')
+    write_hex(path, data, gaps)
+    return path
+
+def write_records(path, records):
+    with open(path, 'w') as f:
+        f.write('\n'.join(records) + '\n')
+
+
+def test_read_hex_pads_the_last_page(tmp_path):
+    path = str(tmp_path / 'sketch.hex')
+    write_hex(path, bytes(range(200)))
+    image = read_hex(path, 128, FLASH_SIZE)
+    assert len(image.data) == 256
+    assert image.data[:200] == bytes(range(200))
+    assert image.data[200:] == b'\xff' * 56
+    assert image.covered == {0, 1}
+
+def test_read_hex_skips_the_gaps(hex_file):
+    image = read_hex(hex_file, 128, FLASH_SIZE)
+    assert image.covered == covered_pages(hex_file)
+    assert [address // 128 for address, _ in image.pages()] == sorted(covered_pages(hex_file))
+
+def test_read_hex_extended_address(tmp_path):
+    path = str(tmp_path / 'sketch.hex')
+    # Segment 0x0010 moves the data 256 bytes up
+    write_records(path, [':020000020010EC', ':0400000001020304F2', ':00000001FF'])
+    image = read_hex(path, 128, FLASH_SIZE)
+    assert image.data[256:260] == b'\x01\x02\x03\x04'
+    assert image.covered == {2}
+
+def test_read_hex_bad_checksum(tmp_path):
+    path = str(tmp_path / 'sketch.hex')
+    write_records(path, [':0400000001020304F3', ':00000001FF'])
+    with pytest.raises(Stk500Error, match=r'sketch.hex:1: bad length or checksum'):
+        read_hex(path, 128, FLASH_SIZE)
+
+def test_read_hex_not_a_record(tmp_path):
+    path = str(tmp_path / 'sketch.hex')
+    write_records(path, ['0400000001020304F2'])
+    with pytest.raises(Stk500Error, match=r'sketch.hex:1: not an Intel HEX record'):
+        read_hex(path, 128, FLASH_SIZE)
+
+def test_read_hex_sketch_too_large(tmp_path):
+    path = str(tmp_path / 'sketch.hex')
+    flash_size = BOARDS[FQBN]['flash_size']
+    write_hex(path, b'\x00' * (flash_size + 16))
+    with pytest.raises(Stk500Error, match=f'the maximum is {flash_size}'):
+        read_hex(path, 128, flash_size)
+
+def test_upload_writes_every_covered_page(board, hex_file):
+    result = upload_hex(FQBN, board.port, hex_file, 30)
+    image = read_hex(hex_file, 128, FLASH_SIZE)
+    pages = covered_pages(hex_file)
+    assert result.returncode == 0
+    assert board.bootloader.pages_written == len(pages)
+    # The flash of the stand-in starts random, so a skipped page does not match
+    for page in pages:
+        assert board.bootloader.flash[page * 128:(page + 1) * 128] == image.data[page * 128:(page + 1) * 128]
+
+def test_upload_with_verify_reads_every_page(board, hex_file):
+    upload_hex(FQBN, board.port, hex_file, 30, verify=True)
+    assert board.bootloader.pages_read == len(covered_pages(hex_file))
+
+def test_verify_finds_a_page_not_written(hex_file):
+    bad_page = sorted(covered_pages(hex_file))[3]
+    fake_board = FakeBoard(FaultyBootloader, bad_page=bad_page)
+    try:
+        with pytest.raises(Stk500Error, match=f'Verification error at address 0x{bad_page * 128:04x}'):
+            upload_hex(FQBN, fake_board.port, hex_file, 30, verify=True)
+    finally:
+        fake_board.close()
+
+def test_no_bootloader_answering(hex_file):
+    fake_board = FakeBoard(bootloader_class=None)
+    try:
+        with pytest.raises(Stk500Error, match='Not in sync'):
+            upload_hex(FQBN, fake_board.port, hex_file, 30)
+    finally:
+        fake_board.close()
+
+def test_upload_timeout(board, hex_file):
+    with pytest.raises(subprocess.TimeoutExpired):
+        upload_hex(FQBN, board.port, hex_file, 0)
+    assert board.bootloader.pages_written == 0
+
+def test_upload_cancelled(board, hex_file):
+    with process_context(None, lambda: True):
+        with pytest.raises(ProcessCancelled):
+            upload_hex(FQBN, board.port, hex_file, 30)
+    assert board.bootloader.pages_written == 0
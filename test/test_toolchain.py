@@ -0,0 +1,106 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+# The daemon backend needs grpcio and the stubs of the arduino-cli protos (see the Dockerfile)
+pytest.importorskip('grpc')
+pytest.importorskip('cc.arduino.cli.commands.v1')
+
+from in4labs_robotics_app.process_runner import ProcessCancelled, process_context
+from in4labs_robotics_app.toolchain import DaemonToolchain
+from in4labs_robotics_app.utils import is_sketch_error
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+# Connecting before the daemon listens makes gRPC wait for its reconnection backoff
+def wait_listening(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return
+        except OSError:
+            assert time.monotonic() < deadline, 'The fake daemon did not start'
+            time.sleep(0.05)
+
+# Start test/fake_arduino_daemon.py with latency seconds per compile and upload
+# and connect a DaemonToolchain to it
+@pytest.fixture
+def daemon():
+    processes = []
+    toolchains = []
+    def start(latency=0):
+        port = free_port()
+        processes.append(subprocess.Popen([sys.executable, os.path.join(basedir, 'fake_arduino_daemon.py'),
+                                            '--port', str(port), '--latency', str(latency)],
+                                            stdout=subprocess.DEVNULL))
+        wait_listening(port)
+        toolchains.append(DaemonToolchain(f'localhost:{port}'))
+        return toolchains[-1]
+    yield start
+    for toolchain in toolchains:
+        toolchain.close()
+    for process in processes:
+        process.terminate()
+        process.wait()
+
+def write_sketch(tmp_path, code):
+    sketch_path = tmp_path / 'temp_sketch'
+    sketch_path.mkdir()
+    (sketch_path / 'temp_sketch.ino').write_text(code)
+    return str(sketch_path)
+
+
+def test_compile(daemon, tmp_path):
+    sketch_path = write_sketch(tmp_path, 'void setup() {}\nvoid loop() {}\n')
+    build_path = str(tmp_path / 'build')
+    result = daemon().compile('arduino:avr:uno', sketch_path, build_path, str(tmp_path / 'cache'))
+    assert result.returncode == 0
+    assert 'Sketch uses' in result.stdout
+    assert os.path.isfile(os.path.join(build_path, 'temp_sketch.ino.hex'))
+
+def test_compile_error_is_reported_against_the_sketch(daemon, tmp_path):
+    sketch_path = write_sketch(tmp_path, 'void setup() { error }\n')
+    result = daemon().compile('arduino:avr:uno', sketch_path, str(tmp_path / 'build'), str(tmp_path / 'cache'))
+    assert result.returncode == 1
+    assert is_sketch_error(result.stderr, sketch_path)
+
+def test_output_is_written_to_the_job(daemon, tmp_path):
+    sketch_path = write_sketch(tmp_path, 'void setup() {}\nvoid loop() {}\n')
+    output_path = tmp_path / 'job.log'
+    with process_context(str(output_path), None):
+        daemon().compile('arduino:avr:uno', sketch_path, str(tmp_path / 'build'), str(tmp_path / 'cache'))
+    assert 'Sketch uses' in output_path.read_text()
+
+def test_upload(daemon, tmp_path):
+    toolchain = daemon()
+    image = tmp_path / 'temp_sketch.ino.hex'
+    image.write_text(':00000001FF\n')
+    assert toolchain.upload('arduino:avr:uno', '/dev/ttyACM0', str(image)).returncode == 0
+
+    result = toolchain.upload('arduino:avr:uno', '/dev/ttyACM0', str(tmp_path / 'missing.hex'))
+    assert result.returncode == 1
+    assert 'not found' in result.stderr
+
+def test_compile_timeout(daemon, tmp_path):
+    sketch_path = write_sketch(tmp_path, 'void setup() {}\nvoid loop() {}\n')
+    toolchain = daemon(latency=5)
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        toolchain.compile('arduino:avr:uno', sketch_path, str(tmp_path / 'build'), str(tmp_path / 'cache'), timeout=0.5)
+    assert time.monotonic() - start < 3
+
+def test_cancelled_compile(daemon, tmp_path):
+    sketch_path = write_sketch(tmp_path, 'void setup() {}\nvoid loop() {}\n')
+    with process_context(None, lambda: True), pytest.raises(ProcessCancelled):
+        daemon(latency=0.2).compile('arduino:avr:uno', sketch_path, str(tmp_path / 'build'), str(tmp_path / 'cache'))